@@ -0,0 +1,84 @@
+CREATE TABLE "dim_date" (
+  "date_id" date PRIMARY KEY NOT NULL,
+  "year" int NOT NULL,
+  "month" int NOT NULL,
+  "day" int NOT NULL,
+  "day_of_week" int NOT NULL,
+  "day_name" varchar NOT NULL,
+  "month_name" varchar NOT NULL,
+  "quarter" int NOT NULL
+);
+
+CREATE TABLE "dim_staff" (
+  "staff_id" int PRIMARY KEY NOT NULL,
+  "first_name" varchar NOT NULL,
+  "last_name" varchar NOT NULL,
+  "department_name" varchar NOT NULL,
+  "location" varchar NOT NULL,
+  "email_address" varchar NOT NULL
+);
+
+CREATE TABLE "dim_location" (
+  "location_id" int PRIMARY KEY NOT NULL,
+  "address_line_1" varchar NOT NULL,
+  "address_line_2" varchar,
+  "district" varchar,
+  "city" varchar NOT NULL,
+  "postal_code" varchar NOT NULL,
+  "country" varchar NOT NULL,
+  "phone" varchar NOT NULL
+);
+
+CREATE TABLE "dim_design" (
+  "design_id" int PRIMARY KEY NOT NULL,
+  "design_name" varchar NOT NULL,
+  "file_location" varchar NOT NULL,
+  "file_name" varchar NOT NULL
+);
+
+CREATE TABLE "dim_currency" (
+  "currency_id" int PRIMARY KEY NOT NULL,
+  "currency_code" varchar NOT NULL,
+  "currency_name" varchar NOT NULL
+);
+
+CREATE TABLE "dim_counterparty" (
+  "counterparty_id" int PRIMARY KEY NOT NULL,
+  "counterparty_legal_name" varchar NOT NULL,
+  "counterparty_legal_address_line_1" varchar NOT NULL,
+  "counterparty_legal_address_line_2" varchar,
+  "counterparty_legal_district" varchar,
+  "counterparty_legal_city" varchar NOT NULL,
+  "counterparty_legal_postal_code" varchar NOT NULL,
+  "counterparty_legal_country" varchar NOT NULL,
+  "counterparty_legal_phone_number" varchar NOT NULL
+);
+
+-- The references of the facts to the dimensions are not enforced with foreign
+-- keys: they would be checked row by row by triggers, which makes bulk loads
+-- about ten times slower. The loader merges the dimensions of a run before its
+-- facts, in the same transaction.
+CREATE TABLE "fact_sales_order" (
+  "sales_record_id" SERIAL PRIMARY KEY NOT NULL,
+  "sales_order_id" int NOT NULL,
+  "created_date" date NOT NULL, -- references dim_date.date_id
+  "created_time" time NOT NULL,
+  "last_updated_date" date NOT NULL, -- references dim_date.date_id
+  "last_updated_time" time NOT NULL,
+  "sales_staff_id" int NOT NULL, -- references dim_staff.staff_id
+  "counterparty_id" int NOT NULL, -- references dim_counterparty.counterparty_id
+  "units_sold" int NOT NULL,
+  "unit_price" numeric(10, 2) NOT NULL,
+  "currency_id" int NOT NULL, -- references dim_currency.currency_id
+  "design_id" int NOT NULL, -- references dim_design.design_id
+  "agreed_payment_date" date NOT NULL, -- references dim_date.date_id
+  "agreed_delivery_date" date NOT NULL, -- references dim_date.date_id
+  "agreed_delivery_location_id" int NOT NULL -- references dim_location.location_id
+);
+
+-- One row per transform run loaded into the warehouse
+CREATE TABLE "load_ledger" (
+  "time_prefix" varchar PRIMARY KEY NOT NULL,
+  "loaded_at" timestamp NOT NULL DEFAULT (current_timestamp),
+  "row_count" int NOT NULL DEFAULT 0
+);
@@ -0,0 +1,309 @@
+import re
+from datetime import datetime
+import polars as pl
+from pg8000.native import identifier
+from src.utils.load_utils import dataframe_to_csv
+
+SCHEMA_FILE = "database/test_db.sql"
+BASE_TIMESTAMP = datetime(2022, 11, 3, 14, 20, 49)
+CURRENCY_CODES = ["GBP", "USD", "EUR"]
+PAYMENT_TYPE_NAMES = ["SALES_RECEIPT", "SALES_REFUND", "PURCHASE_PAYMENT", "PURCHASE_REFUND"]
+# share of the churned rows updated, inserted and deleted between two snapshots
+CHURN_MIX = {"update": 0.7, "insert": 0.25, "delete": 0.05}
+CHURN_BANDS = 10000
+# tables are created and filled in this order (referenced tables first)
+TABLES = [
+    "currency",
+    "payment_type",
+    "department",
+    "address",
+    "staff",
+    "counterparty",
+    "design",
+    "sales_order",
+    "purchase_order",
+    "transaction",
+    "payment",
+]
+
+
+def table_sizes(scale):
+    """
+    Returns the number of rows of each totesys table at a scale factor:
+    sales_order, transaction and payment have scale rows, purchase_order
+    half of it, and the reference tables grow slowly, with the minimum
+    sizes of the real database.
+    """
+    return {
+        "currency": len(CURRENCY_CODES),
+        "payment_type": len(PAYMENT_TYPE_NAMES),
+        "department": 8,
+        "address": max(30, scale // 1000),
+        "staff": max(20, scale // 1000),
+        "counterparty": max(20, scale // 1000),
+        "design": max(100, scale // 100),
+        "sales_order": scale,
+        "purchase_order": max(1, scale // 2),
+        "transaction": scale,
+        "payment": scale,
+    }
+
+
+def random_int(seed, low, high):
+    """
+    Returns an expression drawing a pseudo-random integer from low to high
+    (both included) for each row, from the hash of its id: the same scale
+    always generates the same data.
+    """
+    return (pl.col("id").hash(seed) % (high - low + 1) + low).cast(pl.Int64)
+
+
+def random_date(seed):
+    """
+    Returns an expression drawing a pseudo-random yyyy-mm-dd date string
+    within a year of BASE_TIMESTAMP
+    """
+    return (
+        pl.lit(BASE_TIMESTAMP.date()) + pl.duration(days=random_int(seed, 0, 365))
+    ).dt.strftime("%Y-%m-%d")
+
+
+def random_amount(seed, low, high):
+    """
+    Returns an expression drawing a pseudo-random amount with two decimals
+    from low to high, as text (numeric columns are loaded from csv)
+    """
+    return (random_int(seed, low * 100, high * 100) / 100).round(2).cast(pl.Utf8)
+
+
+def timestamps():
+    """
+    Returns the created_at and last_updated expressions: one row a second
+    from BASE_TIMESTAMP
+    """
+    created = pl.lit(BASE_TIMESTAMP) + pl.duration(seconds=pl.col("id"))
+    return [created.alias("created_at"), created.alias("last_updated")]
+
+
+def table_columns(table, sizes):
+    """
+    Returns the expressions generating the columns of a table (apart from its id),
+    with ids of referenced tables drawn within their sizes
+    """
+    def ref(seed, referenced):
+        return random_int(seed, 1, sizes[referenced])
+
+    columns = {
+        "currency": [
+            pl.col("id")
+            .replace_strict(dict(enumerate(CURRENCY_CODES, 1)), return_dtype=pl.Utf8)
+            .alias("currency_code"),
+        ],
+        "payment_type": [
+            pl.col("id")
+            .replace_strict(dict(enumerate(PAYMENT_TYPE_NAMES, 1)), return_dtype=pl.Utf8)
+            .alias("payment_type_name"),
+        ],
+        "department": [
+            pl.format("Department {}", "id").alias("department_name"),
+            pl.format("Location {}", "id").alias("location"),
+            pl.format("Manager {}", "id").alias("manager"),
+        ],
+        "address": [
+            pl.format("{} Herzog Via", "id").alias("address_line_1"),
+            pl.when(pl.col("id") % 2 == 0)
+            .then(pl.format("Flat {}", "id"))
+            .alias("address_line_2"),
+            pl.when(pl.col("id") % 3 == 0).then(pl.lit("Avon")).alias("district"),
+            pl.format("City {}", random_int(1, 1, 500)).alias("city"),
+            random_int(2, 10000, 99999).cast(pl.Utf8).alias("postal_code"),
+            pl.format("Country {}", random_int(3, 1, 100)).alias("country"),
+            pl.format("1803 {}", random_int(4, 100000, 999999)).alias("phone"),
+        ],
+        "staff": [
+            pl.format("First{}", "id").alias("first_name"),
+            pl.format("Last{}", "id").alias("last_name"),
+            ref(5, "department").alias("department_id"),
+            pl.format("staff{}@terrifictotes.com", "id").alias("email_address"),
+        ],
+        "counterparty": [
+            pl.format("Counterparty {} Ltd", "id").alias("counterparty_legal_name"),
+            ref(6, "address").alias("legal_address_id"),
+            pl.format("Contact {}", "id").alias("commercial_contact"),
+            pl.when(pl.col("id") % 4 != 0)
+            .then(pl.format("Delivery {}", "id"))
+            .alias("delivery_contact"),
+        ],
+        "design": [
+            pl.format("Design {}", "id").alias("design_name"),
+            pl.format("/usr/share/design{}", random_int(7, 1, 50)).alias("file_location"),
+            pl.format("design-{}.json", "id").alias("file_name"),
+        ],
+        "sales_order": [
+            ref(8, "design").alias("design_id"),
+            ref(9, "staff").alias("staff_id"),
+            ref(10, "counterparty").alias("counterparty_id"),
+            random_int(11, 1000, 100000).alias("units_sold"),
+            random_amount(12, 2, 4).alias("unit_price"),
+            ref(13, "currency").alias("currency_id"),
+            random_date(14).alias("agreed_delivery_date"),
+            random_date(15).alias("agreed_payment_date"),
+            ref(16, "address").alias("agreed_delivery_location_id"),
+        ],
+        "purchase_order": [
+            ref(17, "staff").alias("staff_id"),
+            ref(18, "counterparty").alias("counterparty_id"),
+            pl.format("ITEM{}", random_int(19, 1000, 9999)).alias("item_code"),
+            random_int(20, 1, 1000).alias("item_quantity"),
+            random_amount(21, 3, 1000).alias("item_unit_price"),
+            ref(22, "currency").alias("currency_id"),
+            random_date(23).alias("agreed_delivery_date"),
+            random_date(24).alias("agreed_payment_date"),
+            ref(25, "address").alias("agreed_delivery_location_id"),
+        ],
+        "transaction": [
+            pl.when(pl.col("id") % 3 == 0)
+            .then(pl.lit("PURCHASE"))
+            .otherwise(pl.lit("SALE"))
+            .alias("transaction_type"),
+            pl.when(pl.col("id") % 3 != 0)
+            .then(ref(26, "sales_order"))
+            .alias("sales_order_id"),
+            pl.when(pl.col("id") % 3 == 0)
+            .then(ref(27, "purchase_order"))
+            .alias("purchase_order_id"),
+        ],
+        "payment": [
+            ref(28, "transaction").alias("transaction_id"),
+            ref(29, "counterparty").alias("counterparty_id"),
+            random_amount(30, 1, 1000000).alias("payment_amount"),
+            ref(31, "currency").alias("currency_id"),
+            ref(32, "payment_type").alias("payment_type_id"),
+            (random_int(33, 0, 1) == 1).alias("paid"),
+            random_date(34).alias("payment_date"),
+            random_int(35, 10000000, 99999999).alias("company_ac_number"),
+            random_int(36, 10000000, 99999999).alias("counterparty_ac_number"),
+        ],
+    }
+    return columns[table]
+
+
+def generate_table(table, sizes, column_order):
+    """
+    Generates the rows of a table (sizes gives the number of rows of each
+    table), with its columns in column_order (as in the database)
+
+    Returns:
+        DataFrame of the table
+    """
+    df = pl.DataFrame({"id": pl.int_range(1, sizes[table] + 1, eager=True)})
+    df = df.with_columns(
+        pl.col("id").alias(f"{table}_id"), *table_columns(table, sizes), *timestamps()
+    )
+    return df.select(column_order)
+
+
+def schema_statements(schema_file=SCHEMA_FILE):
+    """
+    Returns the CREATE TABLE statements of the totesys schema
+    (the database and sample rows of the file are left out)
+    """
+    with open(schema_file) as f:
+        return re.findall(r"CREATE TABLE .*?\n\);", f.read(), re.DOTALL)
+
+
+def create_schema(conn, schema_file=SCHEMA_FILE):
+    """
+    Creates the totesys tables in the database of conn, dropping them first
+    """
+    for table in TABLES:
+        conn.run(f"DROP TABLE IF EXISTS {identifier(table)}")
+    for statement in schema_statements(schema_file):
+        conn.run(statement)
+
+
+def table_column_names(conn, table):
+    """
+    Returns the columns of a table, in their order in the database
+    """
+    rows = conn.run(
+        "SELECT column_name FROM information_schema.columns "
+        "WHERE table_name = :table ORDER BY ordinal_position",
+        table=table,
+    )
+    return [row[0] for row in rows]
+
+
+def populate(conn, scale):
+    """
+    Fills the totesys tables with the synthetic data of a scale factor:
+    each table is generated with Polars and streamed with COPY, then its
+    identity is moved past the generated ids so that inserts keep working.
+
+    Returns:
+        dict: number of rows of each table
+    """
+    sizes = table_sizes(scale)
+    for table in TABLES:
+        columns = table_column_names(conn, table)
+        df = generate_table(table, sizes, columns)
+        names = ", ".join(identifier(column) for column in columns)
+        conn.run(
+            f"COPY {identifier(table)} ({names}) FROM STDIN WITH (FORMAT csv)",
+            stream=dataframe_to_csv(df),
+        )
+        del df
+        conn.run(
+            f"SELECT setval(pg_get_serial_sequence(:table, :key), "
+            f"max({identifier(table + '_id')})) FROM {identifier(table)}",
+            table=table,
+            key=f"{table}_id",
+        )
+    return sizes
+
+
+def churn_band(table, low, high):
+    """
+    Returns the condition selecting the rows of a table whose id falls in
+    the band [low, high) of CHURN_BANDS: a pseudo-random, repeatable sample
+    """
+    band = f"({identifier(table + '_id')}::bigint * 7919) % {CHURN_BANDS}"
+    return f"{band} >= {low} AND {band} < {high}"
+
+
+def apply_churn(conn, table, rate, mix=CHURN_MIX):
+    """
+    Changes a share (rate) of the rows of a table, as a day of activity on
+    the source database would: most of them are updated (last_updated moves
+    on), some rows are inserted and a few are deleted (mix).
+    The samples are disjoint and the same for the same table and rate.
+
+    Returns:
+        dict: number of rows updated, inserted and deleted
+    """
+    columns = [
+        column for column in table_column_names(conn, table) if column != f"{table}_id"
+    ]
+    names = ", ".join(identifier(column) for column in columns)
+    values = ", ".join(
+        "current_timestamp" if column in ("created_at", "last_updated") else identifier(column)
+        for column in columns
+    )
+    statements = {
+        "update": f"UPDATE {identifier(table)} "
+        "SET last_updated = last_updated + interval '1 day' WHERE {band}",
+        "insert": f"INSERT INTO {identifier(table)} ({names}) "
+        f"SELECT {values} FROM {identifier(table)} WHERE {{band}}",
+        "delete": f"DELETE FROM {identifier(table)} WHERE {{band}}",
+    }
+    changed = {}
+    low = 0
+    for change, share in mix.items():
+        high = low + round(rate * share * CHURN_BANDS)
+        if high > low:
+            conn.run(statements[change].format(band=churn_band(table, low, high)))
+            changed[change] = conn.row_count
+        else:
+            changed[change] = 0
+        low = high
+    return changed
@@ -0,0 +1,376 @@
+"""
+Freshness simulator: how long does a change to the source database take to
+reach the warehouse?
+
+The synthetic totesys data of src.benchmark.dataset is loaded in the local
+benchmark database, then a stream of changes (inserted and updated sales
+orders, updated designs) is applied to it at a configurable rate, in
+transactions of batch-size changes. Each change is stamped with the simulated
+time it is committed at (its last_updated, and the name of the design).
+
+Every interval, the extract, transform and load lambda handlers run in-process,
+one after the other, against moto S3 / Secrets Manager and a local warehouse
+database (BENCH_PG_WAREHOUSE, default totesys_bench_dw). The simulated clock
+moves on by the wall time of the run, so the schedule is replayed faster than
+real time but the latencies include the real cost of the pipeline; a run that
+takes longer than the interval delays the next one, as the step function would.
+After each run, the warehouse is checked for the stamped changes: a change is
+fresh once its version (or a later one of the same row) is in the warehouse.
+
+The distribution of the change-to-warehouse latencies (p50/p95/p99) and the
+share of the changes within the 30 minute SLA are saved to
+benchmarks/freshness-<commit>.json:
+
+    ENV=testing PYTHONPATH=. python -m src.benchmark.freshness --interval 300 --rate 60
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+import boto3
+from moto import mock_aws
+from pg8000.native import identifier
+from src.benchmark.dataset import create_schema, populate, table_column_names
+from src.benchmark.pipeline import bench_credentials, connect, current_commit, RESULTS_PATH
+from src.lambda_functions.extract import lambda_handler as extract
+from src.lambda_functions.transform import lambda_handler as transform
+from src.lambda_functions.load import lambda_handler as load
+from src.utils.cache_utils import invalidate
+from src.utils.load_utils import WAREHOUSE_TABLES, LEDGER_TABLE
+
+SIM_EPOCH = datetime(2024, 1, 1)  # simulated time 0, after the generated rows
+SLA_SECONDS = 30 * 60
+DEFAULT_SCALE = 10000
+DEFAULT_INTERVAL = 300  # simulated seconds between two scheduled runs
+DEFAULT_DURATION = 3600  # simulated seconds of source activity
+DEFAULT_RATE = 60  # changes a minute
+DEFAULT_BATCH_SIZE = 10  # changes committed together
+MAX_DRAIN_RUNS = 3  # scheduled runs after the activity stops, to catch up
+WAREHOUSE_DATABASE = "totesys_bench_dw"
+WAREHOUSE_SCHEMA_FILE = "database/warehouse.sql"
+CHANGE_MIX = {"sales_order_update": 0.5, "sales_order_insert": 0.3, "design_update": 0.2}
+RAW_BUCKET = "totesys-raw-data-freshness"
+PROCESSED_BUCKET = "totesys-processed-data-freshness"
+
+
+def create_warehouse(conn, schema_file=WAREHOUSE_SCHEMA_FILE):
+    """
+    Creates the warehouse tables in the database of conn, dropping them first
+    """
+    for table in WAREHOUSE_TABLES + [LEDGER_TABLE]:
+        conn.run(f"DROP TABLE IF EXISTS {identifier(table)}")
+    with open(schema_file) as f:
+        for statement in f.read().split(";"):
+            if statement.strip():
+                conn.run(statement)
+
+
+def stamp(at):
+    """
+    Returns the timestamp of the simulated time at (seconds), to the millisecond
+    """
+    return SIM_EPOCH + timedelta(milliseconds=round(at * 1000))
+
+
+def latency_percentiles(latencies):
+    """
+    Returns the p50, p95, p99, mean and max of latencies (seconds),
+    or None values when there are none
+    """
+    if not latencies:
+        return dict.fromkeys(["p50", "p95", "p99", "mean", "max"])
+    if len(latencies) == 1:
+        cuts = latencies * 99
+    else:
+        cuts = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        "p50": round(cuts[49], 3),
+        "p95": round(cuts[94], 3),
+        "p99": round(cuts[98], 3),
+        "mean": round(statistics.fmean(latencies), 3),
+        "max": round(max(latencies), 3),
+    }
+
+
+class SourceChurn:
+    """
+    Applies stamped changes to the source database and keeps track of the
+    changes not yet seen in the warehouse.
+    """
+
+    def __init__(self, conn, sizes, seed=0, mix=CHANGE_MIX):
+        self.conn = conn
+        self.sizes = sizes
+        self.random = random.Random(seed)
+        self.kinds = list(mix)
+        self.weights = list(mix.values())
+        self.next_id = 1
+        self.pending = []
+        sales_order_columns = [
+            column for column in table_column_names(conn, "sales_order")
+            if column != "sales_order_id"
+        ]
+        self.insert_columns = ", ".join(identifier(c) for c in sales_order_columns)
+        self.insert_values = ", ".join(
+            ":stamp" if c in ("created_at", "last_updated") else identifier(c)
+            for c in sales_order_columns
+        )
+
+    def apply_batch(self, at, size):
+        """
+        Commits size changes in one transaction, stamped with the simulated time at
+        """
+        self.conn.run("START TRANSACTION")
+        for _ in range(size):
+            kind = self.random.choices(self.kinds, self.weights)[0]
+            change = {"id": self.next_id, "kind": kind, "at": at}
+            self.next_id += 1
+            if kind == "sales_order_update":
+                change["table"] = "sales_order"
+                change["key"] = self.random.randint(1, self.sizes["sales_order"])
+                self.conn.run(
+                    "UPDATE sales_order SET units_sold = units_sold + 1, "
+                    "last_updated = :stamp WHERE sales_order_id = :key",
+                    stamp=stamp(at), key=change["key"],
+                )
+            elif kind == "sales_order_insert":
+                change["table"] = "sales_order"
+                change["key"] = self.conn.run(
+                    f"INSERT INTO sales_order ({self.insert_columns}) "
+                    f"SELECT {self.insert_values} FROM sales_order "
+                    "WHERE sales_order_id = :source RETURNING sales_order_id",
+                    stamp=stamp(at),
+                    source=self.random.randint(1, self.sizes["sales_order"]),
+                )[0][0]
+            else:
+                change["table"] = "design"
+                change["key"] = self.random.randint(1, self.sizes["design"])
+                self.conn.run(
+                    "UPDATE design SET design_name = :name, last_updated = :stamp "
+                    "WHERE design_id = :key",
+                    name=f"Design #{change['id']}", stamp=stamp(at), key=change["key"],
+                )
+            self.pending.append(change)
+        self.conn.run("COMMIT")
+
+    def collect_visible(self, warehouse, visible_at):
+        """
+        Checks which pending changes are in the warehouse: a sales order change
+        once a fact row of the order is as recent as the change, a design change
+        once dim_design holds its name or the name of a later change.
+
+        Returns:
+            list: latencies (simulated seconds) of the changes found
+        """
+        orders = sorted({c["key"] for c in self.pending if c["table"] == "sales_order"})
+        designs = sorted({c["key"] for c in self.pending if c["table"] == "design"})
+        latest_order = dict(warehouse.run(
+            "SELECT sales_order_id, max(last_updated_date + last_updated_time) "
+            "FROM fact_sales_order WHERE sales_order_id = ANY(:keys) GROUP BY sales_order_id",
+            keys=orders,
+        )) if orders else {}
+        latest_design = {
+            design_id: int(name.rsplit("#", 1)[1])
+            for design_id, name in warehouse.run(
+                "SELECT design_id, design_name FROM dim_design WHERE design_id = ANY(:keys)",
+                keys=designs,
+            )
+            if "#" in name
+        } if designs else {}
+
+        latencies = []
+        still_pending = []
+        for change in self.pending:
+            if change["table"] == "sales_order":
+                seen = latest_order.get(change["key"])
+                fresh = seen is not None and seen >= stamp(change["at"])
+            else:
+                fresh = latest_design.get(change["key"], 0) >= change["id"]
+            if fresh:
+                latencies.append(visible_at - change["at"])
+            else:
+                still_pending.append(change)
+        self.pending = still_pending
+        return latencies
+
+
+def wait_for_next_second():
+    """
+    Waits for the wall clock to reach the next second: runs are saved under
+    the second they start at, so two runs can't start within the same second
+    """
+    now = time.time()
+    time.sleep(1 - (now - int(now)) + 0.001)
+
+
+def run_pipeline():
+    """
+    Runs the extract, transform and load handlers in-process, one after the other
+
+    Returns:
+        dict: wall time of each handler (seconds)
+    """
+    timings = {}
+    start = time.perf_counter()
+    extracted = extract({}, None)
+    timings["extract"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    transformed = transform(extracted, None)
+    timings["transform"] = time.perf_counter() - start
+    if not isinstance(transformed, dict):
+        raise Exception(f"Transform failed: {transformed}")
+
+    start = time.perf_counter()
+    loaded = load(transformed, None)
+    timings["load"] = time.perf_counter() - start
+    if not isinstance(loaded, dict):
+        raise Exception(f"Load failed: {loaded}")
+    return timings
+
+
+def mock_environment(source, warehouse):
+    """
+    Creates the buckets and the database secrets the handlers look for in moto
+    """
+    s3_client = boto3.client("s3", region_name="eu-west-2")
+    for bucket in [RAW_BUCKET, PROCESSED_BUCKET]:
+        s3_client.create_bucket(
+            Bucket=bucket, CreateBucketConfiguration={"LocationConstraint": "eu-west-2"}
+        )
+    secrets = boto3.client("secretsmanager", region_name="eu-west-2")
+    for name, credentials in [
+        ("totesys-credentials-freshness", source),
+        ("totesys-data-warehouse-credentials-freshness", warehouse),
+    ]:
+        secrets.create_secret(Name=name, SecretString=json.dumps(credentials))
+
+
+def simulate(
+    scale=DEFAULT_SCALE,
+    interval=DEFAULT_INTERVAL,
+    duration=DEFAULT_DURATION,
+    rate=DEFAULT_RATE,
+    batch_size=DEFAULT_BATCH_SIZE,
+    seed=0,
+):
+    """
+    Runs the freshness simulation (see the module docstring)
+
+    Returns:
+        dict: report of the simulation (settings, runs and latency distribution)
+    """
+    source_credentials = bench_credentials()
+    warehouse_credentials = dict(
+        source_credentials,
+        database=os.getenv("BENCH_PG_WAREHOUSE", WAREHOUSE_DATABASE),
+    )
+    source = connect(source_credentials)
+    warehouse = connect(warehouse_credentials)
+    runs = []
+    latencies = []
+    changes = 0
+    try:
+        create_schema(source)
+        sizes = populate(source, scale)
+        create_warehouse(warehouse)
+        churn = SourceChurn(source, sizes, seed)
+        batch_every = 60 * batch_size / rate  # simulated seconds between batches
+
+        with mock_aws():
+            invalidate()
+            try:
+                mock_environment(source_credentials, warehouse_credentials)
+                # the initial load of the whole database isn't measured
+                run_pipeline()
+
+                run_at = interval
+                next_batch = batch_every
+                drain_runs = 0
+                while True:
+                    while next_batch <= run_at and next_batch <= duration:
+                        churn.apply_batch(next_batch, batch_size)
+                        changes += batch_size
+                        next_batch += batch_every
+                    wait_for_next_second()
+                    timings = run_pipeline()
+                    finished_at = run_at + sum(timings.values())
+                    found = churn.collect_visible(warehouse, finished_at)
+                    latencies.extend(found)
+                    runs.append({
+                        "started_at": round(run_at, 3),
+                        "seconds": {step: round(s, 3) for step, s in timings.items()},
+                        "fresh_changes": len(found),
+                        "pending_changes": len(churn.pending),
+                    })
+                    if run_at >= duration:
+                        drain_runs += 1
+                        if not churn.pending or drain_runs >= MAX_DRAIN_RUNS:
+                            break
+                    # the next run starts on schedule, or when this one ends if it overran
+                    run_at = max(run_at + interval, finished_at)
+            finally:
+                invalidate()
+    finally:
+        source.close()
+        warehouse.close()
+
+    within_sla = sum(1 for latency in latencies if latency <= SLA_SECONDS)
+    return {
+        "commit": current_commit(),
+        "scale": scale,
+        "interval": interval,
+        "duration": duration,
+        "rate": rate,
+        "batch_size": batch_size,
+        "changes": changes,
+        "fresh_changes": len(latencies),
+        "latency": latency_percentiles(latencies),
+        "sla_seconds": SLA_SECONDS,
+        "within_sla": round(within_sla / changes, 4) if changes else None,
+        "runs": runs,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Measure how long source changes take to reach the warehouse"
+    )
+    parser.add_argument("--scale", type=int, default=DEFAULT_SCALE)
+    parser.add_argument("--interval", type=float, default=DEFAULT_INTERVAL,
+                        help="seconds between scheduled pipeline runs")
+    parser.add_argument("--duration", type=float, default=DEFAULT_DURATION,
+                        help="seconds of source activity simulated")
+    parser.add_argument("--rate", type=float, default=DEFAULT_RATE,
+                        help="source changes a minute")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help="changes committed together")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=RESULTS_PATH)
+    args = parser.parse_args(argv)
+
+    report = simulate(
+        args.scale, args.interval, args.duration, args.rate, args.batch_size, args.seed
+    )
+    os.makedirs(args.output, exist_ok=True)
+    filename = os.path.join(args.output, f"freshness-{report['commit']}.json")
+    with open(filename, "w") as f:
+        json.dump(report, f, indent=2)
+
+    latency = report["latency"]
+    print(f"Saved {filename}")
+    print(
+        f"{report['fresh_changes']}/{report['changes']} changes in the warehouse, "
+        f"{report['within_sla']:.1%} within {SLA_SECONDS // 60} minutes"
+        if report["changes"] else "No changes simulated"
+    )
+    print(f"latency p50 {latency['p50']} s, p95 {latency['p95']} s, p99 {latency['p99']} s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,135 @@
+"""
+Import-time report of the lambda handlers: how long a cold container spends
+importing each handler module before the first invocation can start.
+
+Each handler is imported REPEAT times in a fresh interpreter with
+python -X importtime, and the median of its cumulative import time is
+reported, with the number of modules it loads and the cumulative time of
+the heavy dependencies (HEAVY_PACKAGES) it imports. The report is saved to
+benchmarks/import_times.json, which is checked in: a change making a cold
+start slower shows up in its diff.
+
+    PYTHONPATH=. python -m src.benchmark.imports
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from src.benchmark.pipeline import RESULTS_PATH
+
+HANDLERS = [
+    "src.lambda_functions.extract",
+    "src.lambda_functions.transform",
+    "src.lambda_functions.load",
+]
+HEAVY_PACKAGES = ["boto3", "pg8000", "polars", "zstandard"]
+REPEAT = 5
+REPORT_FILE = "import_times.json"
+US = 1000  # -X importtime reports microseconds
+
+
+def parse_importtime(output):
+    """
+    Parses the stderr of python -X importtime
+
+    Returns:
+        list: (module, self time, cumulative time, depth) of each imported
+        module, in the order the imports completed
+    """
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_time, cumulative, name = line[len("import time:"):].split("|")
+        if not self_time.strip().isdigit():
+            continue  # header line
+        depth = (len(name) - len(name.lstrip())) // 2
+        imports.append((name.strip(), int(self_time), int(cumulative), depth))
+    return imports
+
+
+def import_times(module):
+    """
+    Imports module in a fresh interpreter with -X importtime
+
+    Returns:
+        list: parsed import times (see parse_importtime)
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, check=True,
+        env={**os.environ, "PYTHONPATH": os.getcwd()},
+    )
+    return parse_importtime(result.stderr)
+
+
+def handler_imports(imports, module):
+    """
+    Returns the import times of module and of the modules it imported (listed
+    before it, nested under it), leaving out the interpreter start-up
+    """
+    end = next(i for i, (name, _, _, _) in enumerate(imports) if name == module)
+    start = end
+    while start > 0 and imports[start - 1][3] > 0:
+        start -= 1
+    return imports[start:end + 1]
+
+
+def handler_report(module, repeat=REPEAT):
+    """
+    Returns the median import time of a handler module (milliseconds), the
+    number of modules it loads and the median import time of the heavy
+    packages among them
+    """
+    totals = []
+    packages = {}
+    for _ in range(repeat):
+        imports = handler_imports(import_times(module), module)
+        totals.append(imports[-1][2])
+        for name, _, cumulative, _ in imports:
+            if name in HEAVY_PACKAGES:
+                packages.setdefault(name, []).append(cumulative)
+    return {
+        "module": module,
+        "import_ms": round(statistics.median(totals) / US, 1),
+        "modules": len(imports),
+        "packages_ms": {
+            name: round(statistics.median(times) / US, 1) for name, times in packages.items()
+        },
+    }
+
+
+def run_report(handlers=HANDLERS, repeat=REPEAT):
+    """
+    Returns the import-time report of the handlers
+    """
+    return {
+        "python": sys.version.split()[0],
+        "repeat": repeat,
+        "handlers": [handler_report(module, repeat) for module in handlers],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Report the import time of the lambda handlers")
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument("--output", default=RESULTS_PATH)
+    args = parser.parse_args(argv)
+
+    report = run_report(repeat=args.repeat)
+    os.makedirs(args.output, exist_ok=True)
+    filename = os.path.join(args.output, REPORT_FILE)
+    with open(filename, "w") as f:
+        json.dump(report, f, indent=2)
+        f.write("\n")
+    print(f"Saved {filename}")
+    for handler in report["handlers"]:
+        packages = ", ".join(f"{name} {ms} ms" for name, ms in handler["packages_ms"].items())
+        print(f"{handler['module']:<32} {handler['import_ms']:>8.1f} ms  ({packages})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,79 @@
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+RSS_SAMPLE_INTERVAL = 0.005  # seconds
+MB = 1024 * 1024
+
+
+def current_rss():
+    """
+    Returns the resident set size of the process in bytes (from /proc on Linux,
+    as on Lambda), or its peak so far where /proc is not available
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class RssSampler:
+    """
+    Samples the resident set size of the process every RSS_SAMPLE_INTERVAL seconds
+    in a background thread, so that the peak of each stage can be measured
+    (the peak kept by the OS only ever grows over the life of the process).
+    """
+
+    def __init__(self, interval=RSS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.peak = current_rss()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+@contextmanager
+def measure(stage, table, results):
+    """
+    Times a stage of the pipeline run on a table and records its wall time and
+    peak RSS in a result appended to results. The block sets the rows and bytes
+    processed on the yielded result (they can also be set once the stage is
+    timed, e.g. when counting them would slow the stage down).
+    """
+    result = {"stage": stage, "table": table, "rows": 0, "bytes": 0}
+    with RssSampler() as sampler:
+        start = time.perf_counter()
+        yield result
+        seconds = time.perf_counter() - start
+    result["seconds"] = round(seconds, 6)
+    result["peak_rss_mb"] = round(sampler.peak / MB, 1)
+    results.append(result)
+
+
+def add_throughput(results):
+    """
+    Works out the rows/s and MB/s of each result from its rows, bytes and wall time
+    """
+    for result in results:
+        seconds = result["seconds"]
+        result["rows_per_s"] = round(result["rows"] / seconds, 1) if seconds else None
+        result["mb_per_s"] = round(result["bytes"] / MB / seconds, 3) if seconds else None
+    return results
@@ -0,0 +1,359 @@
+"""
+Benchmark of the extract and transform stages on synthetic totesys data.
+
+For each scale factor (rows of sales_order, transaction and payment), the
+totesys tables are generated in a local Postgres database (BENCH_PG_DATABASE,
+default totesys_bench, created with the PG_* credentials of .env.$ENV), then
+for each table:
+- query_db reads the snapshot of the table
+- create_and_upload_csv uploads it, as a first extract run does, to a moto bucket
+- churn (CHURN_MIX) is applied to the table and it is read again
+- compare_csvs diffs the two snapshots, with each backend
+- transform_table converts the differences file of the first extract run
+  to parquet and writes it to the processed bucket, as the transform handler does
+- load_table loads the facts built from the sales_order differences into
+  fact_sales_order (warehouse tables created in the benchmark database), whose
+  rows/s are checked against LOAD_TARGET_ROWS_PER_S
+
+The rows, bytes, wall time, rows/s, MB/s and peak RSS of each stage and table
+are saved to benchmarks/<commit>-<scale>.json, and two result files can be
+compared to find regressions between commits:
+
+    ENV=testing PYTHONPATH=. python -m src.benchmark.pipeline run --scale 1000 100000
+    PYTHONPATH=. python -m src.benchmark.pipeline compare old.json new.json
+"""
+import argparse
+import csv
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+import boto3
+from dotenv import load_dotenv, find_dotenv
+from moto import mock_aws
+from pg8000.native import Connection, identifier
+from src.benchmark.dataset import (
+    TABLES,
+    create_schema,
+    schema_statements,
+    populate,
+    apply_churn,
+)
+from src.benchmark.measure import measure, add_throughput
+from src.utils.cache_utils import invalidate
+from src.lambda_functions.transform import transform_table
+from src.utils.extract_utils import (
+    query_db,
+    create_and_upload_csv,
+    compare_csvs,
+)
+from src.utils.load_utils import load_table, WAREHOUSE_TABLES, LEDGER_TABLE
+from src.utils.transform_utils import (
+    read_raw_file,
+    build_fact_sales_order,
+    HISTORY_PATH,
+    DIFFERENCES_FILE_SUFFIX,
+)
+
+SCALES = [1000, 10000, 100000, 1000000, 10000000]
+DEFAULT_SCALES = [1000, 10000]
+DEFAULT_CHURN = 0.01
+COMPARE_BACKENDS = ["python", "polars"]
+RESULTS_PATH = "benchmarks/"
+BENCH_DATABASE = "totesys_bench"
+RAW_BUCKET = "totesys-raw-data-benchmark"
+PROCESSED_BUCKET = "totesys-processed-data-benchmark"
+TIME_PATH = "2022/11/03/14:20:49/"
+REGRESSION_THRESHOLD = 0.2  # slowdown of a stage reported as a regression
+WAREHOUSE_SCHEMA_FILE = "database/warehouse.sql"
+LOAD_TARGET_ROWS_PER_S = 100_000
+
+
+def bench_credentials():
+    """
+    Returns the credentials of the local benchmark database: the PG_* variables
+    of .env.$ENV, with the database BENCH_PG_DATABASE (default totesys_bench)
+    """
+    env_file = find_dotenv(f'.env.{os.getenv("ENV")}')
+    if env_file != "":
+        load_dotenv(env_file)
+    return {
+        "user": os.getenv("PG_USER"),
+        "password": os.getenv("PG_PASSWORD"),
+        "host": os.getenv("PG_HOST"),
+        "database": os.getenv("BENCH_PG_DATABASE", BENCH_DATABASE),
+        "port": int(os.getenv("PG_PORT", 5432)),
+    }
+
+
+def connect(credentials):
+    """
+    Connects to the benchmark database, creating it first if it doesn't exist
+    (through the PG_DATABASE database), so that the tables of the test database
+    are left alone.
+    """
+    server = Connection(
+        user=credentials["user"],
+        password=credentials["password"],
+        host=credentials["host"],
+        database=os.getenv("PG_DATABASE"),
+        port=credentials["port"],
+    )
+    try:
+        exists = server.run(
+            "SELECT 1 FROM pg_database WHERE datname = :name",
+            name=credentials["database"],
+        )
+        if not exists:
+            server.run(f"CREATE DATABASE {identifier(credentials['database'])}")
+    finally:
+        server.close()
+    return Connection(**credentials)
+
+
+def create_warehouse(conn, schema_file=WAREHOUSE_SCHEMA_FILE):
+    """
+    Creates the warehouse tables in the benchmark database, dropping them first
+    """
+    for table in WAREHOUSE_TABLES + [LEDGER_TABLE]:
+        conn.run(f"DROP TABLE IF EXISTS {identifier(table)}")
+    for statement in schema_statements(schema_file):
+        conn.run(statement)
+
+
+def current_commit():
+    """
+    Returns the commit of the working tree benchmarked, or "unknown" outside git
+    """
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def csv_size(rows):
+    """
+    Returns the size in bytes of rows (list of lists) encoded as csv
+    """
+    class Counter:
+        size = 0
+
+        def write(self, line):
+            self.size += len(line.encode("utf-8"))
+
+    counter = Counter()
+    csv.writer(counter).writerows(rows)
+    return counter.size
+
+
+def remove_tmp_files(table):
+    """
+    Removes the csv files of a table left in /tmp by the extract functions
+    """
+    for name in [table, f"{table}_new", f"{table}_differences"]:
+        if os.path.exists(f"/tmp/{name}.csv"):
+            os.remove(f"/tmp/{name}.csv")
+
+
+def benchmark_table(conn, s3_client, table, churn, backends, results):
+    """
+    Runs the stages of the pipeline on a table (see the module docstring),
+    appending their measurements to results.
+
+    Returns:
+        dict: rows updated, inserted and deleted by the churn
+    """
+    with measure("query_db", table, results) as queried:
+        data = query_db(table, conn)
+        queried["rows"] = len(data) - 1
+    size = csv_size(data)
+    queried["bytes"] = size
+
+    with measure("create_and_upload_csv", table, results) as uploaded:
+        create_and_upload_csv(data, s3_client, RAW_BUCKET, table, TIME_PATH, True)
+        uploaded["rows"], uploaded["bytes"] = len(data) - 1, size
+
+    create_and_upload_csv(data, s3_client, RAW_BUCKET, table, TIME_PATH, False)
+    os.replace(f"/tmp/{table}_new.csv", f"/tmp/{table}.csv")
+    del data
+    churned = apply_churn(conn, table, churn)
+    data = query_db(table, conn)
+    create_and_upload_csv(data, s3_client, RAW_BUCKET, table, TIME_PATH, False)
+    rows = queried["rows"] + len(data) - 1
+    del data
+
+    compared_bytes = os.path.getsize(f"/tmp/{table}.csv") + os.path.getsize(
+        f"/tmp/{table}_new.csv"
+    )
+    for backend in backends:
+        with measure(f"compare_csvs[{backend}]", table, results) as compared:
+            compare_csvs(table, backend=backend)
+            compared["rows"], compared["bytes"] = rows, compared_bytes
+
+    with measure("transform_table", table, results) as transformed:
+        transform_table(table, TIME_PATH, s3_client, RAW_BUCKET, PROCESSED_BUCKET)
+        transformed["rows"], transformed["bytes"] = queried["rows"], size
+
+    if table == "sales_order":
+        differences = read_raw_file(
+            f"{HISTORY_PATH}{TIME_PATH}{table}{DIFFERENCES_FILE_SUFFIX}", s3_client, RAW_BUCKET
+        )
+        facts = build_fact_sales_order(differences.lazy()).collect()
+        with measure("load_table", "fact_sales_order", results) as loaded:
+            conn.run("START TRANSACTION")
+            load_table(conn, "fact_sales_order", facts)
+            conn.run("COMMIT")
+            loaded["rows"], loaded["bytes"] = facts.height, facts.estimated_size()
+
+    remove_tmp_files(table)
+    return churned
+
+
+def run_benchmark(scale, churn=DEFAULT_CHURN, tables=TABLES, backends=COMPARE_BACKENDS):
+    """
+    Generates the totesys data of a scale factor in the benchmark database and
+    benchmarks the pipeline stages on each table against moto S3.
+
+    Returns:
+        dict: report of the run (environment, table sizes, churn and results)
+    """
+    conn = connect(bench_credentials())
+    try:
+        create_schema(conn)
+        create_warehouse(conn)
+        start = time.perf_counter()
+        sizes = populate(conn, scale)
+        populate_seconds = time.perf_counter() - start
+
+        results = []
+        churned = {}
+        with mock_aws():
+            invalidate()
+            s3_client = boto3.client("s3", region_name="eu-west-2")
+            for bucket in [RAW_BUCKET, PROCESSED_BUCKET]:
+                s3_client.create_bucket(
+                    Bucket=bucket,
+                    CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+                )
+            try:
+                for table in tables:
+                    churned[table] = benchmark_table(
+                        conn, s3_client, table, churn, backends, results
+                    )
+            finally:
+                invalidate()
+    finally:
+        conn.close()
+
+    return {
+        "commit": current_commit(),
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "scale": scale,
+        "churn": churn,
+        "sizes": sizes,
+        "populate_seconds": round(populate_seconds, 3),
+        "churned": churned,
+        "results": add_throughput(results),
+    }
+
+
+def save_report(report, path=RESULTS_PATH):
+    """
+    Saves a benchmark report as <path><commit>-<scale>.json
+
+    Returns:
+        string: name of the file
+    """
+    os.makedirs(path, exist_ok=True)
+    filename = os.path.join(path, f"{report['commit']}-{report['scale']}.json")
+    with open(filename, "w") as f:
+        json.dump(report, f, indent=2)
+    return filename
+
+
+def below_load_target(report, target=LOAD_TARGET_ROWS_PER_S):
+    """
+    Returns the load_table results of a report slower than target rows/s
+    """
+    return [
+        r for r in report["results"]
+        if r["stage"] == "load_table" and (r["rows_per_s"] or 0) < target
+    ]
+
+
+def compare_reports(old, new, threshold=REGRESSION_THRESHOLD):
+    """
+    Compares the wall time of each stage and table of two benchmark reports
+
+    Returns:
+        list: (stage, table, old seconds, new seconds, ratio) of the stages more
+        than threshold slower in new
+    """
+    old_results = {(r["stage"], r["table"]): r for r in old["results"]}
+    regressions = []
+    for result in new["results"]:
+        previous = old_results.get((result["stage"], result["table"]))
+        if previous is None or not previous["seconds"]:
+            continue
+        ratio = result["seconds"] / previous["seconds"]
+        if ratio > 1 + threshold:
+            regressions.append(
+                (result["stage"], result["table"], previous["seconds"], result["seconds"], ratio)
+            )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the totesys pipeline stages")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("run", help="benchmark the stages at scale factors")
+    run.add_argument("--scale", type=int, nargs="+", default=DEFAULT_SCALES,
+                     help=f"rows of sales_order/transaction/payment (e.g. {SCALES})")
+    run.add_argument("--churn", type=float, default=DEFAULT_CHURN,
+                     help="share of the rows changed between the two snapshots")
+    run.add_argument("--tables", nargs="+", default=TABLES, choices=TABLES)
+    run.add_argument("--backends", nargs="+", default=COMPARE_BACKENDS,
+                     choices=COMPARE_BACKENDS, help="compare_csvs backends")
+    run.add_argument("--output", default=RESULTS_PATH)
+    compare = commands.add_parser("compare", help="find regressions between two reports")
+    compare.add_argument("old")
+    compare.add_argument("new")
+    compare.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        for scale in args.scale:
+            report = run_benchmark(scale, args.churn, args.tables, args.backends)
+            print(f"Saved {save_report(report, args.output)}")
+            for r in report["results"]:
+                print(
+                    f"{r['stage']:<28} {r['table']:<16} {r['rows']:>10} rows "
+                    f"{r['seconds']:>10.3f} s {r['rows_per_s'] or 0:>12.0f} rows/s "
+                    f"{r['mb_per_s'] or 0:>8.2f} MB/s {r['peak_rss_mb']:>8.1f} MB"
+                )
+            for r in below_load_target(report):
+                print(
+                    f"{r['table']} loaded at {r['rows_per_s'] or 0:.0f} rows/s, "
+                    f"below the target of {LOAD_TARGET_ROWS_PER_S} rows/s"
+                )
+        return 0
+
+    with open(args.old) as f_old, open(args.new) as f_new:
+        regressions = compare_reports(json.load(f_old), json.load(f_new), args.threshold)
+    for stage, table, old_seconds, new_seconds, ratio in regressions:
+        print(f"{stage:<28} {table:<16} {old_seconds:.3f} s -> {new_seconds:.3f} s (x{ratio:.2f})")
+    if not regressions:
+        print("No regressions")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
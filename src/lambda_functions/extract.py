@@ -1,9 +1,51 @@
-import boto3
 import logging
 import os
-from datetime import datetime as dt
-from pg8000.native import Connection, Error
-from src.utils.extract_utils import *
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+from pg8000.native import Error
+from src.utils.extract_utils import (
+    get_secret,
+    connect_to_bucket,
+    create_time_based_path,
+    get_connection_pool,
+    get_watermark_file,
+    save_watermark,
+    probe_table,
+    query_parquet_schema,
+    read_typed_csv,
+    copy_and_upload_csv,
+    stream_query_db,
+    stream_and_upload_csv,
+    query_db,
+    create_and_upload_csv,
+    find_watermark,
+    dataframe_from_rows,
+    concat_frames,
+    upload_parquets,
+    with_change_type,
+    get_fingerprint_index,
+    compare_with_index,
+    write_fingerprint_index,
+    compare_csvs,
+    merge_csvs,
+    read_csv_rows,
+    EXTRACT_MODES,
+    WATERMARK_COLUMN,
+    PROBE_KEY,
+    FINGERPRINT_INDEX_EXTENSION,
+    PARQUET_EXTENSION,
+)
+from src.utils.cache_utils import invalidate_on_error
+from src.utils.metrics_utils import start_metrics, flush_metrics, run_for_table, timed, count
+from src.utils.s3_utils import (
+    get_s3_client,
+    upload_files,
+    delete_objects,
+    download_files_decompressed,
+    compress_file,
+    compression_suffix,
+    READ_SUFFIXES,
+)
 
 """
 RAW DATA BUCKET STRUCTURE:
@@ -19,6 +61,8 @@ source/
 ├─ sales_order_new.csv
 ├─ staff_new.csv
 ├─ transaction_new.csv
+├─ *_new.idx (fingerprint index of each snapshot)
+├─ *_new.parquet (when EXTRACT_PARQUET is "true")
 history/
 ├─ year/
 │  ├─ month/
@@ -35,6 +79,11 @@ history/
 │  │  │  │  ├─ sales_order_differences.csv
 │  │  │  │  ├─ staff_differences.csv
 │  │  │  │  ├─ transaction_differences.csv
+│  │  │  │  ├─ *_differences.parquet (when EXTRACT_PARQUET is "true")
+watermark/
+├─ address.json
+├─ ...
+├─ transaction.json
 """
 
 logger = logging.getLogger(__name__)
@@ -43,6 +92,7 @@ logger.setLevel(logging.INFO)
 SOURCE_PATH = "/source/"
 SOURCE_FILE_SUFFIX = "_new"
 HISTORY_PATH = "/history/"
+DIFFERENCES_FILE_SUFFIX = "_differences"
 DATA_TABLES = [
     "sales_order",
     "design",
@@ -56,6 +106,206 @@ DATA_TABLES = [
     "payment",
     "transaction",
 ]
+DEFAULT_CONCURRENCY = 4
+
+
+def extract_table(
+    data_table_name, pool, s3_client, raw_data_bucket, time_path,
+    first_call_bool, full_snapshot=False, mode="query", diff_backend="python",
+    probe_hash=False, emit_parquet=False, compression=None
+):
+    """
+    Extracts a single data table, using a connection borrowed from the pool:
+    queries the table (or only the rows after its watermark), saves its
+    differences to /history/time_path and updates /source and /watermark.
+    A table whose change probe is the same as on the last run is skipped.
+    With emit_parquet, typed Parquet copies of the snapshot and differences are saved too.
+    With compression ("gzip" or "zstd"), the csv files are saved compressed.
+    Returns False if the table was skipped, True otherwise.
+    """
+    watermark_file = None
+    if not first_call_bool:
+        with timed("download"):
+            watermark_file = get_watermark_file(s3_client, raw_data_bucket, data_table_name)
+    watermark = None
+    if watermark_file is not None and not full_snapshot:
+        watermark = watermark_file[WATERMARK_COLUMN]
+
+    with pool.connection() as conn:
+        # probing before the extract, a change made in between is picked up by the next run
+        with timed("probe"):
+            probe = probe_table(data_table_name, conn, probe_hash)
+        previous_probe = None if watermark_file is None else watermark_file.get(PROBE_KEY)
+        if not full_snapshot and previous_probe == probe:
+            logging.info(f"No changes in {data_table_name} since the last run")
+            return False
+        if (
+            previous_probe is not None
+            and previous_probe["max_last_updated"] == probe["max_last_updated"]
+        ):
+            # a delete or an update leaving last_updated untouched: the incremental
+            # query can't see it, the full table is compared with the previous one
+            logging.info(f"{data_table_name} changed without a newer last_updated")
+            watermark = None
+
+        if emit_parquet:
+            schema = query_parquet_schema(data_table_name, conn)
+
+        # streamed tables are queried, encoded and saved at the same time;
+        # the first snapshot's parquet is built from the same rows on the way
+        keep_snapshot = first_call_bool and emit_parquet
+        if mode == "copy":
+            with timed("query"):
+                row_count, new_watermark = copy_and_upload_csv(
+                    data_table_name, conn, s3_client, raw_data_bucket,
+                    time_path, first_call_bool, watermark, compression, keep_snapshot
+                )
+        elif mode == "stream":
+            frames = []
+
+            def keep_batch(batch):
+                frames.append(dataframe_from_rows([header] + batch, schema))
+
+            with timed("query"):
+                header, batches = stream_query_db(data_table_name, conn, watermark)
+                with closing(batches):
+                    row_count, new_watermark = stream_and_upload_csv(
+                        header, batches, s3_client, raw_data_bucket,
+                        data_table_name, time_path, first_call_bool, compression,
+                        keep_batch if keep_snapshot else None,
+                    )
+        else:
+            with timed("query"):
+                file_data = query_db(data_table_name, conn, watermark)
+            with timed("upload" if first_call_bool else "encode"):
+                create_and_upload_csv(
+                    file_data, s3_client, raw_data_bucket, 
+                    data_table_name, time_path, first_call_bool, compression
+                )
+            row_count = len(file_data) - 1
+            new_watermark = find_watermark(file_data)
+    count("rows", row_count)
+
+    source_key = f"{SOURCE_PATH}{data_table_name}{SOURCE_FILE_SUFFIX}"
+    history_key = f"{HISTORY_PATH}{time_path}{data_table_name}{DIFFERENCES_FILE_SUFFIX}"
+    index_key = f"{source_key}{FINGERPRINT_INDEX_EXTENSION}"
+    suffix = compression_suffix(compression)
+    # copies of the snapshot saved with another compression are stale once it is replaced
+    stale_keys = [
+        f"{source_key}.csv{read_suffix}" for read_suffix in READ_SUFFIXES
+        if read_suffix != suffix
+    ]
+    if not emit_parquet:
+        # a typed snapshot left by a run with EXTRACT_PARQUET would be read instead of the csv
+        stale_keys.append(f"{source_key}{PARQUET_EXTENSION}")
+    if first_call_bool:
+        # the snapshot was replaced, so an index left by a previous bucket content is stale
+        delete_objects(s3_client, raw_data_bucket, [index_key] + stale_keys)
+        count("changed_rows", row_count)
+
+        if emit_parquet:
+            if mode == "query":
+                snapshot = dataframe_from_rows(file_data, schema)
+            elif mode == "stream":
+                snapshot = concat_frames(frames, schema)
+            else:
+                snapshot = read_typed_csv(f"/tmp/{data_table_name}_new.csv", schema)
+                os.remove(f"/tmp/{data_table_name}_new.csv")
+            with timed("parquet_write"):
+                upload_parquets({
+                    f"{source_key}{PARQUET_EXTENSION}": snapshot,
+                    f"{history_key}{PARQUET_EXTENSION}": with_change_type(snapshot, "insert"),
+                }, s3_client, raw_data_bucket)
+    else:
+        # an incremental query with no rows leaves /source untouched
+        fetched = watermark is None or row_count > 0
+
+        def download_previous():
+            # save a copy of _new from /source to /tmp, where it can be manipulated by the lambda function
+            # (whatever the compression it was saved with, this run's first)
+            download_files_decompressed(
+                s3_client, raw_data_bucket,
+                {f"{source_key}.csv": f"/tmp/{data_table_name}.csv"},
+                compression=compression,
+            )
+
+        with timed("download"):
+            prev_index = None
+            if watermark is None:
+                prev_index = get_fingerprint_index(s3_client, raw_data_bucket, data_table_name)
+
+            if fetched and prev_index is None:
+                download_previous()
+
+        with timed("diff"):
+            if prev_index is not None:
+                # deleted rows are copied from the previous snapshot, only downloaded then
+                changes_csv = compare_with_index(data_table_name, prev_index, download_previous)
+            elif watermark is None:
+                changes_csv = compare_csvs(data_table_name, diff_backend)
+            else:
+                changes_csv = merge_csvs(data_table_name)
+        changes = sum(1 for _ in read_csv_rows(f"/tmp/{changes_csv}")) - 1
+        count("changed_rows", changes)
+        # the rows read again by the watermark lookback may all be unchanged
+        changed = watermark is None or changes > 0
+
+        # the _differences file is saved to history, and the files of /source
+        # are replaced, all at once
+        uploads = {
+            f"{HISTORY_PATH}{time_path}{changes_csv}{suffix}":
+                compress_file(f"/tmp/{changes_csv}", compression)
+        }
+        parquets = {}
+        if emit_parquet:
+            parquets[f"{history_key}{PARQUET_EXTENSION}"] = read_typed_csv(
+                f"/tmp/{changes_csv}", schema
+            )
+
+        index_file = None
+        if changed:
+            # replace /source/*_new with /tmp/*_new
+            uploads[f"{source_key}.csv{suffix}"] = compress_file(
+                f"/tmp/{data_table_name}_new.csv", compression
+            )
+            if emit_parquet:
+                parquets[f"{source_key}{PARQUET_EXTENSION}"] = read_typed_csv(
+                    f"/tmp/{data_table_name}_new.csv", schema
+                )
+            # and its fingerprint index, used by the next comparison
+            index_file = f"{data_table_name}_new{FINGERPRINT_INDEX_EXTENSION}"
+            if prev_index is None:
+                index_file = write_fingerprint_index(data_table_name)
+            if index_file is not None:
+                uploads[index_key] = f"/tmp/{index_file}"
+            else:
+                stale_keys.append(index_key)
+
+        with timed("upload"):
+            upload_files(s3_client, raw_data_bucket, uploads)
+            if changed:
+                delete_objects(s3_client, raw_data_bucket, stale_keys)
+        if parquets:
+            with timed("parquet_write"):
+                upload_parquets(parquets, s3_client, raw_data_bucket)
+
+        # removing the temporary files
+        if suffix:
+            for filename in uploads.values():
+                if filename.endswith(suffix):
+                    os.remove(filename)
+        if index_file is not None:
+            os.remove(f"/tmp/{index_file}")
+        if os.path.exists(f"/tmp/{data_table_name}.csv"):
+            os.remove(f"/tmp/{data_table_name}.csv")
+        os.remove(f"/tmp/{data_table_name}_new.csv")
+
+    # the rows read again by the lookback can be older than the watermark
+    if new_watermark is None or (watermark is not None and new_watermark < watermark):
+        new_watermark = watermark
+    with timed("upload"):
+        save_watermark(s3_client, raw_data_bucket, data_table_name, new_watermark, probe)
+    return True
 
 
 def lambda_handler(event, context):
@@ -70,69 +320,136 @@ def lambda_handler(event, context):
     the current date and time (year/month/day/hh:mm:ss).
     Finally, the existing CSV files in the /source/ directory,
     which hold the complete data tables, are updated with the latest content.
+
+    After the first run, only the rows updated after the table's watermark
+    (saved in /watermark/) are queried, going back WATERMARK_LOOKBACK so that
+    rows committed late with an earlier last_updated aren't missed (rows
+    read again without changes are left out of the differences). Incremental
+    queries never see deleted rows: only full snapshots do. A full snapshot
+    of every table can be forced with {"full_snapshot": true} in the event.
+
+    The EXTRACT_MODE environment variable selects how the tables are read:
+    - "query" (default): the whole result is fetched and encoded in memory
+    - "stream": the rows are read through a server-side cursor and streamed
+      to S3 (multipart upload) or /tmp batch by batch, so memory use doesn't
+      grow with the table size
+    - "copy": Postgres encodes the csv itself (COPY ... TO STDOUT) and the
+      bytes are streamed to S3 or /tmp without being decoded in Python
+
+    The tables are extracted in parallel by EXTRACT_CONCURRENCY threads
+    (default 4), each using its own database connection. A table that fails
+    doesn't stop the others: the failures are raised once all tables are done.
+
+    Full snapshots are compared with the previous ones in Python, or with
+    Polars when EXTRACT_DIFF_BACKEND is set to "polars". Once a snapshot has
+    a fingerprint index (/source/*_new.idx: primary key and row hash of each
+    row), the new table is compared with the index instead, in Python, and
+    the previous snapshot is only downloaded when rows were deleted since
+    then. The two options don't combine: EXTRACT_DIFF_BACKEND only applies to
+    the tables without index (text primary keys, or the first comparison
+    after the snapshot was replaced). Both ways write the same differences file.
+
+    Before being extracted, each table is probed with a cheap aggregate query
+    (latest last_updated value and row count, plus a hash of all rows when
+    EXTRACT_PROBE_HASH is set to "true"). A table whose probe hasn't changed
+    since the last run is skipped: nothing is queried or uploaded for it, and
+    no differences file is saved to /history. A table whose probe changed while
+    its latest last_updated value didn't (a delete, or with EXTRACT_PROBE_HASH
+    an update leaving last_updated untouched) is extracted in full and compared
+    with its previous snapshot, since an incremental query can't see the change.
+    Rows deleted in a run where other rows were updated are still only found
+    by full snapshots.
+
+    With EXTRACT_PARQUET set to "true", typed Parquet files (column types
+    taken from the database) are saved next to the csv files:
+    /source/*_new.parquet and /history/.../*_differences.parquet. The transform
+    function reads them instead of parsing the csv files.
+
+    With EXTRACT_COMPRESSION set to "gzip" or "zstd", the csv files saved to
+    /source and /history are compressed, and their keys end with .gz or .zst.
+    Snapshots are read whatever the compression they were saved with, so the
+    setting can be changed between runs.
+
+    The files of a table are uploaded to S3 at once (see s3_utils), large
+    files in parts sent concurrently.
+
+    The time spent by each table in each step (probe, query, encode, diff,
+    download, upload, parquet_write), its rows, changed rows and the bytes
+    transferred are written as CloudWatch EMF metrics (see metrics_utils).
+
+    Secret, bucket name and S3 client are cached between warm invocations and
+    resolved again when an error shows they are stale. With
+    EXTRACT_KEEP_CONNECTIONS set to "true", the database connections are kept
+    open too, and checked before being reused.
     """
 
     db_credentials = get_secret()
-    s3_client = boto3.client("s3")
+    concurrency = int(os.getenv("EXTRACT_CONCURRENCY", DEFAULT_CONCURRENCY))
+    s3_client = get_s3_client()
     raw_data_bucket = connect_to_bucket(s3_client)
     time_path = create_time_based_path()
+    start_metrics("extract", time_path)
     bucket_content = s3_client.list_objects(Bucket=raw_data_bucket)
+    full_snapshot = event.get("full_snapshot", False)
+    mode = os.getenv("EXTRACT_MODE", "query").lower()
+    if mode not in EXTRACT_MODES:
+        raise Exception(f"Unknown extract mode: {mode}")
+    diff_backend = os.getenv("EXTRACT_DIFF_BACKEND", "python").lower()
+    probe_hash = os.getenv("EXTRACT_PROBE_HASH", "false").lower() == "true"
+    emit_parquet = os.getenv("EXTRACT_PARQUET", "false").lower() == "true"
+    compression = os.getenv("EXTRACT_COMPRESSION", "none").lower()
+    compression_suffix(compression)  # raises for an unknown compression
 
     if bucket_content.get("Contents"):
         bucket_files = [dict_["Key"] for dict_ in bucket_content["Contents"]]
     else:
         bucket_files = []
 
+    keep_connections = os.getenv("EXTRACT_KEEP_CONNECTIONS", "false").lower() == "true"
+    pool = get_connection_pool(db_credentials, concurrency, keep_connections)
+    failed_tables = {}
+    skipped_tables = []
     try:
-        conn = connect_to_db(db_credentials)
-        for data_table_name in DATA_TABLES:
-            file_data = query_db(data_table_name, conn)
-            first_call_bool = (
-                not f"{SOURCE_PATH}{data_table_name}{SOURCE_FILE_SUFFIX}.csv"
-                in bucket_files
-            )
-            create_and_upload_csv(
-                file_data, s3_client, raw_data_bucket, 
-                data_table_name, time_path, first_call_bool
-            )
-
-            if not first_call_bool:
-
-                # save a copy of _new from /source to /tmp, where it can be manipulated by the lambda function
-                s3_client.download_file(
-                    Bucket=raw_data_bucket,
-                    Key=f"{SOURCE_PATH}{data_table_name}{SOURCE_FILE_SUFFIX}.csv",
-                    Filename=f"/tmp/{data_table_name}.csv",
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {
+                data_table_name: executor.submit(
+                    run_for_table, data_table_name,
+                    extract_table, data_table_name, pool, s3_client,
+                    raw_data_bucket, time_path,
+                    not any(
+                        f"{SOURCE_PATH}{data_table_name}{SOURCE_FILE_SUFFIX}.csv{suffix}"
+                        in bucket_files
+                        for suffix in READ_SUFFIXES
+                    ),
+                    full_snapshot, mode, diff_backend, probe_hash, emit_parquet,
+                    compression,
                 )
+                for data_table_name in DATA_TABLES
+            }
+            for data_table_name, future in futures.items():
+                try:
+                    if not future.result():
+                        skipped_tables.append(data_table_name)
+                except Exception as e:
+                    logging.error(f"Failed to extract {data_table_name}: {e}")
+                    invalidate_on_error(e)
+                    failed_tables[data_table_name] = e
 
-                changes_csv = compare_csvs(data_table_name)
-
-                # save the _differences file to history
-                s3_client.upload_file(
-                    Bucket=raw_data_bucket,
-                    Filename=f"/tmp/{changes_csv}",
-                    Key=f"{HISTORY_PATH}{time_path}{changes_csv}",
-                )
-
-                # replace /source/*_new with /tmp/*_new
-                s3_client.upload_file(
-                    Bucket=raw_data_bucket,
-                    Filename=f"/tmp/{data_table_name}_new.csv",
-                    Key=f"{SOURCE_PATH}{data_table_name}{SOURCE_FILE_SUFFIX}.csv",
-                )
-
-                # removing the temporary files
-                os.remove(f"/tmp/{data_table_name}.csv")
-                os.remove(f"/tmp/{data_table_name}_new.csv")
-
-        logging.info(f"Successfully uploaded raw data to {raw_data_bucket}")
+    finally:
+        logging.info(f"Database connections: {pool.counters}")
+        if not keep_connections:
+            pool.close()
+        flush_metrics()
 
-    except Error as e:
-        logging.error(e)
-        raise Exception(f"Connection to database failed: {e}")
+    if failed_tables:
+        if all(isinstance(e, Error) for e in failed_tables.values()):
+            raise Exception(
+                f"Connection to database failed: {list(failed_tables.values())[0]}"
+            )
+        raise Exception(f"Failed to extract tables: {', '.join(failed_tables)}")
 
-    finally:
-        if "conn" in locals():
-            conn.close()
+    if skipped_tables:
+        logging.info(f"Unchanged tables skipped: {', '.join(skipped_tables)}")
+    logging.info(f"Successfully uploaded raw data to {raw_data_bucket}")
 
     return {"time_path": time_path}
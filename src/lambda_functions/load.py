@@ -1,2 +1,63 @@
+import logging
+from src.utils.cache_utils import invalidate_on_error
+from src.utils.metrics_utils import start_metrics, flush_metrics
+from src.utils.s3_utils import get_s3_client
+from src.utils.extract_utils import get_secret, connect_to_db
+from src.utils.load_utils import (
+    find_processed_bucket,
+    load_star_schema,
+    WAREHOUSE_SECRET_PREFIX,
+)
+
+
 def lambda_handler(event, context):
-    return "hello"
+    """
+    This function loads the star schema tables saved by the transform function
+    (/table=table/year=yyyy/month=mm/day=dd/hh:mm:ss.parquet in the processed
+    data bucket) into the data warehouse. Only the files of the run are read.
+
+    Each table is streamed with COPY FROM STDIN into a temporary staging table
+    and merged into the warehouse with one statement, so the cost of a load
+    doesn't depend on round trips per row. Dimensions keep the latest value
+    of each row, facts are appended. The tables are loaded in a single
+    transaction: a run that fails leaves the warehouse unchanged.
+    Loaded runs are recorded in the load_ledger table, so a run loaded again
+    (e.g. when the step function retries) is skipped.
+
+    The time spent by each table downloading and copying, its rows and the
+    rows inserted or updated in the warehouse are written as CloudWatch EMF
+    metrics (see metrics_utils).
+
+    Args:
+        event (dict): time prefix provided by transform function
+        context (dict): AWS provided context
+
+    Returns:
+        dict: time prefix and number of rows loaded into each table
+    """
+    prefix = event["time_prefix"]
+    start_metrics("load", prefix)
+    s3_client = get_s3_client()
+
+    try:
+        processed_data_bucket = find_processed_bucket(s3_client)
+        conn = connect_to_db(get_secret(WAREHOUSE_SECRET_PREFIX))
+    except Exception as e:
+        logging.error(f"Failed to connect: {e}")
+        invalidate_on_error(e)
+        flush_metrics()
+        return "Failed to load data"
+
+    try:
+        loaded = load_star_schema(conn, s3_client, processed_data_bucket, prefix)
+    except Exception as e:
+        logging.error(f"Failed to load data: {e}")
+        invalidate_on_error(e)
+        return "Failed to load data"
+    finally:
+        conn.close()
+        flush_metrics()
+
+    if loaded is None:
+        loaded = {}
+    return {"time_prefix": prefix, "loaded": loaded}
@@ -1,7 +1,34 @@
-import boto3
 import logging
-from botocore.exceptions import ClientError
-from src.utils.transform_utils import finds_data_buckets, convert_csv_to_parquet
+import os
+from concurrent.futures import ThreadPoolExecutor
+from src.utils.cache_utils import invalidate_on_error
+from src.utils.metrics_utils import (
+    start_metrics,
+    flush_metrics,
+    metrics_table,
+    run_for_table,
+    timed,
+    count,
+)
+from src.utils.s3_utils import get_s3_client
+from src.utils.transform_utils import (
+    finds_data_buckets,
+    read_raw_file,
+    write_partition,
+    scan_all_differences,
+    update_source_states,
+    extend_dim_date,
+    get_state,
+    state_etag,
+    save_states,
+    remove_raw_files,
+    build_star_schema,
+    write_star_schema,
+    STAR_SCHEMA_SOURCES,
+    STATE_TABLES,
+    HISTORY_PATH,
+    DIFFERENCES_FILE_SUFFIX,
+)
 
 csvs = [
     "sales_order.csv",
@@ -18,10 +45,121 @@ csvs = [
 ]
 
 
+DEFAULT_CONCURRENCY = 4
+
+
+def transform_table(file, prefix, s3_client, raw_data_bucket, processed_data_bucket):
+    """
+    Converts the rows of a single table changed by the extract run saved at prefix
+    (history/prefix/table_differences) to parquet, and writes them to the
+    partitioned history of the table in the processed data bucket.
+    Tables the run didn't change are skipped.
+    Raises ClientError if the upload fails.
+
+    Returns:
+        string: key of the parquet file, or None if the table didn't change
+    """
+    with timed("download"):
+        df = read_raw_file(
+            f"{HISTORY_PATH}{prefix}{file}{DIFFERENCES_FILE_SUFFIX}", s3_client, raw_data_bucket
+        )
+    if df is None:
+        return None
+    count("changed_rows", df.height)
+    return write_partition(df, s3_client, processed_data_bucket, HISTORY_PATH, file, prefix)
+
+
+def transform_star_schema(prefix, s3_client, raw_data_bucket, processed_data_bucket):
+    """
+    Builds the star schema rows changed by the extract run saved at prefix
+    (history/prefix/*_differences) and uploads them to the processed data bucket:
+    new fact rows, and the latest values of the changed dimension rows.
+    The latest rows of the tables joined to build dimensions are kept in
+    /state/ in the processed data bucket. So is the dim_date calendar, which is
+    generated once and only saved again (with its new rows) when facts use
+    dates outside of it. The states aren't saved here: the caller saves them
+    (see save_states) once the whole run has succeeded, so that a run retried
+    with the same prefix builds the same rows again.
+    The star schema is not built until every source table has a snapshot.
+    A run without changes to the source tables leaves it as it is, without
+    reading the states (or importing Polars).
+
+    Returns:
+        tuple: keys of the parquet files, and the changed states to save
+    """
+    try:
+        with metrics_table("star_schema"), timed("download"):
+            changes = scan_all_differences(
+                STAR_SCHEMA_SOURCES, prefix, s3_client, raw_data_bucket
+            )
+            # the calendar is saved with the first star schema built
+            if all(frame is None for frame in changes.values()) and state_etag(
+                "dim_date", s3_client, processed_data_bucket
+            ):
+                logging.info("No changes to the star schema")
+                return [], {}
+            states = update_source_states(
+                changes, s3_client, raw_data_bucket, processed_data_bucket
+            )
+        if states is None:
+            logging.info("Star schema not built")
+            return [], {}
+
+        tables = build_star_schema(changes, states)
+        calendar = get_state("dim_date", s3_client, processed_data_bucket)
+        calendar_rows = 0 if calendar is None else calendar.height
+        calendar, new_dates = extend_dim_date(calendar, tables.get("fact_sales_order"))
+        tables["dim_date"] = new_dates.lazy()
+        keys = write_star_schema(tables, s3_client, processed_data_bucket, prefix)
+
+        changed_states = {
+            table: states[table] for table in STATE_TABLES if changes[table] is not None
+        }
+        if calendar.height > calendar_rows:
+            changed_states["dim_date"] = calendar
+        return keys, changed_states
+
+    finally:
+        remove_raw_files(STAR_SCHEMA_SOURCES)
+
+
 def lambda_handler(event, context):
     """
-    This function finds data buckets, converts the csvs to parquet, then uploads this
-    to the processed data bucket.
+    This function finds data buckets, converts the rows changed by the extract run
+    to parquet, then uploads them to the processed data bucket.
+    When the extract function saved typed parquet files (EXTRACT_PARQUET),
+    they are read instead of the csvs.
+
+    Every table is kept as a Hive-partitioned dataset,
+    /history/table=table/year=yyyy/month=mm/day=dd/hh:mm:ss.parquet, with rows
+    sorted on their last update, row groups of 100k rows with min/max statistics,
+    and an _index.json in each day folder giving the rows and min/max dates of
+    each of its files: readers (the load function, pl.scan_parquet with
+    hive_partitioning) can prune days, files and row groups instead of
+    scanning the whole history.
+
+    The tables are transformed in parallel by TRANSFORM_CONCURRENCY threads
+    (default 4): Polars releases the GIL while parsing and encoding, so the
+    downloads and uploads of a table overlap with the conversion of another.
+    A table that fails doesn't stop the others, but the run then raises an
+    exception naming the failed tables, so that it isn't loaded and the step
+    function retries it with the same time path.
+
+    The tables of the sales star schema (fact_sales_order, dim_staff, dim_location,
+    dim_design, dim_date, dim_currency and dim_counterparty) are then updated
+    from the differences saved by the extract run, and their new rows are
+    saved the same way as /table=table/year=yyyy/month=mm/day=dd/hh:mm:ss.parquet:
+    the cost of a run follows the
+    number of changes, not the size of the database. The states the star
+    schema is built from are only saved when every table of the run succeeded:
+    a failed run leaves them as they were, and its retry builds the same rows.
+
+    EXTRACT_COMPRESSION is set as for the extract function: the csv files it
+    saves are looked for with the suffix of that compression first.
+
+    The time spent by each table in each step (download, transform,
+    parquet_write, upload), its changed rows and the bytes transferred are
+    written as CloudWatch EMF metrics (see metrics_utils).
 
     Args:
         event (dict): time prefix provided by extract function
@@ -30,24 +168,53 @@ def lambda_handler(event, context):
     Returns:
         dict: dictionary with time prefix to be used in the load function
     """
-    s3_client = boto3.client("s3")
+    concurrency = int(os.getenv("TRANSFORM_CONCURRENCY", DEFAULT_CONCURRENCY))
+    s3_client = get_s3_client()
 
     prefix = event["time_path"]
+    start_metrics("transform", prefix)
 
-    _, processed_data_bucket = finds_data_buckets()
+    raw_data_bucket, processed_data_bucket = finds_data_buckets()
 
-    for file in csvs:
-        parquet = convert_csv_to_parquet(file)
-        file = file[:-4]
-        try:
-            s3_client.put_object(
-                Body=parquet,
-                Bucket=processed_data_bucket,
-                Key=f"/history/{prefix}/{file}.parquet",
+    failed_tables = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {
+            file[:-4]: executor.submit(
+                run_for_table,
+                file[:-4],
+                transform_table,
+                file[:-4],
+                prefix,
+                s3_client,
+                raw_data_bucket,
+                processed_data_bucket,
             )
+            for file in csvs
+        }
+        for file, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                logging.error(f"Failed to transform {file}: {e}")
+                invalidate_on_error(e)
+                failed_tables[file] = e
+
+    try:
+        _, states = transform_star_schema(
+            prefix, s3_client, raw_data_bucket, processed_data_bucket
+        )
+        # the states only move on once every table of the run has been saved
+        if not failed_tables:
+            with metrics_table("star_schema"), timed("upload"):
+                save_states(states, s3_client, processed_data_bucket)
+    except Exception as e:
+        logging.error(f"Failed to build star schema: {e}")
+        invalidate_on_error(e)
+        failed_tables["star_schema"] = e
+    flush_metrics()
 
-        except ClientError as e:
-            logging.error(e)
-            return "Failed to upload file"
+    if failed_tables:
+        logging.error(f"Failed to transform tables: {', '.join(failed_tables)}")
+        raise Exception(f"Failed to transform tables: {', '.join(failed_tables)}")
 
     return {"time_prefix": prefix}
@@ -0,0 +1,127 @@
+import boto3
+import importlib
+import logging
+import threading
+import time
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+"""
+Values kept at module level survive between warm invocations of a lambda
+function, so secrets, bucket names and boto3 clients are resolved once per
+container (and again after DEFAULT_TTL seconds) instead of on every run.
+Heavy libraries are imported the same way, on first use (see lazy_import),
+so that a cold start only pays for the libraries its run needs.
+"""
+
+DEFAULT_TTL = 15 * 60
+# errors showing that a cached value (credentials, bucket name, secret) is stale
+STALE_ERROR_CODES = {
+    "NoSuchBucket",
+    "AccessDenied",
+    "ExpiredToken",
+    "ExpiredTokenException",
+    "InvalidAccessKeyId",
+    "InvalidClientTokenId",
+    "SignatureDoesNotMatch",
+    "UnrecognizedClientException",
+    "ResourceNotFoundException",
+    "28P01",  # postgres: invalid password
+    "28000",  # postgres: invalid authorization
+}
+
+cache = {}
+cache_lock = threading.Lock()
+
+
+def cached(key, factory, ttl=DEFAULT_TTL):
+    """
+    Returns the value cached under key, calling factory() to build it
+    when it is missing or older than ttl seconds (ttl=None never expires).
+    Exceptions raised by factory are not cached.
+    """
+    now = time.monotonic()
+    with cache_lock:
+        if key in cache:
+            value, expires_at = cache[key]
+            if expires_at is None or expires_at > now:
+                return value
+
+    value = factory()
+    with cache_lock:
+        cache[key] = (value, None if ttl is None else now + ttl)
+    return value
+
+
+def invalidate(*keys):
+    """
+    Removes keys from the cache, or every cached value if no key is given
+    """
+    with cache_lock:
+        if not keys:
+            cache.clear()
+        for key in keys:
+            cache.pop(key, None)
+
+
+def invalidate_on_error(error):
+    """
+    Clears the cache if error (or the exception it was raised from) shows that
+    a cached value is stale: expired credentials, missing bucket or secret,
+    or a database password that was changed.
+    Returns True if the cache was cleared.
+    """
+    while error is not None:
+        if isinstance(error, ClientError):
+            code = error.response["Error"]["Code"]
+        elif error.args and isinstance(error.args[0], dict):
+            code = error.args[0].get("C")  # pg8000 database errors
+        else:
+            code = None
+
+        if code in STALE_ERROR_CODES:
+            logging.info(f"Clearing cached resources after {code} error")
+            invalidate()
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
+def get_client(service_name, region_name=None, max_pool_connections=10):
+    """
+    Returns a boto3 client shared by every invocation of the container
+    """
+    return cached(
+        ("client", service_name, region_name, max_pool_connections),
+        lambda: boto3.client(
+            service_name,
+            region_name=region_name,
+            config=Config(max_pool_connections=max_pool_connections),
+        ),
+        ttl=None,
+    )
+
+
+class LazyModule:
+    """
+    Module imported on first access to one of its attributes, and then
+    shared by every invocation of the container
+    """
+
+    def __init__(self, module_name):
+        self._module_name = module_name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            # the import lock makes the first import safe from several threads
+            self._module = importlib.import_module(self._module_name)
+        return getattr(self._module, attribute)
+
+
+def lazy_import(module_name):
+    """
+    Returns module_name (e.g. pl = lazy_import("polars")) without importing
+    it until it is used
+    """
+    return LazyModule(module_name)
@@ -1,22 +1,46 @@
-import boto3
+import array
 import logging
 import os
 import csv
+import hashlib
 import json
-import re
-import subprocess
+import queue
+import struct
+import threading
+import time
+import zlib
+from contextlib import contextmanager
 from datetime import datetime as dt
-from pg8000.native import Connection, Error
+from pg8000.native import Connection, Error, literal
 from botocore.exceptions import ClientError
-from io import StringIO
+from io import StringIO, BytesIO
+from src.utils.cache_utils import cached, get_client
+from src.utils.s3_utils import (
+    MultipartUpload,
+    put_objects,
+    compress,
+    compression_suffix,
+)
 
-#for debugging
-CSV_REGEX = r">\s*([A-Za-z0-9\.@:\-_\s,:]+)(?=\s\d+c\d+)|>\s*([A-Za-z0-9\.@:\-_\s,:]+)(?=\s\\)|>\s*([A-Za-z0-9\.@:\-_\s,:]+)(?=\s>)"
 
 HISTORY_PATH = "/history/" 
 SOURCE_PATH = "/source/"
 SOURCE_FILE_SUFFIX = "_new"
 DIFFERENCES_FILE_SUFFIX = "_differences"
+WATERMARK_PATH = "/watermark/"
+WATERMARK_COLUMN = "last_updated"
+PROBE_KEY = "probe"
+CHANGE_TYPE_COLUMN = "change_type"
+FINGERPRINT_INDEX_EXTENSION = ".idx"
+FINGERPRINT_INDEX_MAGIC = b"TSFP"
+PARQUET_EXTENSION = ".parquet"
+EXTRACT_MODES = ["query", "stream", "copy"]
+STREAM_BATCH_SIZE = 10000
+# incremental queries read the rows updated since the watermark minus this interval
+# again, so that a transaction committed after a run with an earlier last_updated
+# is not skipped (the rows read again are deduplicated by merge_csvs)
+WATERMARK_LOOKBACK = "5 minutes"
+PING_AFTER = 30  # seconds a pooled connection can stay idle before being checked
 DATA_TABLES = [
     "sales_order",
     "design",
@@ -57,9 +81,18 @@ def create_time_based_path():
 
 
 def get_secret(secret_prefix="totesys-credentials-"):
+    """
+    Retrieves secret from secrets manager based on argument given, with the
+    default argument set to the database credentials.
+    The secret is cached and reused by warm invocations (see fetch_secret).
+    """
+    return cached(("secret", secret_prefix), lambda: fetch_secret(secret_prefix))
+
+
+def fetch_secret(secret_prefix):
     """
     Initialises a boto3 secrets manager client and retrieves secret from secrets manager
-    based on argument given, with the default argument set to the database credentials.
+    based on argument given.
     The secret returned should be a dictionary with 5 keys:
     user - the username for the database
     password - the password for the user
@@ -67,9 +100,8 @@ def get_secret(secret_prefix="totesys-credentials-"):
     port - which port we are using to connect with the database
     database - the name of the database that we want to connect to
     """
-    session = boto3.session.Session()
-    client = session.client(service_name="secretsmanager", region_name="eu-west-2")
-    
+    client = get_client("secretsmanager", region_name="eu-west-2")
+
     try:
         get_secrets_lists_response = client.list_secrets()
         for secret in get_secrets_lists_response['SecretList']:
@@ -88,13 +120,17 @@ def connect_to_bucket(client):
     """
     Searches for a raw data bucket within an AWS account and returns bucket name if
     bucket is found or raises exception if bucket is not found.
+    The bucket name is cached and reused by warm invocations.
     """
-    buckets = client.list_buckets()
-    for bucket in buckets["Buckets"]:
-        if bucket["Name"].startswith("totesys-raw-data-"):
-            return bucket["Name"]
-    logging.error("No raw data bucket found")
-    raise Exception("No raw data bucket found")
+    def find_bucket():
+        buckets = client.list_buckets()
+        for bucket in buckets["Buckets"]:
+            if bucket["Name"].startswith("totesys-raw-data-"):
+                return bucket["Name"]
+        logging.error("No raw data bucket found")
+        raise Exception("No raw data bucket found")
+
+    return cached(("bucket", "totesys-raw-data-"), find_bucket)
 
 
 def connect_to_db(credentials):
@@ -111,30 +147,435 @@ def connect_to_db(credentials):
     )
 
 
-def query_db(dt_name, conn):
+class ConnectionPool:
+    """
+    Bounded pool of database connections, opened with connect_to_db
+    on demand (up to size), so that tables can be extracted concurrently
+    without two threads sharing a connection.
+    Connections idle for more than PING_AFTER seconds are checked with a
+    cheap query before being reused and replaced if they are stale.
+    The counters record how many connections were opened, reused and
+    reconnected (replaced after a failed check).
+    """
+
+    def __init__(self, credentials, size):
+        self.credentials = credentials
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.opened = 0
+        self.lock = threading.Lock()
+        self.counters = {"opened": 0, "reused": 0, "reconnected": 0}
+
+    def get(self):
+        while True:
+            try:
+                conn, idle_since = self.idle.get_nowait()
+            except queue.Empty:
+                conn = None
+            if conn is None:
+                with self.lock:
+                    if self.opened < self.size:
+                        self.opened += 1
+                        break
+                try:
+                    conn, idle_since = self.idle.get(timeout=1)
+                except queue.Empty:
+                    continue
+            if self.is_alive(conn, idle_since):
+                self.count("reused")
+                return conn
+            self.discard(conn)
+            self.count("reconnected")
+        try:
+            conn = connect_to_db(self.credentials)
+        except Exception:
+            with self.lock:
+                self.opened -= 1
+            raise
+        self.count("opened")
+        return conn
+
+    def is_alive(self, conn, idle_since):
+        if time.monotonic() - idle_since < PING_AFTER:
+            return True
+        try:
+            conn.run("SELECT 1;")
+            return True
+        except Exception as e:
+            logging.info(f"Replacing stale database connection: {e}")
+            return False
+
+    def count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def put(self, conn):
+        self.idle.put((conn, time.monotonic()))
+
+    def discard(self, conn):
+        """Closes a connection that can't be reused (e.g. after an error)"""
+        with self.lock:
+            self.opened -= 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def connection(self):
+        conn = self.get()
+        try:
+            yield conn
+        except Exception:
+            self.discard(conn)
+            raise
+        self.put(conn)
+
+    def close(self):
+        while True:
+            try:
+                conn, _ = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            self.discard(conn)
+
+
+kept_pool = None
+kept_pool_lock = threading.Lock()
+
+
+def get_connection_pool(credentials, size, keep=False):
+    """
+    Returns a ConnectionPool for the credentials.
+    With keep=True the pool, and the connections it holds, is kept at module
+    scope and reused by the following warm invocations (a new one replaces it
+    if the credentials or size change). Otherwise the caller should close it.
+    """
+    global kept_pool
+    if not keep:
+        return ConnectionPool(credentials, size)
+
+    with kept_pool_lock:
+        if kept_pool is not None and (
+            kept_pool.credentials != credentials or kept_pool.size != size
+        ):
+            kept_pool.close()
+            kept_pool = None
+        if kept_pool is None:
+            kept_pool = ConnectionPool(credentials, size)
+        return kept_pool
+
+
+def query_columns(dt_name, conn):
+    """
+    Returns the names and data types of the table's columns
+    """
+    query = (
+        f"SELECT column_name, data_type FROM information_schema.columns "
+        f"WHERE table_name = '{dt_name}' ORDER BY ordinal_position;"
+    )
+    return conn.run(query)
+
+
+def query_header(dt_name, conn):
+    """
+    Returns the names of the table's columns (header of csv format file)
+    """
+    header = []
+    for column in query_columns(dt_name, conn):
+        header.append(column[0])
+    return header
+
+
+def watermark_condition(watermark):
+    """
+    Returns the condition selecting the rows updated after the watermark
+    (SQL expression), going back WATERMARK_LOOKBACK to pick up rows
+    committed late with an earlier last_updated
+    """
+    return (
+        f"{WATERMARK_COLUMN} >= CAST({watermark} AS timestamp) "
+        f"- INTERVAL '{WATERMARK_LOOKBACK}'"
+    )
+
+
+def select_query(dt_name, watermark=None):
+    """
+    Returns the query selecting all table's content (watermark is None)
+    or only the rows updated after the watermark (incremental extract,
+    see watermark_condition). Deleted rows are never seen by an
+    incremental query: only full snapshots find them.
+    """
+    if watermark is None:
+        return f"SELECT * FROM {dt_name}"
+    return f"SELECT * FROM {dt_name} WHERE {watermark_condition(':watermark')}"
+
+
+def query_db(dt_name, conn, watermark=None):
     """
     Does two queries to the database:
     1. Name of table's columns --> header of csv format file
-    2. All table's content
+    2. All table's content (watermark is None) or only the rows
+       updated after the watermark (incremental extract)
     Returns data in csv format (header + data rows)
     """
-    query = f"SELECT column_name FROM information_schema.columns WHERE table_name = '{dt_name}';"
-    column_names = conn.run(query)
-    header = []
-    for column in column_names:
-        header.append(column[0])
+    header = query_header(dt_name, conn)
 
-    query = f"SELECT * FROM {dt_name};"
-    data_rows = conn.run(query)
+    query = f"{select_query(dt_name, watermark)};"
+    if watermark is None:
+        data_rows = conn.run(query)
+    else:
+        data_rows = conn.run(query, watermark=watermark)
     return [header] + data_rows
 
 
-def create_and_upload_csv(data, client, bucket, tablename, time_path, first_call):
+def stream_query_db(dt_name, conn, watermark=None, batch_size=STREAM_BATCH_SIZE):
+    """
+    Streaming version of query_db: the rows are fetched through a server-side
+    cursor, batch_size rows at a time, so the table is never held in memory.
+    Returns the header and a generator yielding the batches of rows.
+    The connection can't be used for other queries until the generator is exhausted
+    or closed, so callers should close it once they stop reading the batches.
+    """
+    header = query_header(dt_name, conn)
+
+    def fetch_batches():
+        cursor = f"{dt_name}_cursor"
+        conn.run("START TRANSACTION;")
+        try:
+            query = f"DECLARE {cursor} NO SCROLL CURSOR FOR {select_query(dt_name, watermark)};"
+            if watermark is None:
+                conn.run(query)
+            else:
+                conn.run(query, watermark=watermark)
+            while True:
+                data_rows = conn.run(f"FETCH FORWARD {batch_size} FROM {cursor};")
+                if not data_rows:
+                    break
+                yield data_rows
+            conn.run(f"CLOSE {cursor};")
+        finally:
+            conn.run("COMMIT;")
+
+    return header, fetch_batches()
+
+
+def copy_select_list(columns):
+    """
+    Returns the select list used by the COPY extract. Booleans and timestamps
+    are rendered the way Python writes them (True/False, microseconds only when
+    not zero), so that both extract modes produce the same csv values.
+    COPY quotes empty strings ("") where Python writes them bare, like NULLs,
+    so empty text values are copied as NULLs.
+    """
+    select_list = []
+    for column_name, data_type in columns:
+        if data_type == "boolean":
+            select_list.append(
+                f"CASE WHEN {column_name} THEN 'True' "
+                f"WHEN NOT {column_name} THEN 'False' END AS {column_name}"
+            )
+        elif data_type == "timestamp without time zone":
+            select_list.append(
+                f"CASE WHEN date_part('microseconds', {column_name})::int % 1000000 = 0 "
+                f"THEN to_char({column_name}, 'YYYY-MM-DD HH24:MI:SS') "
+                f"ELSE to_char({column_name}, 'YYYY-MM-DD HH24:MI:SS.US') END AS {column_name}"
+            )
+        elif data_type in ("text", "character varying", "character"):
+            select_list.append(f"NULLIF({column_name}, '') AS {column_name}")
+        else:
+            select_list.append(column_name)
+    return ", ".join(select_list)
+
+
+class TeeWriter:
+    """
+    File-like object writing the same bytes to several outputs
+    """
+
+    def __init__(self, *outputs):
+        self.outputs = outputs
+
+    def write(self, data):
+        for output in self.outputs:
+            output.write(data)
+        return len(data)
+
+
+def copy_and_upload_csv(
+    dt_name, conn, client, bucket, time_path, first_call, watermark=None, compression=None,
+    keep_csv=False,
+):
+    """
+    COPY version of query_db + create_and_upload_csv: Postgres encodes the table
+    (or only the rows updated after the watermark) as csv with COPY ... TO STDOUT
+    and the bytes are forwarded as they arrive, without being decoded in Python.
+    - first_call == True ? multipart upload to bucket/source as *_new.csv, and history/y/m/d/hh:mm:ss/*_differences.csv
+      (compressed with compression, see create_and_upload_csv); with keep_csv the
+      uncompressed csv is also written to lamba ephemeral storage/tmp as *_new.csv
+    - first_call == False ? lamba ephemeral storage/tmp as *.csv
+    Returns the number of rows copied and their latest last_updated value (watermark).
+    """
+    select_list = copy_select_list(query_columns(dt_name, conn))
+    where = ""
+    if watermark is not None:
+        where = f" WHERE {watermark_condition(literal(watermark))}"
+
+    if first_call:
+        suffix = compression_suffix(compression)
+        outputs = [
+            MultipartUpload(
+                client, bucket, f"{SOURCE_PATH}{dt_name}{SOURCE_FILE_SUFFIX}.csv{suffix}",
+                compression=compression,
+            ),
+            MultipartUpload(
+                client, bucket,
+                f"{HISTORY_PATH}{time_path}{dt_name}{DIFFERENCES_FILE_SUFFIX}.csv{suffix}",
+                compression=compression,
+            ),
+        ]
+        if keep_csv:
+            outputs.append(open(f"/tmp/{dt_name}_new.csv", "wb"))
+    else:
+        outputs = [open(f"/tmp/{dt_name}_new.csv", "wb")]
+    stream = outputs[0] if len(outputs) < 3 else TeeWriter(outputs[0], outputs[2])
+
+    # every query runs on the same snapshot of the table
+    conn.run("START TRANSACTION ISOLATION LEVEL REPEATABLE READ;")
+    try:
+        conn.run(
+            f"COPY (SELECT {select_list} FROM {dt_name}{where}) TO STDOUT WITH CSV HEADER;",
+            stream=stream,
+        )
+        row_count = conn.row_count
+        if first_call:
+            conn.run(
+                f"COPY (SELECT {select_list}, 'insert' AS {CHANGE_TYPE_COLUMN} "
+                f"FROM {dt_name}{where}) TO STDOUT WITH CSV HEADER;",
+                stream=outputs[1],
+            )
+        new_watermark = conn.run(
+            f"SELECT max({WATERMARK_COLUMN}) FROM {dt_name}{where};"
+        )[0][0]
+
+        for output in outputs:
+            output.close()
+        conn.run("COMMIT;")
+
+    except Exception as e:
+        conn.run("ROLLBACK;")
+        for output in outputs:
+            if isinstance(output, MultipartUpload):
+                output.abort()
+        if isinstance(e, ClientError):
+            logging.error(e)
+            raise Exception("Failed to upload file")
+        raise
+
+    finally:
+        for output in outputs:
+            if not isinstance(output, MultipartUpload):
+                output.close()
+
+    if new_watermark is None:
+        return row_count, None
+    return row_count, str(new_watermark)
+
+
+def get_watermark_file(client, bucket, tablename):
+    """
+    Reads the json file saved for a table in bucket/watermark:
+    its high-water mark and the result of its last change probe.
+    Returns None if no watermark has been saved yet (first run).
+    """
+    try:
+        res = client.get_object(
+            Bucket=bucket, Key=f"{WATERMARK_PATH}{tablename}.json"
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "NoSuchKey":
+            return None
+        logging.error(e)
+        raise Exception(f"Can't retrieve watermark due to {e}")
+    return json.loads(res["Body"].read())
+
+
+def save_watermark(client, bucket, tablename, watermark, probe=None):
+    """
+    Saves the high-water mark of a table to bucket/watermark as a json file,
+    so that the next run only queries the rows updated after it.
+    The result of the table's change probe is saved with it (see probe_table).
+    """
+    watermark_file = {WATERMARK_COLUMN: watermark}
+    if probe is not None:
+        watermark_file[PROBE_KEY] = probe
+    try:
+        client.put_object(
+            Body=json.dumps(watermark_file),
+            Bucket=bucket,
+            Key=f"{WATERMARK_PATH}{tablename}.json",
+        )
+    except ClientError as e:
+        logging.error(e)
+        raise Exception("Failed to upload watermark")
+
+
+def probe_table(dt_name, conn, with_hash=False):
+    """
+    Runs a cheap aggregate query summarising a table's content:
+    latest last_updated value and number of rows.
+    With with_hash, the sum of the hashes of all rows is added too, so that
+    updates which leave last_updated untouched change the probe as well.
+    Two equal probes mean the table most likely hasn't changed in between
+    (without hash, an update keeping last_updated, or as many inserts as
+    deletes of older rows, leave the probe as it was).
+    """
+    aggregates = f"max({WATERMARK_COLUMN}), count(*)"
+    if with_hash:
+        aggregates += f", sum(hashtext({dt_name}::text))"
+    result = conn.run(f"SELECT {aggregates} FROM {dt_name};")[0]
+
+    probe = {
+        "max_last_updated": None if result[0] is None else str(result[0]),
+        "row_count": result[1],
+    }
+    if with_hash:
+        probe["row_hash"] = None if result[2] is None else int(result[2])
+    return probe
+
+
+def find_watermark(data):
+    """
+    Returns the latest last_updated value found in data (header + data rows)
+    as a string, or None if data has no rows.
+    """
+    if len(data) < 2:
+        return None
+    column = data[0].index(WATERMARK_COLUMN)
+    return str(max(row[column] for row in data[1:]))
+
+
+def primary_key_index(header, dt_name):
+    """
+    Returns the position of the primary key (<dt_name>_id) in the header,
+    defaulting to the first column.
+    """
+    if f"{dt_name}_id" in header:
+        return header.index(f"{dt_name}_id")
+    return 0
+
+
+def create_and_upload_csv(
+    data, client, bucket, tablename, time_path, first_call, compression=None
+):
     """
     Converts a table from a database into a CSV file and uploads that CSV file to either:
     - first_call == True ? bucket/source as *_new.csv , and history/y/m/d/hh:mm:ss/*_differences.csv
+      (where every row is marked as an insert)
     - first_call == False ? lamba ephemeral storage/tmp as *.csv
     The data argument is a list of lists.
+    With compression ("gzip" or "zstd"), the uploaded files are compressed
+    and their keys end with .gz or .zst.
     """
     file_to_save = StringIO()
     csv.writer(file_to_save).writerows(data)
@@ -142,16 +583,18 @@ def create_and_upload_csv(data, client, bucket, tablename, time_path, first_call
 
     try:
         if first_call:
-            client.put_object(
-                Body=file_to_save,
-                Bucket=bucket,
-                Key=f"{SOURCE_PATH}{tablename}{SOURCE_FILE_SUFFIX}.csv",
-            )
-            client.put_object(
-                Body=file_to_save,
-                Bucket=bucket,
-                Key=f"{HISTORY_PATH}{time_path}{tablename}{DIFFERENCES_FILE_SUFFIX}.csv",
-            )
+            differences = StringIO()
+            csvwriter = csv.writer(differences)
+            csvwriter.writerow(list(data[0]) + [CHANGE_TYPE_COLUMN])
+            csvwriter.writerows(list(row) + ["insert"] for row in data[1:])
+
+            suffix = compression_suffix(compression)
+            put_objects(client, bucket, {
+                f"{SOURCE_PATH}{tablename}{SOURCE_FILE_SUFFIX}.csv{suffix}":
+                    compress(file_to_save, compression),
+                f"{HISTORY_PATH}{time_path}{tablename}{DIFFERENCES_FILE_SUFFIX}.csv{suffix}":
+                    compress(bytes(differences.getvalue(), encoding="utf-8"), compression),
+            })
         else:
             with open(f'/tmp/{tablename}_new.csv', 'wb') as csvfile:
                 csvfile.write(file_to_save)
@@ -161,49 +604,490 @@ def create_and_upload_csv(data, client, bucket, tablename, time_path, first_call
         raise Exception("Failed to upload file")
 
 
-def compare_csvs(dt_name):
+def encode_csv(rows):
+    """
+    Returns the rows (list of lists) encoded as utf-8 csv bytes
+    """
+    chunk = StringIO()
+    csv.writer(chunk).writerows(rows)
+    return chunk.getvalue().encode("utf-8")
+
+
+def stream_and_upload_csv(
+    header, batches, client, bucket, tablename, time_path, first_call, compression=None,
+    on_batch=None,
+):
+    """
+    Streaming version of create_and_upload_csv: header and batches are the output
+    of stream_query_db and each batch is encoded and written as soon as it is fetched.
+    - first_call == True ? multipart upload to bucket/source as *_new.csv, and history/y/m/d/hh:mm:ss/*_differences.csv
+      (compressed with compression, see create_and_upload_csv)
+    - first_call == False ? lamba ephemeral storage/tmp as *.csv
+    on_batch, if given, is called with every batch once it has been written.
+    Returns the number of rows written and their latest last_updated value (watermark).
+    """
+    if first_call:
+        suffix = compression_suffix(compression)
+        outputs = [
+            MultipartUpload(
+                client, bucket, f"{SOURCE_PATH}{tablename}{SOURCE_FILE_SUFFIX}.csv{suffix}",
+                compression=compression,
+            ),
+            MultipartUpload(
+                client, bucket,
+                f"{HISTORY_PATH}{time_path}{tablename}{DIFFERENCES_FILE_SUFFIX}.csv{suffix}",
+                compression=compression,
+            ),
+        ]
+    else:
+        outputs = [open(f"/tmp/{tablename}_new.csv", "wb")]
+
+    row_count = 0
+    watermark = None
+    try:
+        outputs[0].write(encode_csv([header]))
+        if first_call:
+            outputs[1].write(encode_csv([header + [CHANGE_TYPE_COLUMN]]))
+
+        for batch in batches:
+            outputs[0].write(encode_csv(batch))
+            if first_call:
+                outputs[1].write(encode_csv(list(row) + ["insert"] for row in batch))
+            if on_batch is not None:
+                on_batch(batch)
+            row_count += len(batch)
+            batch_watermark = find_watermark([header] + batch)
+            if watermark is None or batch_watermark > watermark:
+                watermark = batch_watermark
+
+        for output in outputs:
+            output.close()
+
+    except Exception as e:
+        for output in outputs:
+            if isinstance(output, MultipartUpload):
+                output.abort()
+        if isinstance(e, ClientError):
+            logging.error(e)
+            raise Exception("Failed to upload file")
+        raise
+
+    finally:
+        if not first_call:
+            outputs[0].close()
+
+    return row_count, watermark
+
+
+def read_csv_rows(path):
+    """
+    Yields the rows of a csv file as lists of strings, ignoring blank lines
+    """
+    with open(path, "r", newline="") as csv_file:
+        for row in csv.reader(csv_file):
+            if row:
+                yield row
+
+
+def row_hash(row):
+    """
+    Returns a 64-bit fingerprint (int) of a csv row, used to find out
+    whether a row has changed without keeping its content in memory.
+    """
+    digest = hashlib.blake2b("\x1f".join(row).encode("utf-8"), digest_size=8)
+    return int.from_bytes(digest.digest(), "big")
+
+
+def compare_csvs(dt_name, backend="python"):
     """
     Takes two csvs (dt_name.csv, dt_name_new.csv) located in /tmp
-    and compares the differences between them, returning an
-    empty csv if no differences found.
+    and compares them in one pass, joining the rows on the table's
+    primary key (<dt_name>_id). Inserted, updated and deleted rows are
+    saved with a change_type column; the csv only holds the header
+    if no differences are found.
+    With backend="polars" the comparison is vectorised (see compare_csvs_polars).
+
+    Arg: datatable name (= prefix of csv file name)
+
+    Returns:
+    name of the csv file containing all changes to database
+    """
+    if backend == "polars":
+        return compare_csvs_polars(dt_name)
+
+    csv_prev = f"/tmp/{dt_name}.csv"
+    csv_new = f"/tmp/{dt_name}_new.csv"
+
+    prev_rows = read_csv_rows(csv_prev)
+    key = primary_key_index(next(prev_rows), dt_name)
+    prev_hashes = {row[key]: row_hash(row) for row in prev_rows}
+
+    new_rows = read_csv_rows(csv_new)
+    header = next(new_rows)
+    changes = 0
+
+    filepath = f"{dt_name}_differences.csv"
+    with open(f"/tmp/{filepath}", "w", newline="") as f:
+        csvwriter = csv.writer(f)
+        csvwriter.writerow(header + [CHANGE_TYPE_COLUMN])
+        for row in new_rows:
+            prev_hash = prev_hashes.pop(row[key], None)
+            if prev_hash is None:
+                csvwriter.writerow(row + ["insert"])
+                changes += 1
+            elif prev_hash != row_hash(row):
+                csvwriter.writerow(row + ["update"])
+                changes += 1
+
+        # keys left in prev_hashes are no longer in the table
+        if prev_hashes:
+            prev_rows = read_csv_rows(csv_prev)
+            next(prev_rows)
+            for row in prev_rows:
+                if row[key] in prev_hashes:
+                    csvwriter.writerow(row + ["delete"])
+                    changes += 1
+
+    if changes == 0:
+        logging.info("No changes in table found")
+    else:
+        logging.info(f"{changes} changes found in table")
+
+    return filepath
+
+
+def compare_csvs_polars(dt_name):
+    """
+    Vectorised version of compare_csvs: both csvs are loaded as Polars
+    DataFrames (all values as strings) and compared through joins on the
+    primary key and a row hash column. Writes the same _differences csv
+    as compare_csvs. Polars is only imported when this backend is used.
 
     Arg: datatable name (= prefix of csv file name)
 
     Returns:
-    csv file containing all changes to database (if csv1 and csv2 are not equal)
-    None (if dt_name.csv, dt_name_new.csv are equal)
+    name of the csv file containing all changes to database
+    """
+    import polars as pl
+
+    def read_snapshot(path):
+        return pl.read_csv(path, infer_schema_length=0)
+
+    prev = read_snapshot(f"/tmp/{dt_name}.csv")
+    new = read_snapshot(f"/tmp/{dt_name}_new.csv")
+    key = new.columns[primary_key_index(new.columns, dt_name)]
+    # empty values are read as nulls, which are written back as empty values
+    row_hash = (
+        pl.concat_str(pl.all().fill_null(""), separator="\x1f").hash().alias("row_hash")
+    )
+
+    changed = (
+        new.with_columns(row_hash)
+        .join(prev.select(key, row_hash), on=key, how="left", suffix="_prev")
+        .filter(
+            pl.col("row_hash_prev").is_null()
+            | (pl.col("row_hash") != pl.col("row_hash_prev"))
+        )
+        .with_columns(
+            pl.when(pl.col("row_hash_prev").is_null())
+            .then(pl.lit("insert"))
+            .otherwise(pl.lit("update"))
+            .alias(CHANGE_TYPE_COLUMN)
+        )
+        .select(new.columns + [CHANGE_TYPE_COLUMN])
+    )
+    deleted = prev.join(new.select(key), on=key, how="anti").with_columns(
+        pl.lit("delete").alias(CHANGE_TYPE_COLUMN)
+    )
+    differences = pl.concat([changed, deleted], how="diagonal")
+
+    filepath = f"{dt_name}_differences.csv"
+    differences.write_csv(f"/tmp/{filepath}", line_terminator="\r\n")
+
+    if differences.height == 0:
+        logging.info("No changes in table found")
+    else:
+        logging.info(f"{differences.height} changes found in table")
+
+    return filepath
+
+
+def merge_csvs(dt_name):
+    """
+    Applies the rows fetched by an incremental query (dt_name_new.csv)
+    to the previous full snapshot of the table (dt_name.csv), both located in /tmp.
+    The incremental rows are saved as dt_name_differences.csv with a change_type
+    column and dt_name_new.csv is overwritten with the updated full snapshot.
+    Rows identical to their previous version (read again because of the
+    watermark lookback) are not differences. Deleted rows are not found.
+    If the incremental query found no rows, the snapshot is left untouched
+    and dt_name.csv is not needed.
+
+    Arg: datatable name (= prefix of csv file name)
+
+    Returns:
+    name of the csv file containing all changes to database
     """
     csv_prev = f"/tmp/{dt_name}.csv"
     csv_new = f"/tmp/{dt_name}_new.csv"
+    filepath = f"{dt_name}_differences.csv"
+
+    with open(csv_new, "r", newline="") as csv_file:
+        csv_reader = csv.reader(csv_file)
+        header = next(csv_reader)
+        key = primary_key_index(header, dt_name)
+        changes_to_table = {row[key]: row for row in csv_reader}
+
+    found = set()
+    unchanged = set()
+    if changes_to_table:
+        with open(csv_prev, "r", newline="") as f_prev, open(csv_new, "w", newline="") as f_new:
+            csv_reader = csv.reader(f_prev)
+            csvwriter = csv.writer(f_new)
+            csvwriter.writerow(next(csv_reader))
+            for row in csv_reader:
+                if row[key] in changes_to_table:
+                    found.add(row[key])
+                    if row == changes_to_table[row[key]]:
+                        unchanged.add(row[key])
+                    row = changes_to_table[row[key]]
+                csvwriter.writerow(row)
+            csvwriter.writerows(
+                row for pk, row in changes_to_table.items() if pk not in found
+            )
+
+    with open(f"/tmp/{filepath}", "w", newline="") as f:
+        csvwriter = csv.writer(f)
+        csvwriter.writerow(header + [CHANGE_TYPE_COLUMN])
+        for pk, row in changes_to_table.items():
+            if pk not in unchanged:
+                csvwriter.writerow(row + ["update" if pk in found else "insert"])
+
+    logging.info(
+        f"Merged {len(changes_to_table) - len(unchanged)} incremental changes "
+        f"into {dt_name} snapshot"
+    )
+
+    return filepath
+
+
+def encode_fingerprint_index(keys, hashes):
+    """
+    Encodes a fingerprint index (primary keys and 64-bit row hashes) in binary:
+    magic bytes + row count + int64 keys + uint64 row hashes, compressed with zlib.
+    """
+    payload = (
+        FINGERPRINT_INDEX_MAGIC
+        + struct.pack("<Q", len(keys))
+        + array.array("q", keys).tobytes()
+        + array.array("Q", hashes).tobytes()
+    )
+    return zlib.compress(payload)
+
+
+def decode_fingerprint_index(data):
+    """
+    Decodes a fingerprint index encoded by encode_fingerprint_index.
+    Returns a dictionary primary key (int) -> row hash, in snapshot order.
+    """
+    payload = zlib.decompress(data)
+    if payload[:4] != FINGERPRINT_INDEX_MAGIC:
+        raise ValueError("Not a fingerprint index")
+    (row_count,) = struct.unpack("<Q", payload[4:12])
+    keys = array.array("q", payload[12:12 + 8 * row_count])
+    hashes = array.array("Q", payload[12 + 8 * row_count:12 + 16 * row_count])
+    return dict(zip(keys, hashes))
+
+
+def write_fingerprint_index(dt_name):
+    """
+    Builds the fingerprint index of dt_name_new.csv (located in /tmp)
+    and saves it as dt_name_new.idx in /tmp.
+    Returns the index file name, or None if the primary keys are not integers.
+    """
+    rows = read_csv_rows(f"/tmp/{dt_name}_new.csv")
+    key = primary_key_index(next(rows), dt_name)
+    keys = array.array("q")
+    hashes = array.array("Q")
+    try:
+        for row in rows:
+            keys.append(int(row[key]))
+            hashes.append(row_hash(row))
+    except ValueError:
+        logging.info(f"No fingerprint index for {dt_name}: primary key is not an integer")
+        return None
+
+    filepath = f"{dt_name}_new{FINGERPRINT_INDEX_EXTENSION}"
+    with open(f"/tmp/{filepath}", "wb") as f:
+        f.write(encode_fingerprint_index(keys, hashes))
+    return filepath
+
+
+def get_fingerprint_index(client, bucket, tablename):
+    """
+    Downloads the fingerprint index saved next to the table's snapshot in bucket/source.
+    Returns None if the table has no index yet.
+    """
+    try:
+        res = client.get_object(
+            Bucket=bucket,
+            Key=f"{SOURCE_PATH}{tablename}{SOURCE_FILE_SUFFIX}{FINGERPRINT_INDEX_EXTENSION}",
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "NoSuchKey":
+            return None
+        logging.error(e)
+        raise Exception(f"Can't retrieve fingerprint index due to {e}")
+    return decode_fingerprint_index(res["Body"].read())
+
+
+def compare_with_index(dt_name, prev_index, download_previous):
+    """
+    Compares dt_name_new.csv (located in /tmp) with the fingerprint index of the
+    previous snapshot, so that the previous csv doesn't need to be downloaded
+    unless rows were deleted: download_previous is then called to save it
+    as dt_name.csv in /tmp, and the deleted rows are copied from it.
+    Writes the same differences csv as compare_csvs (with either backend).
+    The fingerprint index of dt_name_new.csv is saved in /tmp as
+    dt_name_new.idx on the way.
+
+    Arg: datatable name (= prefix of csv file name), previous fingerprint index,
+    function downloading the previous snapshot
+
+    Returns:
+    name of the csv file containing all changes to database
+    """
+    prev_index = dict(prev_index)
+    rows = read_csv_rows(f"/tmp/{dt_name}_new.csv")
+    header = next(rows)
+    key = primary_key_index(header, dt_name)
+    keys = array.array("q")
+    hashes = array.array("Q")
+    changes = 0
 
-    # read the header from the CSV file
-    with open(csv_prev, "r", newline="") as csv_file:  # , newline=''
-        csv_reader = csv.reader(csv_file, delimiter=",")
-        header = []
-        for row in csv_reader:
-            header.append(row)
-            break
-
-    diff_output = subprocess.run(
-        ["diff", csv_prev, csv_new], capture_output=True
-    ).stdout
-    differences = subprocess.run(["echo", diff_output], capture_output=True)
-
-    #print(f"\n differences: {differences}")
-    changes_to_table = re.findall(CSV_REGEX, differences.stdout.decode())
-    #print(f"\nCHANGES TO TABLE: {changes_to_table}")
     filepath = f"{dt_name}_differences.csv"
     with open(f"/tmp/{filepath}", "w", newline="") as f:
         csvwriter = csv.writer(f)
-        csvwriter.writerow(header[0])
-        for change in changes_to_table:
-            change_list = [k for k in list(change) if not "" == k]
-            #print(f"\nchange_list: {change_list}")
-            csvwriter.writerow(change_list[0].split(","))
+        csvwriter.writerow(header + [CHANGE_TYPE_COLUMN])
+        for row in rows:
+            pk = int(row[key])
+            new_hash = row_hash(row)
+            keys.append(pk)
+            hashes.append(new_hash)
+            prev_hash = prev_index.pop(pk, None)
+            if prev_hash is None:
+                csvwriter.writerow(row + ["insert"])
+                changes += 1
+            elif prev_hash != new_hash:
+                csvwriter.writerow(row + ["update"])
+                changes += 1
+
+        # keys left in prev_index are no longer in the table
+        if prev_index:
+            download_previous()
+            prev_rows = read_csv_rows(f"/tmp/{dt_name}.csv")
+            next(prev_rows)
+            for row in prev_rows:
+                if int(row[key]) in prev_index:
+                    csvwriter.writerow(row + ["delete"])
+                    changes += 1
 
-    if changes_to_table == "\n":
+    with open(f"/tmp/{dt_name}_new{FINGERPRINT_INDEX_EXTENSION}", "wb") as f:
+        f.write(encode_fingerprint_index(keys, hashes))
+
+    if changes == 0:
         logging.info("No changes in table found")
     else:
-        logging.info("Changes found in table")
+        logging.info(f"{changes} changes found in table")
+
+    return filepath
+
+
+def query_parquet_schema(dt_name, conn):
+    """
+    Returns the Polars schema (column name -> data type) matching the types
+    of the table's columns, used to write typed Parquet files.
+    Numerics declared without precision and scale have no fixed number
+    of decimals, so they are saved as floats.
+    """
+    import polars as pl
+
+    parquet_types = {
+        "smallint": pl.Int16,
+        "integer": pl.Int32,
+        "bigint": pl.Int64,
+        "real": pl.Float32,
+        "double precision": pl.Float64,
+        "boolean": pl.Boolean,
+        "date": pl.Date,
+        "timestamp without time zone": pl.Datetime("us"),
+    }
+    query = (
+        "SELECT column_name, data_type, numeric_precision, numeric_scale "
+        "FROM information_schema.columns "
+        "WHERE table_name = :dt_name ORDER BY ordinal_position;"
+    )
+    schema = {}
+    for column_name, data_type, precision, scale in conn.run(query, dt_name=dt_name):
+        if data_type == "numeric":
+            schema[column_name] = pl.Float64 if scale is None else pl.Decimal(precision, scale)
+        else:
+            schema[column_name] = parquet_types.get(data_type, pl.Utf8)
+    return schema
+
+
+def dataframe_from_rows(data, schema):
+    """
+    Builds a typed DataFrame straight from a query result (header + data rows)
+    """
+    import polars as pl
+
+    return pl.DataFrame(data[1:], schema=schema, orient="row")
+
+
+def concat_frames(frames, schema):
+    """
+    Concatenates typed DataFrames (see dataframe_from_rows) into one,
+    an empty DataFrame with the table's columns when there are none
+    """
+    import polars as pl
+
+    if not frames:
+        return pl.DataFrame(schema=schema)
+    return pl.concat(frames)
+
 
-    return filepath
\ No newline at end of file
+def read_typed_csv(source, schema):
+    """
+    Reads a csv file written by the extract (path or bytes) with the types
+    of the table's columns. Columns missing from schema (change_type) are strings.
+    """
+    import polars as pl
+
+    return pl.read_csv(source, schema_overrides=schema, infer_schema_length=0)
+
+
+def with_change_type(df, change_type):
+    """
+    Adds the change_type column to a DataFrame, with the same value for every row
+    """
+    import polars as pl
+
+    return df.with_columns(pl.lit(change_type).alias(CHANGE_TYPE_COLUMN))
+
+
+def upload_parquets(dfs, client, bucket):
+    """
+    Writes DataFrames as Parquet and uploads them to bucket concurrently
+    (dfs maps each key to its DataFrame)
+    """
+    parquets = {}
+    for key, df in dfs.items():
+        parquet = BytesIO()
+        df.write_parquet(parquet)
+        parquets[key] = parquet.getvalue()
+    try:
+        put_objects(client, bucket, parquets)
+    except ClientError as e:
+        logging.error(e)
+        raise Exception("Failed to upload file")
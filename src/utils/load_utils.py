@@ -0,0 +1,191 @@
+import logging
+from io import BytesIO
+from botocore.exceptions import ClientError
+from pg8000.native import identifier
+from src.utils.cache_utils import cached, lazy_import
+from src.utils.metrics_utils import metrics_table, timed, count
+from src.utils.s3_utils import partition_key
+
+# a run with nothing to load doesn't need Polars
+pl = lazy_import("polars")
+cs = lazy_import("polars.selectors")
+
+WAREHOUSE_SECRET_PREFIX = "totesys-data-warehouse-credentials-"
+STAGING_PREFIX = "stg_"
+LEDGER_TABLE = "load_ledger"
+COPY_BATCH_ROWS = 20000
+# dimensions are loaded before the facts referencing them
+WAREHOUSE_TABLES = [
+    "dim_date",
+    "dim_staff",
+    "dim_location",
+    "dim_design",
+    "dim_currency",
+    "dim_counterparty",
+    "fact_sales_order",
+]
+DIMENSION_KEYS = {
+    "dim_date": "date_id",
+    "dim_staff": "staff_id",
+    "dim_location": "location_id",
+    "dim_design": "design_id",
+    "dim_currency": "currency_id",
+    "dim_counterparty": "counterparty_id",
+}
+
+
+def find_processed_bucket(client):
+    """
+    Searches for the processed data bucket within an AWS account and returns its
+    name, or raises exception if the bucket is not found.
+    The bucket name is cached and reused by warm invocations.
+    """
+    def find_bucket():
+        buckets = client.list_buckets()
+        for bucket in buckets["Buckets"]:
+            if bucket["Name"].startswith("totesys-processed-data-"):
+                return bucket["Name"]
+        logging.error("No processed data bucket found")
+        raise Exception("No processed data bucket found")
+
+    return cached(("bucket", "totesys-processed-data-"), find_bucket)
+
+
+def get_star_schema_table(table, prefix, s3_client, processed_data_bucket):
+    """
+    Reads the rows of a star schema table saved by the transform run at prefix:
+    the file of the run in the partitioned dataset of the table is read directly
+    (/table=table/year=yyyy/month=mm/day=dd/hh:mm:ss.parquet in the processed
+    data bucket), without listing or scanning the rest of the history.
+
+    Returns:
+        DataFrame of the rows, or None if the run didn't change the table
+    """
+    try:
+        response = s3_client.get_object(
+            Bucket=processed_data_bucket, Key=partition_key("/", table, prefix)
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "NoSuchKey":
+            return None
+        raise
+    parquet = response["Body"].read()
+    count("downloaded_bytes", len(parquet), "Bytes")
+    return pl.read_parquet(BytesIO(parquet))
+
+
+def dataframe_to_csv(df, batch_rows=COPY_BATCH_ROWS):
+    """
+    Yields df as headerless csv chunks of batch_rows rows, streamed to COPY.
+    Each chunk is sent as one message (pg8000 sends file objects in 8KB
+    messages) and is only encoded once the previous one was sent, so the
+    whole csv is never held in memory.
+    Missing values are written as empty unquoted fields, which COPY reads as NULL
+    (decimals are written as text first: Polars quotes their missing values).
+    """
+    df = df.with_columns(cs.decimal().cast(pl.Utf8))
+    for offset in range(0, df.height, batch_rows):
+        yield df.slice(offset, batch_rows).write_csv(include_header=False).encode()
+
+
+def load_table(conn, table, df):
+    """
+    Bulk loads df into a warehouse table: the rows are streamed with
+    COPY FROM STDIN into a temporary table with the same columns, then merged
+    into the table with a single statement: dimension rows replace the rows
+    with the same key (INSERT ... ON CONFLICT, rows that didn't change are left
+    untouched), fact rows are appended so facts keep the full history
+    (load_star_schema makes sure a run is only loaded once).
+    Must be called inside a transaction (the staging table is dropped on commit
+    if the merge doesn't happen).
+
+    Returns:
+        int: number of rows inserted or updated
+    """
+    staging = identifier(STAGING_PREFIX + table)
+    target = identifier(table)
+    columns = ", ".join(identifier(column) for column in df.columns)
+
+    conn.run(
+        f"CREATE TEMPORARY TABLE {staging} ON COMMIT DROP "
+        f"AS SELECT {columns} FROM {target} WITH NO DATA"
+    )
+    conn.run(
+        f"COPY {staging} ({columns}) FROM STDIN WITH (FORMAT csv)",
+        stream=dataframe_to_csv(df),
+    )
+
+    merge = f"INSERT INTO {target} ({columns}) SELECT {columns} FROM {staging}"
+    if table in DIMENSION_KEYS:
+        key = DIMENSION_KEYS[table]
+        values = [identifier(column) for column in df.columns if column != key]
+        updates = ", ".join(f"{value} = EXCLUDED.{value}" for value in values)
+        current = ", ".join(f"{target}.{value}" for value in values)
+        excluded = ", ".join(f"EXCLUDED.{value}" for value in values)
+        merge += (
+            f" ON CONFLICT ({identifier(key)}) DO UPDATE SET {updates}"
+            f" WHERE ({current}) IS DISTINCT FROM ({excluded})"
+        )
+    conn.run(merge)
+    row_count = conn.row_count
+    conn.run(f"DROP TABLE {staging}")
+    return row_count
+
+
+def record_load(conn, prefix):
+    """
+    Adds the transform run saved at prefix to the load ledger.
+    Must be called inside the transaction loading the run: if another
+    invocation is loading the same run, this waits for it to finish.
+
+    Returns:
+        bool: False if the run was already loaded
+    """
+    conn.run(
+        f"INSERT INTO {LEDGER_TABLE} (time_prefix) VALUES (:prefix) "
+        "ON CONFLICT (time_prefix) DO NOTHING",
+        prefix=prefix,
+    )
+    return conn.row_count == 1
+
+
+def load_star_schema(conn, s3_client, processed_data_bucket, prefix):
+    """
+    Loads every star schema table saved by the transform run at prefix into the
+    warehouse, in a single transaction: either the whole run is loaded or none of it.
+    The run is recorded in the load ledger in the same transaction, so loading
+    a run again (e.g. when the step function retries) changes nothing.
+
+    Returns:
+        dict: number of rows loaded into each table changed by the run,
+        or None if the run was already loaded
+    """
+    loaded = {}
+    conn.run("START TRANSACTION")
+    try:
+        if not record_load(conn, prefix):
+            conn.run("ROLLBACK")
+            logging.info(f"Run {prefix} was already loaded")
+            return None
+        for table in WAREHOUSE_TABLES:
+            with metrics_table(table):
+                with timed("download"):
+                    df = get_star_schema_table(table, prefix, s3_client, processed_data_bucket)
+                if df is None or df.height == 0:
+                    continue
+                with timed("copy"):
+                    loaded[table] = load_table(conn, table, df)
+                count("rows", df.height)
+                count("changed_rows", loaded[table])
+            logging.info(f"Loaded {loaded[table]} rows into {table}")
+        conn.run(
+            f"UPDATE {LEDGER_TABLE} SET row_count = :row_count "
+            "WHERE time_prefix = :prefix",
+            row_count=sum(loaded.values()),
+            prefix=prefix,
+        )
+        conn.run("COMMIT")
+    except Exception:
+        conn.run("ROLLBACK")
+        raise
+    return loaded
@@ -0,0 +1,157 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+"""
+Metrics of a lambda invocation, written as CloudWatch Embedded Metric Format
+(EMF) log lines: CloudWatch turns them into metrics (namespace METRICS_NAMESPACE,
+dimensions stage and table) without any API call from the lambda.
+
+A handler starts recording with start_metrics once it knows its time_path and
+writes the metrics with flush_metrics before returning. In between, the
+functions it calls time their steps (timed) and count rows and bytes (count);
+what they record is attributed to the table set with metrics_table in the
+current thread (the S3 helpers count the bytes transferred that way).
+Nothing is recorded outside of a handler, so the functions can be used
+on their own.
+"""
+
+DEFAULT_NAMESPACE = "Totesys/Pipeline"
+ALL_TABLES = "all"
+TIME_SUFFIX = "_time"
+
+current = None
+current_lock = threading.Lock()
+local = threading.local()
+
+
+class Metrics:
+    """
+    Metrics recorded by a stage (extract, transform or load) of the pipeline
+    run saved under time_path: for each table, the sum of each metric
+    and its unit.
+    """
+
+    def __init__(self, stage, time_path=None):
+        self.stage = stage
+        self.time_path = time_path
+        self.start = time.perf_counter()
+        self.tables = {}
+        self.lock = threading.Lock()
+
+    def add(self, table, name, value, unit):
+        with self.lock:
+            metrics = self.tables.setdefault(table, {})
+            total, _ = metrics.get(name, (0, unit))
+            metrics[name] = (total + value, unit)
+
+    def records(self, namespace=None):
+        """
+        Returns the EMF record of each table
+        """
+        namespace = namespace or os.getenv("METRICS_NAMESPACE", DEFAULT_NAMESPACE)
+        timestamp = int(time.time() * 1000)
+        records = []
+        with self.lock:
+            for table, metrics in self.tables.items():
+                record = {
+                    "_aws": {
+                        "Timestamp": timestamp,
+                        "CloudWatchMetrics": [{
+                            "Namespace": namespace,
+                            "Dimensions": [["stage", "table"]],
+                            "Metrics": [
+                                {"Name": name, "Unit": unit}
+                                for name, (_, unit) in metrics.items()
+                            ],
+                        }],
+                    },
+                    "stage": self.stage,
+                    "table": table,
+                    "time_path": self.time_path,
+                }
+                for name, (value, _) in metrics.items():
+                    record[name] = round(value, 3) if isinstance(value, float) else value
+                records.append(record)
+        return records
+
+
+def start_metrics(stage, time_path=None):
+    """
+    Starts recording the metrics of a stage of the pipeline run saved under time_path
+    """
+    global current
+    with current_lock:
+        current = Metrics(stage, time_path)
+    return current
+
+
+def flush_metrics():
+    """
+    Writes the metrics recorded since start_metrics to stdout, one EMF line per
+    table (plus the duration of the whole stage under the "all" table),
+    and stops recording.
+
+    Returns:
+        list: the EMF records written
+    """
+    global current
+    with current_lock:
+        metrics, current = current, None
+    if metrics is None:
+        return []
+    metrics.add(
+        ALL_TABLES, f"duration{TIME_SUFFIX}",
+        (time.perf_counter() - metrics.start) * 1000, "Milliseconds",
+    )
+    records = metrics.records()
+    for record in records:
+        # EMF lines must be written as they are, without the logging prefix
+        print(json.dumps(record), flush=True)
+    return records
+
+
+@contextmanager
+def metrics_table(table):
+    """
+    Attributes the metrics recorded in the block by the current thread to table
+    """
+    previous = getattr(local, "table", None)
+    local.table = table
+    try:
+        yield
+    finally:
+        local.table = previous
+
+
+def run_for_table(table, function, *args):
+    """
+    Calls function(*args) (e.g. in a worker thread) with its metrics attributed
+    to table, and records how long the table took
+    """
+    with metrics_table(table), timed("table"):
+        return function(*args)
+
+
+def count(name, value, unit="Count"):
+    """
+    Adds value to the metric name of the current table
+    """
+    metrics = current
+    if metrics is not None:
+        metrics.add(getattr(local, "table", None) or ALL_TABLES, name, value, unit)
+
+
+@contextmanager
+def timed(step):
+    """
+    Adds the wall time of the block (milliseconds) to the step_time metric
+    of the current table, also when the block raises
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        count(f"{step}{TIME_SUFFIX}", (time.perf_counter() - start) * 1000, "Milliseconds")
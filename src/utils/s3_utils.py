@@ -0,0 +1,406 @@
+import logging
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from src.utils.cache_utils import get_client
+from src.utils.metrics_utils import count
+
+"""
+S3 helpers shared by the lambda functions: every transfer goes through the
+same client, and the bulk helpers send their requests concurrently instead
+of waiting for each round trip in turn.
+"""
+
+MULTIPART_CHUNK_SIZE = 8 * 1024 * 1024  # S3 parts must be at least 5 MiB (apart from the last one)
+# threads used by a single upload_file or download_file (one part each)
+TRANSFER_CONCURRENCY = 4
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=MULTIPART_CHUNK_SIZE,
+    multipart_chunksize=MULTIPART_CHUNK_SIZE,
+    max_concurrency=TRANSFER_CONCURRENCY,
+)
+# objects transferred at once by the bulk helpers
+BULK_CONCURRENCY = 8
+# enough for the tables of a lambda function transferring their files at once
+MAX_POOL_CONNECTIONS = 50
+MISSING_ERROR_CODES = {"404", "NoSuchKey"}
+# key suffix of the objects saved with each compression
+COMPRESSION_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+# suffixes an object can be saved with (see read_suffixes)
+READ_SUFFIXES = ["", ".gz", ".zst"]
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+FILE_CHUNK_SIZE = 1024 * 1024
+
+
+def get_s3_client():
+    """
+    Returns the S3 client shared by every invocation of the container,
+    with a connection pool large enough for concurrent transfers
+    """
+    return get_client("s3", max_pool_connections=MAX_POOL_CONNECTIONS)
+
+
+def is_missing(error):
+    """
+    Returns True if a ClientError shows that the object doesn't exist
+    """
+    return error.response["Error"]["Code"] in MISSING_ERROR_CODES
+
+
+def compression_suffix(compression):
+    """
+    Returns the key suffix of the objects saved with compression
+    ("gzip", "zstd", or None / "none" for no compression)
+    """
+    if compression is None or compression == "none":
+        return ""
+    if compression not in COMPRESSION_SUFFIXES:
+        logging.error(f"Unknown compression: {compression}")
+        raise Exception(f"Unknown compression: {compression}")
+    return COMPRESSION_SUFFIXES[compression]
+
+
+def compressor(compression):
+    """
+    Returns an object compressing data incrementally (compress() and flush()),
+    or None for no compression
+    """
+    suffix = compression_suffix(compression)
+    if suffix == ".gz":
+        return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if suffix == ".zst":
+        import zstandard  # only needed with zstd compression
+
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    return None
+
+
+def decompressor(suffix):
+    """
+    Returns an object decompressing data incrementally (decompress()),
+    for an object saved with suffix
+    """
+    if suffix == ".gz":
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    import zstandard  # only needed with zstd compression
+
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+def compress(data, compression):
+    """
+    Returns data compressed with compression
+    """
+    codec = compressor(compression)
+    if codec is None:
+        return data
+    return codec.compress(data) + codec.flush()
+
+
+def decompress(data, suffix):
+    """
+    Returns the content of an object saved with suffix
+    """
+    if not suffix:
+        return data
+    return decompressor(suffix).decompress(data)
+
+
+def compress_file(filename, compression):
+    """
+    Writes filename compressed with compression next to it, chunk by chunk.
+
+    Returns:
+        string: name of the compressed file (filename itself with no compression)
+    """
+    codec = compressor(compression)
+    if codec is None:
+        return filename
+    compressed = f"{filename}{compression_suffix(compression)}"
+    with open(filename, "rb") as source, open(compressed, "wb") as destination:
+        while chunk := source.read(FILE_CHUNK_SIZE):
+            destination.write(codec.compress(chunk))
+        destination.write(codec.flush())
+    return compressed
+
+
+def decompress_file(source, destination, suffix):
+    """
+    Writes the content of a file saved with suffix to destination, chunk by chunk
+    """
+    codec = decompressor(suffix)
+    with open(source, "rb") as f_source, open(destination, "wb") as f_destination:
+        while chunk := f_source.read(FILE_CHUNK_SIZE):
+            f_destination.write(codec.decompress(chunk))
+
+
+def partition_key(root, table, prefix):
+    """
+    Returns the key of the file saved for the run at prefix (year/month/day/hh:mm:ss/)
+    in the Hive-partitioned dataset of table under root:
+    root/table=table/year=yyyy/month=mm/day=dd/hh:mm:ss.parquet
+    """
+    year, month, day, time = prefix.strip("/").split("/")
+    return f"{root}table={table}/year={year}/month={month}/day={day}/{time}.parquet"
+
+
+def run_bulk(function, items):
+    """
+    Calls function(key, value) for every item of the dict items, on up to
+    BULK_CONCURRENCY threads. Every call is waited for before the first
+    exception raised (if any) is raised again.
+
+    Returns:
+        dict: result of the call for each key
+    """
+    if len(items) <= 1:
+        return {key: function(key, value) for key, value in items.items()}
+    with ThreadPoolExecutor(max_workers=min(BULK_CONCURRENCY, len(items))) as executor:
+        futures = {
+            key: executor.submit(function, key, value) for key, value in items.items()
+        }
+    return {key: future.result() for key, future in futures.items()}
+
+
+def upload_file(client, bucket, filename, key):
+    """
+    Uploads a local file to bucket/key, in parts sent concurrently
+    when it is larger than MULTIPART_CHUNK_SIZE
+    """
+    client.upload_file(Filename=filename, Bucket=bucket, Key=key, Config=TRANSFER_CONFIG)
+
+
+def download_file(client, bucket, key, filename, missing_ok=False):
+    """
+    Downloads bucket/key to a local file, in parts fetched concurrently
+    when it is larger than MULTIPART_CHUNK_SIZE.
+    With missing_ok, returns False instead of raising if the object doesn't exist.
+    """
+    try:
+        client.download_file(
+            Bucket=bucket, Key=key, Filename=filename, Config=TRANSFER_CONFIG
+        )
+    except ClientError as e:
+        if missing_ok and is_missing(e):
+            return False
+        raise
+    return True
+
+
+def upload_files(client, bucket, files):
+    """
+    Uploads local files concurrently (files maps each key to a file name)
+    """
+    run_bulk(lambda key, filename: upload_file(client, bucket, filename, key), files)
+    count("uploaded_bytes", sum(os.path.getsize(f) for f in files.values()), "Bytes")
+
+
+def download_files(client, bucket, files, missing_ok=False):
+    """
+    Downloads objects concurrently (files maps each key to a file name).
+
+    Returns:
+        dict: for each key, whether the object was downloaded
+        (False when it doesn't exist, with missing_ok)
+    """
+    downloaded = run_bulk(
+        lambda key, filename: download_file(client, bucket, key, filename, missing_ok),
+        files,
+    )
+    count(
+        "downloaded_bytes",
+        sum(os.path.getsize(files[key]) for key, found in downloaded.items() if found),
+        "Bytes",
+    )
+    return downloaded
+
+
+def put_objects(client, bucket, objects):
+    """
+    Puts objects concurrently (objects maps each key to its content)
+
+    Returns:
+        dict: put_object response for each key
+    """
+    responses = run_bulk(
+        lambda key, body: client.put_object(Body=body, Bucket=bucket, Key=key), objects
+    )
+    count("uploaded_bytes", sum(len(body) for body in objects.values()), "Bytes")
+    return responses
+
+
+def get_objects(client, bucket, keys):
+    """
+    Reads objects concurrently.
+
+    Returns:
+        dict: content (bytes) of each key, or None when the object doesn't exist
+    """
+    def get_object(key, _):
+        try:
+            return client.get_object(Bucket=bucket, Key=key)["Body"].read()
+        except ClientError as e:
+            if is_missing(e):
+                return None
+            raise
+
+    objects = run_bulk(get_object, dict.fromkeys(keys))
+    count("downloaded_bytes", sum(len(body) for body in objects.values() if body), "Bytes")
+    return objects
+
+
+def delete_objects(client, bucket, keys):
+    """
+    Deletes keys with a single request (keys that don't exist are ignored)
+    """
+    client.delete_objects(
+        Bucket=bucket,
+        Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True},
+    )
+
+
+def read_suffixes(compression=None):
+    """
+    Returns the suffixes an object can be saved with, starting with the
+    suffix of compression: the others are only looked for when it is missing
+    """
+    suffix = compression_suffix(compression)
+    return [suffix] + [other for other in READ_SUFFIXES if other != suffix]
+
+
+def download_files_decompressed(client, bucket, files, missing_ok=False, compression=None):
+    """
+    Downloads objects saved with or without compression (files maps each key
+    to a file name) and decompresses them to their file: each key is read from
+    key + compression_suffix(compression), and only the keys missing there are
+    looked for with the other suffixes (an object saved before the compression
+    was changed), so that the usual case costs one request per key.
+
+    Returns:
+        dict: for each key, whether the object was downloaded
+        (False when it doesn't exist, with missing_ok)
+    """
+    found = dict.fromkeys(files, False)
+    missing = dict(files)
+    for suffix in read_suffixes(compression):
+        if not missing:
+            break
+        candidates = {f"{key}{suffix}": f"{filename}{suffix}" for key, filename in missing.items()}
+        downloaded = download_files(client, bucket, candidates, missing_ok=True)
+        for key, filename in list(missing.items()):
+            if not downloaded[f"{key}{suffix}"]:
+                continue
+            if suffix:
+                decompress_file(f"{filename}{suffix}", filename, suffix)
+                os.remove(f"{filename}{suffix}")
+            found[key] = True
+            del missing[key]
+    if missing and not missing_ok:
+        key = next(iter(missing))
+        logging.error(f"{key} not found")
+        raise Exception(f"{key} not found")
+    return found
+
+
+def get_object_decompressed(client, bucket, key, compression=None):
+    """
+    Reads an object saved with or without compression: key +
+    compression_suffix(compression) first, then the other suffixes if it is missing.
+
+    Returns:
+        bytes: content of the object, or None if it doesn't exist
+    """
+    for suffix in read_suffixes(compression):
+        data = get_objects(client, bucket, [f"{key}{suffix}"])[f"{key}{suffix}"]
+        if data is not None:
+            return decompress(data, suffix)
+    return None
+
+
+class MultipartUpload:
+    """
+    Writable file-like object that uploads its content to S3 in parts
+    of chunk_size bytes, so that only one part is held in memory.
+    Content smaller than a part is uploaded with a single put_object.
+    With compression ("gzip" or "zstd"), the content is compressed as it is
+    written (the key should end with compression_suffix(compression)).
+    """
+
+    def __init__(
+        self, client, bucket, key, chunk_size=MULTIPART_CHUNK_SIZE, compression=None
+    ):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.parts = []
+        self.size = 0
+        self.upload_id = None
+        self.compressor = compressor(compression)
+
+    def write(self, data):
+        written = len(data)
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self._buffer(data)
+        return written
+
+    def _buffer(self, data):
+        # large writes are cut into parts without copying the whole data first
+        data = memoryview(data)
+        while len(self.buffer) + len(data) >= self.chunk_size:
+            size = self.chunk_size - len(self.buffer)
+            self.buffer += data[:size]
+            data = data[size:]
+            self._upload_part()
+        self.buffer += data
+
+    def flush(self):
+        pass
+
+    def _upload_part(self):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key
+            )["UploadId"]
+        part_number = len(self.parts) + 1
+        res = self.client.upload_part(
+            Body=bytes(self.buffer),
+            Bucket=self.bucket,
+            Key=self.key,
+            PartNumber=part_number,
+            UploadId=self.upload_id,
+        )
+        self.parts.append({"ETag": res["ETag"], "PartNumber": part_number})
+        self.size += len(self.buffer)
+        self.buffer = bytearray()
+
+    def close(self):
+        if self.compressor is not None:
+            self._buffer(self.compressor.flush())
+            self.compressor = None
+        if self.upload_id is None:
+            self.client.put_object(
+                Body=bytes(self.buffer), Bucket=self.bucket, Key=self.key
+            )
+            self.size = len(self.buffer)
+        else:
+            if self.buffer:
+                self._upload_part()
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={"Parts": self.parts},
+            )
+        count("uploaded_bytes", self.size, "Bytes")
+
+    def abort(self):
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+            )
@@ -1,8 +1,74 @@
-import boto3
+import json
 import logging
-from io import StringIO, BytesIO
-import polars as pl
+import os
+from datetime import date, timedelta
+from io import BytesIO
 from botocore.exceptions import ClientError
+from src.utils.cache_utils import cached, invalidate, lazy_import
+from src.utils.metrics_utils import metrics_table, timed, count
+from src.utils.s3_utils import (
+    get_s3_client,
+    upload_files,
+    download_files,
+    download_files_decompressed,
+    get_objects,
+    get_object_decompressed,
+    put_objects,
+    partition_key,
+)
+
+# a run without changes (or failing early) doesn't need Polars
+pl = lazy_import("polars")
+
+SOURCE_PATH = "/source/"
+HISTORY_PATH = "/history/"
+STATE_PATH = "/state/"
+DIFFERENCES_FILE_SUFFIX = "_differences"
+CHANGE_TYPE_COLUMN = "change_type"
+STAR_SCHEMA_SOURCES = [
+    "sales_order",
+    "staff",
+    "department",
+    "address",
+    "design",
+    "currency",
+    "counterparty",
+]
+CURRENCY_NAMES = {
+    "GBP": "British Pound",
+    "USD": "US Dollar",
+    "EUR": "Euro",
+}
+LEGAL_ADDRESS_COLUMNS = {
+    "address_line_1": "counterparty_legal_address_line_1",
+    "address_line_2": "counterparty_legal_address_line_2",
+    "district": "counterparty_legal_district",
+    "city": "counterparty_legal_city",
+    "postal_code": "counterparty_legal_postal_code",
+    "country": "counterparty_legal_country",
+    "phone": "counterparty_legal_phone_number",
+}
+# source tables joined with others to build the dimensions: their latest rows are kept
+STATE_TABLES = ["staff", "department", "counterparty", "address"]
+DIM_DATE_START = "2020-01-01"
+DIM_DATE_END = "2030-12-31"
+TIMESTAMP_COLUMNS = ["created_at", "last_updated"]
+# columns of the totesys tables that aren't strings, besides the timestamps
+# and the *_id columns (integers)
+INTEGER_COLUMNS = ["units_sold", "item_quantity", "company_ac_number", "counterparty_ac_number"]
+FLOAT_COLUMNS = ["unit_price", "item_unit_price", "payment_amount"]
+BOOLEAN_COLUMNS = ["paid"]
+# rows are sorted on the first of these columns present, so that the min/max
+# statistics of the row groups are narrow enough to skip most of them
+SORT_COLUMNS = ["last_updated", "last_updated_date", "date_id"]
+PARQUET_ROW_GROUP_SIZE = 100_000
+PARTITION_INDEX_FILE = "_index.json"
+DATE_COLUMNS = [
+    "created_date",
+    "last_updated_date",
+    "agreed_payment_date",
+    "agreed_delivery_date",
+]
 
 
 def finds_data_buckets():
@@ -10,12 +76,24 @@ def finds_data_buckets():
     This function finds the raw data and processed data buckets on AWS S3.
 
     Contains error handling for if either or both data buckets are missing.
+    The bucket names are cached and reused by warm invocations once both are found.
 
     Returns:
         raw_data_bucket (string): string containing full name of the raw data bucket
         processed_data_bucket (string): string containing full name of the processed data bucket
     """
-    s3_client = boto3.client("s3")
+    try:
+        return cached("data_buckets", find_data_buckets)
+    except LookupError as e:
+        return str(e)
+
+
+def find_data_buckets():
+    """
+    Lists the buckets on AWS S3 and returns the names of the raw data
+    and processed data buckets, raising LookupError if either is missing.
+    """
+    s3_client = get_s3_client()
     buckets = s3_client.list_buckets()
     found_processed = False
     found_raw = False
@@ -32,49 +110,606 @@ def finds_data_buckets():
 
     if not found_raw and not found_processed:
         logging.error("No buckets found")
-        return "No buckets found"
+        raise LookupError("No buckets found")
     elif not found_raw:
         logging.error("No raw data bucket found")
-        return "No raw data bucket found"
+        raise LookupError("No raw data bucket found")
     elif not found_processed:
         logging.error("No processed data bucket found")
-        return "No processed data bucket found"
+        raise LookupError("No processed data bucket found")
 
     return raw_data_bucket, processed_data_bucket
 
 
-def convert_csv_to_parquet(csv):
+def raw_compression():
+    """
+    Returns the compression the extract function saves its csv files with
+    (EXTRACT_COMPRESSION): they are looked for with its suffix first.
+    """
+    return os.getenv("EXTRACT_COMPRESSION", "none").lower()
+
+
+def scan_raw_files(keys, s3_client, raw_data_bucket):
     """
-    This takes in a csv file name, finds this file within the raw data bucket then
-    converts it to a parquet file in buffer storage.
+    Downloads tables saved by the extract function (key.parquet, or key.csv
+    when there is no parquet file) to /tmp and returns them as LazyFrames,
+    so that only the columns used by the star schema are read.
+    The files are downloaded concurrently: the parquet files first, then the
+    csv files of the tables without parquet file (decompressed when they were
+    saved compressed). The columns have the types given by source_type.
 
     Args:
-        csv (string): Name of csv file
+        keys (list): Keys of the files in the raw data bucket, without extension
+        s3_client: boto3 S3 client
+        raw_data_bucket (string): Name of the raw data bucket
+
+    Returns:
+        dict: LazyFrame of each key, or None if its file is not found
+    """
+    frames = dict.fromkeys(keys)
+    missing = list(keys)
+    for extension in [".parquet", ".csv"]:
+        files = {
+            f"{key}{extension}": f"/tmp/{os.path.basename(key)}{extension}"
+            for key in missing
+        }
+        if extension == ".parquet":
+            downloaded = download_files(s3_client, raw_data_bucket, files, missing_ok=True)
+        else:
+            downloaded = download_files_decompressed(
+                s3_client, raw_data_bucket, files, missing_ok=True, compression=raw_compression()
+            )
+        for key in list(missing):
+            if not downloaded[f"{key}{extension}"]:
+                continue
+            filename = files[f"{key}{extension}"]
+            if extension == ".parquet":
+                frames[key] = cast_source_columns(pl.scan_parquet(filename))
+            else:
+                frames[key] = cast_source_columns(pl.scan_csv(filename))
+            missing.remove(key)
+    return frames
+
+
+def read_raw_file(key, s3_client, raw_data_bucket):
+    """
+    Reads a table saved by the extract function (key.parquet, or key.csv when
+    there is no parquet file, decompressed when it was saved compressed) in memory.
+    The columns have the types given by source_type.
+
+    Returns:
+        DataFrame of the table, or None if the file is not found.
+    """
+    parquet = get_objects(s3_client, raw_data_bucket, [f"{key}.parquet"])[f"{key}.parquet"]
+    if parquet is not None:
+        return cast_source_columns(pl.read_parquet(parquet))
+    csv = get_object_decompressed(
+        s3_client, raw_data_bucket, f"{key}.csv", compression=raw_compression()
+    )
+    if csv is None:
+        return None
+    return cast_source_columns(pl.read_csv(csv))
+
+
+def source_type(column):
+    """
+    Returns the type a column of the totesys tables is given by the transform,
+    whatever file it was read from: the types inferred from a csv (or from a
+    csv without rows, all strings) and those of the typed parquet files
+    (Int32, Decimal, ...) differ, and so would the partitions of a table.
+    """
+    if column in TIMESTAMP_COLUMNS:
+        return pl.Datetime("us")
+    if column.endswith("_id") or column in INTEGER_COLUMNS:
+        return pl.Int32
+    if column in FLOAT_COLUMNS:
+        return pl.Float64
+    if column in BOOLEAN_COLUMNS:
+        return pl.Boolean
+    return pl.String
+
+
+def cast_source_columns(frame):
+    """
+    Casts the columns of a table saved by the extract function (DataFrame or
+    LazyFrame) to the types given by source_type. Timestamps and booleans
+    read from csv are parsed.
+    """
+    casts = []
+    for column, dtype in frame.collect_schema().items():
+        target = source_type(column)
+        if dtype == target:
+            continue
+        if dtype == pl.String and target == pl.Datetime("us"):
+            casts.append(pl.col(column).str.to_datetime(time_unit="us"))
+        elif dtype == pl.String and target == pl.Boolean:
+            casts.append(pl.col(column).str.to_lowercase() == "true")
+        else:
+            casts.append(pl.col(column).cast(target))
+    return frame.with_columns(casts)
+
+
+def remove_raw_files(tables):
+    """
+    Removes the files downloaded to /tmp by scan_raw_files for the tables
+    """
+    for table in tables:
+        for name in [f"{table}_new", f"{table}{DIFFERENCES_FILE_SUFFIX}"]:
+            for extension in [".parquet", ".csv"]:
+                if os.path.exists(f"/tmp/{name}{extension}"):
+                    os.remove(f"/tmp/{name}{extension}")
+
+
+def scan_all_differences(tables, prefix, s3_client, raw_data_bucket):
+    """
+    Returns the rows of the tables changed by the extract run saved at prefix
+    (/history/prefix/table_differences) as LazyFrames, with their change_type.
+    The files of the tables are downloaded concurrently.
 
     Returns:
-        parquet (string): This string contains parquet file data converted from csv format.
+        dict: changed rows (LazyFrame) of each table, or None if it didn't change
     """
-    if csv[-4:] != ".csv":
-        return f"{csv} is not a .csv file."
+    keys = {
+        table: f"{HISTORY_PATH}{prefix}{table}{DIFFERENCES_FILE_SUFFIX}"
+        for table in tables
+    }
+    frames = scan_raw_files(list(keys.values()), s3_client, raw_data_bucket)
+    return {table: frames[key] for table, key in keys.items()}
 
-    s3_client = boto3.client("s3")
 
-    raw_data_bucket, _ = finds_data_buckets()
+def state_etag(table, s3_client, processed_data_bucket):
+    """
+    Returns the ETag of the state kept by transform for a table,
+    or None if there is no state yet (without reading the state).
+    """
     try:
-        res = s3_client.get_object(
-            Bucket=raw_data_bucket, Key=f"{csv}"
-        )  # change f string for when we finalise extract structure
-        csv_data = res["Body"].read().decode("utf-8")
-    except ClientError:
-        return "csv file not found"
+        return s3_client.head_object(
+            Bucket=processed_data_bucket, Key=f"{STATE_PATH}{table}.parquet"
+        )["ETag"]
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            return None
+        raise
+
+
+def get_state(table, s3_client, processed_data_bucket):
+    """
+    Returns the state kept by transform for a table (latest rows of a table used
+    to build the dimensions, or the dim_date calendar), saved in the processed
+    data bucket as /state/table.parquet, or None if there is no state yet.
+    The state is cached between warm invocations and read again only when
+    the file was changed by another invocation.
+    """
+    key = f"{STATE_PATH}{table}.parquet"
+    etag = state_etag(table, s3_client, processed_data_bucket)
+    if etag is None:
+        return None
+
+    def read_state():
+        res = s3_client.get_object(Bucket=processed_data_bucket, Key=key)
+        return res["ETag"], pl.read_parquet(res["Body"].read())
+
+    cached_etag, state = cached(("state", table), read_state, ttl=None)
+    if cached_etag != etag:
+        invalidate(("state", table))
+        _, state = cached(("state", table), read_state, ttl=None)
+    return state
+
+
+def save_states(states, s3_client, processed_data_bucket):
+    """
+    Saves the states of tables (states maps each table to its state) to the
+    processed data bucket as /state/table.parquet, uploaded concurrently,
+    and keeps them cached for the next invocation.
+    """
+    parquets = {}
+    for table, state in states.items():
+        parquet = BytesIO()
+        state.write_parquet(parquet)
+        parquets[f"{STATE_PATH}{table}.parquet"] = parquet.getvalue()
+    responses = put_objects(s3_client, processed_data_bucket, parquets)
+
+    for table, state in states.items():
+        etag = responses[f"{STATE_PATH}{table}.parquet"]["ETag"]
+        invalidate(("state", table))
+        cached(("state", table), lambda: (etag, state), ttl=None)
+
+
+def upsert_source_state(state, changes, table):
+    """
+    Applies the changed rows of a table to its state: updated and inserted rows
+    replace the rows with the same primary key, deleted rows are removed.
+    The changed rows are cast to the types of the state.
+
+    Returns:
+        tuple: new state (DataFrame) and changed rows (LazyFrame)
+    """
+    key = f"{table}_id"
+    changes = changes.select(
+        [pl.col(column).cast(dtype) for column, dtype in state.schema.items()]
+        + [CHANGE_TYPE_COLUMN]
+    )
+    changed_rows = changes.collect()
+    state = pl.concat(
+        [
+            state.join(changed_rows.select(key), on=key, how="anti"),
+            changed_rows.filter(pl.col(CHANGE_TYPE_COLUMN) != "delete").drop(
+                CHANGE_TYPE_COLUMN
+            ),
+        ]
+    ).sort(key)
+    return state, changed_rows.lazy()
+
+
+def split_datetime(column, prefix):
+    """
+    Returns the expressions splitting a datetime column into
+    prefix_date and prefix_time columns
+    """
+    return [
+        pl.col(column).dt.date().alias(f"{prefix}_date"),
+        pl.col(column).dt.time().alias(f"{prefix}_time"),
+    ]
+
+
+def build_fact_sales_order(sales_order):
+    """
+    Builds fact_sales_order from the sales_order table: created_at and last_updated
+    are split into dates and times, the agreed dates are parsed as dates.
+    """
+    return sales_order.select(
+        "sales_order_id",
+        *split_datetime("created_at", "created"),
+        *split_datetime("last_updated", "last_updated"),
+        pl.col("staff_id").alias("sales_staff_id"),
+        "counterparty_id",
+        "units_sold",
+        "unit_price",
+        "currency_id",
+        "design_id",
+        pl.col("agreed_payment_date").str.to_date(),
+        pl.col("agreed_delivery_date").str.to_date(),
+        "agreed_delivery_location_id",
+    )
+
+
+def build_dim_staff(staff, department):
+    """
+    Builds dim_staff by joining each member of staff with their department
+    """
+    return staff.join(
+        department.select("department_id", "department_name", "location"),
+        on="department_id",
+        how="left",
+    ).select(
+        "staff_id",
+        "first_name",
+        "last_name",
+        "department_name",
+        "location",
+        "email_address",
+    )
+
+
+def build_dim_location(address):
+    """
+    Builds dim_location from the address table
+    """
+    return address.select(
+        pl.col("address_id").alias("location_id"),
+        "address_line_1",
+        "address_line_2",
+        "district",
+        "city",
+        "postal_code",
+        "country",
+        "phone",
+    )
+
 
-    data_buffer_csv = StringIO(csv_data)
-    df = pl.read_csv(data_buffer_csv)
+def build_dim_design(design):
+    """
+    Builds dim_design from the design table
+    """
+    return design.select("design_id", "design_name", "file_location", "file_name")
+
+
+def build_dim_currency(currency):
+    """
+    Builds dim_currency from the currency table, adding the name of each currency.
+    A currency missing from CURRENCY_NAMES is named after its code
+    (currency_name can't be NULL in the warehouse).
+    """
+    return currency.select(
+        "currency_id",
+        "currency_code",
+        pl.col("currency_code")
+        .replace_strict(CURRENCY_NAMES, default=pl.col("currency_code"), return_dtype=pl.Utf8)
+        .alias("currency_name"),
+    )
+
+
+def build_dim_counterparty(counterparty, address):
+    """
+    Builds dim_counterparty by joining each counterparty with its legal address
+    """
+    legal_address = address.select(
+        pl.col("address_id").alias("legal_address_id"),
+        *[
+            pl.col(column).alias(legal_column)
+            for column, legal_column in LEGAL_ADDRESS_COLUMNS.items()
+        ],
+    )
+    return counterparty.join(legal_address, on="legal_address_id", how="left").select(
+        "counterparty_id",
+        "counterparty_legal_name",
+        *LEGAL_ADDRESS_COLUMNS.values(),
+    )
+
+
+def generate_dim_date(start, end):
+    """
+    Builds the dim_date calendar of every day from start to end (both included)
+
+    Args:
+        start (date): First day of the calendar
+        end (date): Last day of the calendar
+
+    Returns:
+        DataFrame of dim_date
+    """
+    date_id = pl.col("date_id")
+    return pl.DataFrame(
+        {"date_id": pl.date_range(start, end, "1d", eager=True)}
+    ).select(
+        date_id,
+        date_id.dt.year().alias("year"),
+        date_id.dt.month().alias("month"),
+        date_id.dt.day().alias("day"),
+        date_id.dt.weekday().alias("day_of_week"),
+        date_id.dt.strftime("%A").alias("day_name"),
+        date_id.dt.strftime("%B").alias("month_name"),
+        date_id.dt.quarter().alias("quarter"),
+    )
 
-    data_buffer_parquet = BytesIO()
-    parquet = df.write_parquet(data_buffer_parquet)
-    data_buffer_parquet.seek(0)
 
-    parquet = data_buffer_parquet.read()
+def extend_dim_date(calendar, fact_sales_order=None):
+    """
+    Makes sure the dim_date calendar covers every date used by fact_sales_order.
+    A new calendar covers DIM_DATE_START to DIM_DATE_END (environment variables),
+    and is only extended, by whole years, when a fact uses a date outside of it.
+
+    Args:
+        calendar (DataFrame): Current calendar, or None if there is none yet
+        fact_sales_order (LazyFrame): New fact rows, or None
+
+    Returns:
+        tuple: calendar and its new rows (DataFrames)
+    """
+    new_rows = []
+    if calendar is None:
+        start = date.fromisoformat(os.getenv("DIM_DATE_START", DIM_DATE_START))
+        end = date.fromisoformat(os.getenv("DIM_DATE_END", DIM_DATE_END))
+        calendar = generate_dim_date(start, end)
+        new_rows.append(calendar)
+    else:
+        start, end = calendar["date_id"].min(), calendar["date_id"].max()
+
+    if fact_sales_order is not None:
+        used = fact_sales_order.select(
+            pl.min_horizontal([pl.col(column).min() for column in DATE_COLUMNS]).alias("first"),
+            pl.max_horizontal([pl.col(column).max() for column in DATE_COLUMNS]).alias("last"),
+        ).collect()
+        first, last = used["first"][0], used["last"][0]
+        if first is not None and first < start:
+            extension = generate_dim_date(date(first.year, 1, 1), start - timedelta(days=1))
+            new_rows.append(extension)
+            calendar = pl.concat([extension, calendar])
+        if last is not None and last > end:
+            extension = generate_dim_date(end + timedelta(days=1), date(last.year, 12, 31))
+            new_rows.append(extension)
+            calendar = pl.concat([calendar, extension])
+
+    if not new_rows:
+        return calendar, calendar.clear()
+    return calendar, pl.concat(new_rows).sort("date_id")
+
+
+def affected_rows(state, changed_keys):
+    """
+    Returns the rows of state matching any of the changed keys, as a LazyFrame.
+    Each item of changed_keys is a LazyFrame with a single column of state.
+    """
+    matches = []
+    for keys in changed_keys:
+        column = keys.collect_schema().names()[0]
+        matches.append(
+            state.lazy().join(
+                keys.select(pl.col(column).cast(state.schema[column])),
+                on=column,
+                how="semi",
+            )
+        )
+    return pl.concat(matches).unique(maintain_order=True)
+
+
+def build_star_schema(changes, states):
+    """
+    Builds the star schema rows affected by an extract run as lazy Polars queries,
+    so that only the columns used are read: new fact rows for the changed sales
+    orders, and the latest values of the dimension rows whose source rows were
+    inserted or updated. A member of staff is rebuilt when their department
+    changed too, and a counterparty when its legal address changed.
+
+    Args:
+        changes (dict): changed rows (LazyFrame with change_type) of each table
+            in STAR_SCHEMA_SOURCES, or None when the table didn't change
+        states (dict): latest rows (DataFrame) of each table in STATE_TABLES
+
+    Returns:
+        dict: LazyFrame of each star schema table with rows to add or update
+    """
+    upserted = {
+        table: rows.filter(pl.col(CHANGE_TYPE_COLUMN) != "delete").drop(CHANGE_TYPE_COLUMN)
+        for table, rows in changes.items()
+        if rows is not None
+    }
+    tables = {}
+
+    if "sales_order" in upserted:
+        tables["fact_sales_order"] = build_fact_sales_order(upserted["sales_order"])
+
+    changed_staff = []
+    if "staff" in upserted:
+        changed_staff.append(upserted["staff"].select("staff_id"))
+    if "department" in upserted:
+        changed_staff.append(upserted["department"].select("department_id"))
+    if changed_staff:
+        tables["dim_staff"] = build_dim_staff(
+            affected_rows(states["staff"], changed_staff), states["department"].lazy()
+        )
+
+    if "address" in upserted:
+        tables["dim_location"] = build_dim_location(upserted["address"])
+    if "design" in upserted:
+        tables["dim_design"] = build_dim_design(upserted["design"])
+    if "currency" in upserted:
+        tables["dim_currency"] = build_dim_currency(upserted["currency"])
+
+    changed_counterparties = []
+    if "counterparty" in upserted:
+        changed_counterparties.append(upserted["counterparty"].select("counterparty_id"))
+    if "address" in upserted:
+        changed_counterparties.append(
+            upserted["address"].select(pl.col("address_id").alias("legal_address_id"))
+        )
+    if changed_counterparties:
+        tables["dim_counterparty"] = build_dim_counterparty(
+            affected_rows(states["counterparty"], changed_counterparties),
+            states["address"].lazy(),
+        )
+
+    return tables
+
+
+def update_source_states(changes, s3_client, raw_data_bucket, processed_data_bucket):
+    """
+    Applies the changed rows of the tables in STATE_TABLES to their states.
+    A table without state yet starts from its snapshot in /source, and all of
+    its rows are treated as inserted. So does every table in STAR_SCHEMA_SOURCES
+    when none of the states exists yet, so that the first star schema holds
+    the rows extracted before the transform first ran. The changes are updated
+    in place with rows cast to the types of the states.
+
+    Returns:
+        dict: latest rows (DataFrame) of each table in STATE_TABLES, or None
+        if a table to start from its snapshot has none.
+    """
+    states = {
+        table: get_state(table, s3_client, processed_data_bucket)
+        for table in STATE_TABLES
+    }
+    if all(state is None for state in states.values()):
+        bootstrap = STAR_SCHEMA_SOURCES
+    else:
+        bootstrap = [table for table, state in states.items() if state is None]
+    # the snapshots of the tables to bootstrap are downloaded at once
+    snapshot_keys = {table: f"{SOURCE_PATH}{table}_new" for table in bootstrap}
+    snapshots = scan_raw_files(list(snapshot_keys.values()), s3_client, raw_data_bucket)
+
+    for table in bootstrap:
+        snapshot = snapshots[snapshot_keys[table]]
+        if snapshot is None:
+            logging.info(f"No snapshot of {table} found")
+            return None
+        if table in states:
+            states[table] = snapshot.collect()
+            snapshot = states[table].lazy()
+        changes[table] = snapshot.with_columns(pl.lit("insert").alias(CHANGE_TYPE_COLUMN))
+
+    for table in STATE_TABLES:
+        if table not in bootstrap and changes[table] is not None:
+            states[table], changes[table] = upsert_source_state(
+                states[table], changes[table], table
+            )
+    return states
+
+
+def write_star_schema(tables, s3_client, processed_data_bucket, prefix):
+    """
+    Runs the star schema queries together (sources shared by several tables
+    are read once) and writes each table to its partitioned dataset in the
+    processed data bucket (see write_partition). Tables without rows are not saved.
+
+    Returns:
+        list: keys of the parquet files
+    """
+    keys = []
+    with timed("transform"):
+        frames = pl.collect_all(list(tables.values()))
+    for name, df in zip(tables, frames):
+        if df.height == 0:
+            continue
+        keys.append(write_partition(df, s3_client, processed_data_bucket, "/", name, prefix))
+    return keys
+
+
+def partition_stats(df):
+    """
+    Returns the number of rows of df and the min/max values of its date and
+    datetime columns, as saved in the partition indexes
+    """
+    stats = {"rows": df.height, "min": {}, "max": {}}
+    for column, dtype in df.schema.items():
+        if not dtype.is_temporal():
+            continue
+        for bound, value in [("min", df[column].min()), ("max", df[column].max())]:
+            stats[bound][column] = None if value is None else str(value)
+    return stats
+
+
+def update_partition_index(s3_client, bucket, key, stats):
+    """
+    Records the stats of the file saved at key in the index of its partition
+    (_index.json in the same folder), so that readers can pick the files of a
+    day whose rows may match a filter without opening them.
+    Saving a file again (e.g. when a run is retried) replaces its entry.
+    """
+    folder, filename = key.rsplit("/", 1)
+    index_key = f"{folder}/{PARTITION_INDEX_FILE}"
+    index = get_objects(s3_client, bucket, [index_key])[index_key]
+    index = {"files": {}} if index is None else json.loads(index)
+    index["files"][filename] = stats
+    put_objects(s3_client, bucket, {index_key: json.dumps(index, sort_keys=True).encode()})
+
+
+def write_partition(df, s3_client, bucket, root, table, prefix):
+    """
+    Writes the rows of a table saved by the run at prefix to its Hive-partitioned
+    dataset: root/table=table/year=yyyy/month=mm/day=dd/hh:mm:ss.parquet, so that
+    readers (pl.scan_parquet with hive_partitioning, Athena, ...) only list the
+    days they need.
+    The rows are sorted on their last update and written in row groups of
+    PARQUET_ROW_GROUP_SIZE rows with min/max statistics, which lets readers skip
+    row groups, and the file is recorded in the partition index.
+    The parquet file is written to /tmp by Polars, then uploaded in parts.
+
+    Returns:
+        string: key of the parquet file
+    """
+    sort_columns = [column for column in SORT_COLUMNS if column in df.columns]
+    if sort_columns:
+        df = df.sort(sort_columns[0], nulls_last=True)
 
-    return parquet
+    key = partition_key(root, table, prefix)
+    filename = f"/tmp/{table}_partition.parquet"
+    with metrics_table(table), timed("parquet_write"):
+        try:
+            df.write_parquet(filename, row_group_size=PARQUET_ROW_GROUP_SIZE, statistics=True)
+            upload_files(s3_client, bucket, {key: filename})
+        finally:
+            if os.path.exists(filename):
+                os.remove(filename)
+        update_partition_index(s3_client, bucket, key, partition_stats(df))
+        count("rows", df.height)
+    return key
@@ -11,14 +11,58 @@ data "archive_file" "extract_lambda" {
     filename = "src/utils/extract_utils.py"
   }
 
+  source {
+    content  = file("${path.module}/../src/utils/cache_utils.py")
+    filename = "src/utils/cache_utils.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/utils/s3_utils.py")
+    filename = "src/utils/s3_utils.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/utils/metrics_utils.py")
+    filename = "src/utils/metrics_utils.py"
+  }
+
   output_path = "${path.module}/../zip_code/extract.zip"
 }
 
 data "archive_file" "load_lambda" {
   type             = "zip"
   output_file_mode = "0666"
-  source_file      = "${path.module}/../src/lambda_functions/load.py"
-  output_path      = "${path.module}/../zip_code/load.zip"
+  source {
+    content  = file("${path.module}/../src/lambda_functions/load.py")
+    filename = "load.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/utils/load_utils.py")
+    filename = "src/utils/load_utils.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/utils/extract_utils.py")
+    filename = "src/utils/extract_utils.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/utils/cache_utils.py")
+    filename = "src/utils/cache_utils.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/utils/s3_utils.py")
+    filename = "src/utils/s3_utils.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/utils/metrics_utils.py")
+    filename = "src/utils/metrics_utils.py"
+  }
+
+  output_path = "${path.module}/../zip_code/load.zip"
 }
 
 data "archive_file" "transform_lambda" {
@@ -34,6 +78,21 @@ data "archive_file" "transform_lambda" {
     filename = "src/utils/transform_utils.py"
   }
 
+  source {
+    content  = file("${path.module}/../src/utils/cache_utils.py")
+    filename = "src/utils/cache_utils.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/utils/s3_utils.py")
+    filename = "src/utils/s3_utils.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/utils/metrics_utils.py")
+    filename = "src/utils/metrics_utils.py"
+  }
+
   output_path = "${path.module}/../zip_code/transform.zip"
 }
 
@@ -1,11 +1,10 @@
 resource "aws_secretsmanager_secret" "db_credentials_" {
   name_prefix = "totesys-credentials-"
 }
-/*
 resource "aws_secretsmanager_secret" "dw_credentials_" {
   name_prefix = "totesys-data-warehouse-credentials-"
 }
-*/
+
 resource "aws_secretsmanager_secret_version" "db_credentials_" {
   secret_id     = aws_secretsmanager_secret.db_credentials_.id
   secret_string = jsonencode({
@@ -19,17 +18,15 @@ resource "aws_secretsmanager_secret_version" "db_credentials_" {
   depends_on = [aws_secretsmanager_secret.db_credentials_]
 }
 
-/*
 resource "aws_secretsmanager_secret_version" "dw_credentials_" {
   secret_id     = aws_secretsmanager_secret.dw_credentials_.id
   secret_string = jsonencode({
-    DB_USERNAME = var.DW_UN
-    DB_PASSWORD = var.DW_PW
-    DB_NAME     = var.DW_DB
-    DB_HOST     = var.DW_HT
-    DB_PORT     = var.DW_PT
+    user     = var.DW_UN
+    password = var.DW_PW
+    host     = var.DW_HT
+    database = var.DW_DB
+    port     = var.DW_PT
   })
 
   depends_on = [aws_secretsmanager_secret.dw_credentials_]
-}
-*/
\ No newline at end of file
+}
\ No newline at end of file
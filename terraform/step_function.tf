@@ -60,6 +60,12 @@ resource "aws_sfn_state_machine" "sfn_state_machine" {
           "IntervalSeconds": 1,
           "MaxAttempts": 3,
           "BackoffRate": 2
+        },
+        {
+          "ErrorEquals": ["States.TaskFailed"],
+          "IntervalSeconds": 30,
+          "MaxAttempts": 2,
+          "BackoffRate": 2
         }
       ],
       "Catch": [ {
@@ -69,7 +75,8 @@ resource "aws_sfn_state_machine" "sfn_state_machine" {
             "Lambda.SdkClientException",
             "Lambda.TooManyRequestsException",
             "Runtime.HandlerNotFound",
-            "States.Runtime"],
+            "States.Runtime",
+            "States.TaskFailed"],
         "Next": "SnsNotification"
         } 
       ],
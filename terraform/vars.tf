@@ -67,4 +67,34 @@ variable "DB_PT" {
   description = "Database port"
   type        = string
   sensitive   = true
+}
+
+variable "DW_UN" {
+  description = "Data warehouse username"
+  type        = string
+  sensitive   = true
+}
+
+variable "DW_PW" {
+  description = "Data warehouse password"
+  type        = string
+  sensitive   = true
+}
+
+variable "DW_DB" {
+  description = "Data warehouse name"
+  type        = string
+  sensitive   = true
+}
+
+variable "DW_HT" {
+  description = "Data warehouse host"
+  type        = string
+  sensitive   = true
+}
+
+variable "DW_PT" {
+  description = "Data warehouse port"
+  type        = string
+  sensitive   = true
 }
\ No newline at end of file
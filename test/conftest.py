@@ -0,0 +1,10 @@
+import pytest
+from src.utils.cache_utils import invalidate
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    """Cached secrets, bucket names and clients must not leak between tests."""
+    invalidate()
+    yield
+    invalidate()
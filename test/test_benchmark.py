@@ -0,0 +1,197 @@
+import pytest
+import json
+import os
+import subprocess
+import sys
+import time
+import polars as pl
+from src.benchmark.dataset import (
+    table_sizes,
+    generate_table,
+    TABLES,
+)
+from src.benchmark.measure import measure, add_throughput
+from src.benchmark.pipeline import (
+    below_load_target,
+    run_benchmark,
+    save_report,
+    compare_reports,
+    main,
+)
+from src.benchmark.freshness import simulate, latency_percentiles
+from src.benchmark.imports import parse_importtime, handler_imports, handler_report
+
+
+class TestDataset:
+
+    @pytest.mark.it("Large tables follow the scale factor, reference tables grow slowly")
+    def test_table_sizes(self):
+        sizes = table_sizes(1000000)
+
+        assert sizes["sales_order"] == sizes["transaction"] == 1000000
+        assert sizes["purchase_order"] == 500000
+        assert sizes["staff"] == 1000
+        assert table_sizes(1000)["staff"] == 20
+        assert table_sizes(1000)["currency"] == 3
+
+    @pytest.mark.it("Generated rows reference existing rows and are repeatable")
+    def test_generate_table(self):
+        sizes = table_sizes(1000)
+        columns = ["sales_order_id", "created_at", "last_updated", "design_id",
+                   "staff_id", "unit_price", "agreed_delivery_date"]
+
+        df = generate_table("sales_order", sizes, columns)
+
+        assert df.columns == columns
+        assert df.height == 1000
+        assert df["sales_order_id"].is_unique().all()
+        assert df["staff_id"].is_between(1, sizes["staff"]).all()
+        assert df["design_id"].is_between(1, sizes["design"]).all()
+        assert df["unit_price"].cast(pl.Float64).is_between(2, 4).all()
+        assert df["agreed_delivery_date"].str.to_date().is_not_null().all()
+        assert df.equals(generate_table("sales_order", sizes, columns))
+
+
+class TestMeasure:
+
+    @pytest.mark.it("A stage is timed and its throughput worked out")
+    def test_measure(self):
+        results = []
+
+        with measure("query_db", "staff", results) as result:
+            time.sleep(0.05)
+            result["rows"] = 100
+        result["bytes"] = 1024 * 1024
+
+        add_throughput(results)
+        assert results == [result]
+        assert result["seconds"] >= 0.05
+        assert result["rows_per_s"] == pytest.approx(100 / result["seconds"], rel=0.01)
+        assert result["mb_per_s"] == pytest.approx(1 / result["seconds"], rel=0.01)
+        assert result["peak_rss_mb"] > 0
+
+    @pytest.mark.it("Loads slower than the target rows/s are reported")
+    def test_below_load_target(self):
+        report = {"results": [
+            {"stage": "load_table", "table": "fact_sales_order", "rows_per_s": 250000.0},
+            {"stage": "load_table", "table": "fact_sales_order", "rows_per_s": 50000.0},
+            {"stage": "query_db", "table": "staff", "rows_per_s": 10.0},
+        ]}
+
+        assert below_load_target(report) == [report["results"][1]]
+
+    @pytest.mark.it("Stages slower than the threshold are reported as regressions")
+    def test_compare_reports(self):
+        old = {"results": [
+            {"stage": "query_db", "table": "staff", "seconds": 1.0},
+            {"stage": "query_db", "table": "design", "seconds": 1.0},
+        ]}
+        new = {"results": [
+            {"stage": "query_db", "table": "staff", "seconds": 1.5},
+            {"stage": "query_db", "table": "design", "seconds": 1.1},
+            {"stage": "query_db", "table": "address", "seconds": 9.0},
+        ]}
+
+        assert compare_reports(old, new) == [("query_db", "staff", 1.0, 1.5, 1.5)]
+
+
+class TestRunBenchmark:
+
+    @pytest.mark.it("Every stage is measured on each table and saved to JSON")
+    def test_run_benchmark(self, tmp_path):
+        report = run_benchmark(200, churn=0.05, tables=["staff", "sales_order"])
+
+        assert report["sizes"]["sales_order"] == 200
+        churned = report["churned"]["sales_order"]
+        assert sum(churned.values()) == pytest.approx(200 * 0.05, abs=3)
+        assert churned["update"] > churned["insert"]
+        assert [(r["stage"], r["table"]) for r in report["results"]] == [
+            (stage, table)
+            for table in ["staff", "sales_order"]
+            for stage in [
+                "query_db",
+                "create_and_upload_csv",
+                "compare_csvs[python]",
+                "compare_csvs[polars]",
+                "transform_table",
+            ]
+        ] + [("load_table", "fact_sales_order")]
+        assert report["results"][-1]["rows"] == 200
+        query = report["results"][5]
+        assert query["rows"] == 200
+        assert query["bytes"] > 0 and query["mb_per_s"] > 0
+        assert not os.path.exists("/tmp/sales_order_new.csv")
+
+        filename = save_report(report, str(tmp_path))
+        with open(filename) as f:
+            assert json.load(f) == report
+        assert main(["compare", filename, filename]) == 0
+
+
+class TestFreshness:
+
+    @pytest.mark.it("Latency percentiles are worked out from the fresh changes")
+    def test_latency_percentiles(self):
+        result = latency_percentiles([float(i) for i in range(1, 101)])
+
+        assert result["p50"] == pytest.approx(50.5)
+        assert result["p95"] == pytest.approx(95.05)
+        assert result["p99"] == pytest.approx(99.01)
+        assert result["max"] == 100
+        assert latency_percentiles([3.0])["p99"] == 3.0
+        assert latency_percentiles([])["p50"] is None
+
+    @pytest.mark.it("Source changes are followed into the warehouse through the handlers")
+    def test_simulate(self):
+        report = simulate(scale=200, interval=60, duration=120, rate=30, batch_size=5)
+
+        assert report["changes"] == 60
+        assert report["fresh_changes"] == 60
+        assert report["within_sla"] == 1
+        assert len(report["runs"]) == 2
+        assert set(report["runs"][0]["seconds"]) == {"extract", "transform", "load"}
+        run_seconds = max(sum(run["seconds"].values()) for run in report["runs"])
+        assert 0 < report["latency"]["p50"] <= report["latency"]["p99"]
+        assert report["latency"]["max"] <= 60 + run_seconds
+
+
+class TestImports:
+
+    @pytest.mark.it("The modules imported by a handler are parsed from -X importtime")
+    def test_handler_imports(self):
+        output = "\n".join([
+            "import time: self [us] | cumulative | imported package",
+            "import time:       100 |        100 | site",
+            "import time:        50 |         50 | src",
+            "import time:       300 |        300 |     polars.config",
+            "import time:       200 |        500 |   polars",
+            "import time:        20 |        520 | src.lambda_functions.transform",
+        ])
+
+        imports = handler_imports(parse_importtime(output), "src.lambda_functions.transform")
+
+        assert imports == [
+            ("polars.config", 300, 300, 2),
+            ("polars", 200, 500, 1),
+            ("src.lambda_functions.transform", 20, 520, 0),
+        ]
+
+    @pytest.mark.it("The import time of a handler and its heavy packages are reported")
+    def test_handler_report(self):
+        report = handler_report("src.lambda_functions.extract", repeat=1)
+
+        assert report["import_ms"] > 0
+        assert report["modules"] > 1
+        assert set(report["packages_ms"]) == {"boto3", "pg8000"}
+
+    @pytest.mark.it("The handlers don't import Polars until it is used")
+    def test_handlers_import_polars_lazily(self):
+        result = subprocess.run(
+            [sys.executable, "-c",
+             "import sys, src.lambda_functions.extract, src.lambda_functions.transform, "
+             "src.lambda_functions.load; print('polars' in sys.modules)"],
+            capture_output=True, text=True, check=True,
+            env={**os.environ, "PYTHONPATH": os.getcwd()},
+        )
+
+        assert result.stdout.strip() == "False"
@@ -0,0 +1,127 @@
+import pytest
+import boto3
+import os
+import sys
+from moto import mock_aws
+from unittest.mock import patch, Mock
+from botocore.exceptions import ClientError
+from src.utils.cache_utils import (
+    cached, invalidate, invalidate_on_error, get_client, lazy_import
+)
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    """Mocked AWS Credentials for S3 bucket."""
+    os.environ["AWS_ACCESS_KEY_ID"] = "test"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+    os.environ["AWS_SECURITY_TOKEN"] = "test"
+    os.environ["AWS_SESSION_TOKEN"] = "test"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+def client_error(code):
+    return ClientError({"Error": {"Code": code, "Message": code}}, "operation")
+
+
+class TestCached:
+
+    @pytest.mark.it("Builds the value once and then returns the cached value")
+    def test_cached_value_is_reused(self):
+        factory = Mock(return_value="value")
+
+        assert cached("key", factory) == "value"
+        assert cached("key", factory) == "value"
+        factory.assert_called_once()
+
+    @pytest.mark.it("Builds the value again once it has expired")
+    @patch("src.utils.cache_utils.time")
+    def test_cached_value_expires(self, patched_time):
+        factory = Mock(side_effect=["first", "second"])
+        patched_time.monotonic.return_value = 0
+        assert cached("key", factory, ttl=10) == "first"
+
+        patched_time.monotonic.return_value = 5
+        assert cached("key", factory, ttl=10) == "first"
+
+        patched_time.monotonic.return_value = 11
+        assert cached("key", factory, ttl=10) == "second"
+
+    @pytest.mark.it("Doesn't cache exceptions")
+    def test_exceptions_are_not_cached(self):
+        factory = Mock(side_effect=[Exception("not found"), "value"])
+
+        with pytest.raises(Exception):
+            cached("key", factory)
+        assert cached("key", factory) == "value"
+
+    @pytest.mark.it("Invalidates single keys or the whole cache")
+    def test_invalidate(self):
+        cached("key_1", lambda: 1)
+        cached("key_2", lambda: 2)
+
+        invalidate("key_1")
+        assert cached("key_1", lambda: "new") == "new"
+        assert cached("key_2", lambda: "new") == 2
+
+        invalidate()
+        assert cached("key_2", lambda: "new") == "new"
+
+
+class TestInvalidateOnError:
+
+    @pytest.mark.it("Clears the cache on NoSuchBucket and auth errors")
+    @pytest.mark.parametrize("code", ["NoSuchBucket", "ExpiredToken", "AccessDenied"])
+    def test_stale_client_errors(self, code):
+        cached("key", lambda: "old")
+
+        assert invalidate_on_error(client_error(code))
+        assert cached("key", lambda: "new") == "new"
+
+    @pytest.mark.it("Clears the cache when the database password is rejected")
+    def test_database_auth_error(self):
+        cached("key", lambda: "old")
+
+        assert invalidate_on_error(Exception({"C": "28P01", "M": "password authentication failed"}))
+        assert cached("key", lambda: "new") == "new"
+
+    @pytest.mark.it("Finds the stale error an exception was raised from")
+    def test_wrapped_error(self):
+        cached("key", lambda: "old")
+        try:
+            try:
+                raise client_error("NoSuchBucket")
+            except ClientError:
+                raise Exception("Failed to upload file")
+        except Exception as e:
+            assert invalidate_on_error(e)
+        assert cached("key", lambda: "new") == "new"
+
+    @pytest.mark.it("Keeps the cache on other errors")
+    def test_other_errors(self):
+        cached("key", lambda: "old")
+
+        assert not invalidate_on_error(client_error("NoSuchKey"))
+        assert not invalidate_on_error(ValueError("steve"))
+        assert cached("key", lambda: "new") == "old"
+
+
+class TestGetClient:
+
+    @pytest.mark.it("Returns the same client for the same service and settings")
+    def test_client_is_reused(self, aws_credentials):
+        with mock_aws():
+            assert get_client("s3") is get_client("s3")
+            assert get_client("s3") is not get_client("s3", max_pool_connections=20)
+
+
+class TestLazyImport:
+
+    @pytest.mark.it("Imports the module on first use of one of its attributes")
+    def test_lazy_import(self):
+        sys.modules.pop("colorsys", None)
+        module = lazy_import("colorsys")
+        assert "colorsys" not in sys.modules
+
+        assert module.rgb_to_hsv(1, 0, 0) == (0, 1, 1)
+        assert "colorsys" in sys.modules
@@ -2,10 +2,16 @@ import pytest
 import boto3
 import os
 import json
+import csv
 from moto import mock_aws
 from unittest.mock import patch
 from src.lambda_functions.extract import lambda_handler
+from src.utils.extract_utils import query_db
+import src.utils.extract_utils as extract_utils
+from src.utils.s3_utils import get_s3_client, decompress
 from datetime import datetime as dt
+from io import BytesIO, StringIO
+import polars as pl
 from dotenv import load_dotenv, find_dotenv
 
 env_file = find_dotenv(f'.env.{os.getenv("ENV")}')
@@ -35,6 +41,7 @@ SOURCE_PATH = "/source/"
 SOURCE_FILE_SUFFIX = "_new"
 HISTORY_PATH = "/history/"
 HISTORY_FILE_SUFFIX = "_differences"
+WATERMARK_PATH = "/watermark/"
 MOCK_BUCKET_NAME = "totesys-raw-data-000000"
 
 """
@@ -90,8 +97,8 @@ def s3_wfile_in_source(aws_credentials):
         )
         s3.put_object(
             Body="""staff_id,first_name,last_name,department_id,email_address,created_at,last_updated
-                1,John,Doe,1,john.doe@example.com,2023-08-10 08:00:00,2023-08-10 08:00:00
-                2,Jane,Smith,2,jane.smith@example.com,2023-08-11 09:15:00,2023-08-11 09:15:00""",
+1,John,Doe,1,john.doe@example.com,2023-08-10 08:00:00,2023-08-10 08:00:00
+2,Jane,Smith,2,jane.smith@example.com,2023-08-11 09:15:00,2023-08-11 09:15:00""",
             Bucket=MOCK_BUCKET_NAME,
             Key=f"{SOURCE_PATH}staff{SOURCE_FILE_SUFFIX}.csv",
         )
@@ -207,14 +214,24 @@ class TestLambdaHandler:
             f"{path_history}transaction{HISTORY_FILE_SUFFIX}.csv": 0,
         }
 
+        expected_files_in_watermark = {
+            f"{WATERMARK_PATH}{table}.json": 0
+            for table in [
+                "sales_order", "design", "currency", "staff", "counterparty",
+                "address", "department", "purchase_order", "payment_type",
+                "payment", "transaction",
+            ]
+        }
+
         listing = s3.list_objects_v2(Bucket=MOCK_BUCKET_NAME)
 
-        assert len(listing["Contents"]) == 11 * 2
+        assert len(listing["Contents"]) == 11 * 3
 
         for i in range(len(listing["Contents"])):
             assert (
                 f"{listing['Contents'][i]['Key']}" in expected_files_in_source
                 or f"{listing['Contents'][i]['Key']}" in expected_files_in_history
+                or f"{listing['Contents'][i]['Key']}" in expected_files_in_watermark
             )
 
     # @pytest.mark.skip()
@@ -245,3 +262,329 @@ class TestLambdaHandler:
         tmp_content = [filename for filename in os.listdir("/tmp")]
         assert "staff.csv" not in tmp_content
         assert f"staff{SOURCE_FILE_SUFFIX}.csv" not in tmp_content
+
+    @pytest.mark.it(
+        "Only rows updated after the watermark are saved to /history on the following runs"
+    )
+    @patch("src.utils.extract_utils.dt")
+    def test_incremental_run_saves_only_new_rows(self, patched_dt, s3, secretsmanager):
+        patched_dt.now.return_value = dt(2014, 3, 10)
+        patched_dt.side_effect = lambda *args, **kw: dt(*args, **kw)
+        lambda_handler({}, DummyContext())
+        source_file = s3.get_object(
+            Bucket=MOCK_BUCKET_NAME, Key=f"{SOURCE_PATH}staff{SOURCE_FILE_SUFFIX}.csv"
+        )["Body"].read()
+        # an older latest last_updated makes the table look updated since the first run
+        watermark_file = json.loads(
+            s3.get_object(Bucket=MOCK_BUCKET_NAME, Key=f"{WATERMARK_PATH}staff.json")["Body"].read()
+        )
+        watermark_file["probe"]["max_last_updated"] = "2000-01-01 00:00:00"
+        s3.put_object(
+            Body=json.dumps(watermark_file),
+            Bucket=MOCK_BUCKET_NAME,
+            Key=f"{WATERMARK_PATH}staff.json",
+        )
+
+        patched_dt.now.return_value = dt(2014, 3, 11)
+        lambda_handler({}, DummyContext())
+
+        differences = s3.get_object(
+            Bucket=MOCK_BUCKET_NAME,
+            Key=f"{HISTORY_PATH}2014/03/11/00:00:00/staff{HISTORY_FILE_SUFFIX}.csv",
+        )["Body"].read()
+        assert len(differences.decode().splitlines()) == 1
+        assert (
+            s3.get_object(
+                Bucket=MOCK_BUCKET_NAME,
+                Key=f"{SOURCE_PATH}staff{SOURCE_FILE_SUFFIX}.csv",
+            )["Body"].read()
+            == source_file
+        )
+
+    @pytest.mark.it("Tables that haven't changed since the last run are skipped")
+    @patch("src.utils.extract_utils.dt")
+    def test_unchanged_tables_are_skipped(self, patched_dt, s3, secretsmanager):
+        patched_dt.now.return_value = dt(2014, 3, 10)
+        patched_dt.side_effect = lambda *args, **kw: dt(*args, **kw)
+        lambda_handler({}, DummyContext())
+        first_listing = s3.list_objects(Bucket=MOCK_BUCKET_NAME)["Contents"]
+
+        patched_dt.now.return_value = dt(2014, 3, 11)
+        with patch(
+            "src.lambda_functions.extract.query_db", side_effect=AssertionError("table queried")
+        ):
+            lambda_handler({}, DummyContext())
+
+        listing = s3.list_objects(Bucket=MOCK_BUCKET_NAME)["Contents"]
+        assert [obj["Key"] for obj in listing] == [obj["Key"] for obj in first_listing]
+
+    @pytest.mark.it(
+        "Tables whose probe changed with the same latest last_updated are compared in full"
+    )
+    @patch("src.utils.extract_utils.dt")
+    def test_probe_change_without_newer_rows(self, patched_dt, s3, secretsmanager):
+        patched_dt.now.return_value = dt(2014, 3, 10)
+        patched_dt.side_effect = lambda *args, **kw: dt(*args, **kw)
+        lambda_handler({}, DummyContext())
+        # a row deleted from the table since the first run: it is still in the
+        # snapshot and counted by the saved probe
+        source_key = f"{SOURCE_PATH}staff{SOURCE_FILE_SUFFIX}.csv"
+        rows = list(
+            csv.reader(StringIO(s3.get_object(Bucket=MOCK_BUCKET_NAME, Key=source_key)["Body"].read().decode()))
+        )
+        rows.append(["9999"] + rows[1][1:])
+        body = StringIO()
+        csv.writer(body).writerows(rows)
+        s3.put_object(Body=body.getvalue(), Bucket=MOCK_BUCKET_NAME, Key=source_key)
+        watermark_file = json.loads(
+            s3.get_object(Bucket=MOCK_BUCKET_NAME, Key=f"{WATERMARK_PATH}staff.json")["Body"].read()
+        )
+        watermark_file["probe"]["row_count"] += 1
+        s3.put_object(
+            Body=json.dumps(watermark_file),
+            Bucket=MOCK_BUCKET_NAME,
+            Key=f"{WATERMARK_PATH}staff.json",
+        )
+
+        patched_dt.now.return_value = dt(2014, 3, 11)
+        lambda_handler({}, DummyContext())
+
+        differences = list(
+            csv.reader(
+                StringIO(
+                    s3.get_object(
+                        Bucket=MOCK_BUCKET_NAME,
+                        Key=f"{HISTORY_PATH}2014/03/11/00:00:00/staff{HISTORY_FILE_SUFFIX}.csv",
+                    )["Body"].read().decode()
+                )
+            )
+        )
+        assert len(differences) == 2
+        assert differences[1][0] == "9999"
+        assert differences[1][-1] == "delete"
+        new_probe = json.loads(
+            s3.get_object(Bucket=MOCK_BUCKET_NAME, Key=f"{WATERMARK_PATH}staff.json")["Body"].read()
+        )["probe"]
+        assert new_probe["row_count"] == watermark_file["probe"]["row_count"] - 1
+
+    @pytest.mark.it("Full snapshot can be forced through the event")
+    def test_full_snapshot_ignores_watermark(self, s3_wfile_in_source, secretsmanager):
+        s3_wfile_in_source.put_object(
+            Body='{"last_updated": "2100-01-01 00:00:00"}',
+            Bucket=MOCK_BUCKET_NAME,
+            Key=f"{WATERMARK_PATH}staff.json",
+        )
+        prev_file = s3_wfile_in_source.get_object(
+            Bucket=MOCK_BUCKET_NAME, Key=f"{SOURCE_PATH}staff{SOURCE_FILE_SUFFIX}.csv"
+        )
+
+        lambda_handler({"full_snapshot": True}, DummyContext())
+
+        new_file = s3_wfile_in_source.get_object(
+            Bucket=MOCK_BUCKET_NAME, Key=f"{SOURCE_PATH}staff{SOURCE_FILE_SUFFIX}.csv"
+        )
+        assert new_file["ContentLength"] > prev_file["ContentLength"]
+
+    @pytest.mark.parametrize("mode", ["stream", "copy"])
+    @pytest.mark.it("Streaming and COPY extracts save the same files as the default extract")
+    @patch("src.utils.extract_utils.dt")
+    def test_extract_modes(self, patched_dt, s3, secretsmanager, mode):
+        patched_dt.now.return_value = dt(2014, 3, 10)
+        patched_dt.side_effect = lambda *args, **kw: dt(*args, **kw)
+        lambda_handler({}, DummyContext())
+        expected = {
+            obj["Key"]: s3.get_object(Bucket=MOCK_BUCKET_NAME, Key=obj["Key"])["Body"].read()
+            for obj in s3.list_objects_v2(Bucket=MOCK_BUCKET_NAME)["Contents"]
+        }
+        for key in expected:
+            s3.delete_object(Bucket=MOCK_BUCKET_NAME, Key=key)
+
+        with patch.dict(os.environ, {"EXTRACT_MODE": mode}):
+            lambda_handler({}, DummyContext())
+
+        for key, body in expected.items():
+            result = s3.get_object(Bucket=MOCK_BUCKET_NAME, Key=key)["Body"].read()
+            if key.endswith(".csv"):
+                assert list(csv.reader(result.decode().splitlines())) == list(
+                    csv.reader(body.decode().splitlines())
+                )
+            else:
+                assert result == body
+
+    @pytest.mark.parametrize("compression,suffix", [("gzip", ".gz"), ("zstd", ".zst")])
+    @pytest.mark.parametrize("mode", ["query", "stream", "copy"])
+    @pytest.mark.it("Csv files are saved compressed when enabled")
+    @patch("src.utils.extract_utils.dt")
+    def test_compressed_csv_files(self, patched_dt, s3, secretsmanager, mode, compression, suffix):
+        patched_dt.now.return_value = dt(2014, 3, 10)
+        patched_dt.side_effect = lambda *args, **kw: dt(*args, **kw)
+        lambda_handler({}, DummyContext())
+        expected = {
+            obj["Key"]: s3.get_object(Bucket=MOCK_BUCKET_NAME, Key=obj["Key"])["Body"].read()
+            for obj in s3.list_objects_v2(Bucket=MOCK_BUCKET_NAME)["Contents"]
+        }
+        for key in expected:
+            s3.delete_object(Bucket=MOCK_BUCKET_NAME, Key=key)
+
+        with patch.dict(os.environ, {"EXTRACT_MODE": mode, "EXTRACT_COMPRESSION": compression}):
+            lambda_handler({}, DummyContext())
+
+        for key, body in expected.items():
+            if key.endswith(".csv"):
+                result = s3.get_object(Bucket=MOCK_BUCKET_NAME, Key=f"{key}{suffix}")["Body"].read()
+                assert len(result) < len(body)
+                assert list(csv.reader(decompress(result, suffix).decode().splitlines())) == list(
+                    csv.reader(body.decode().splitlines())
+                )
+
+        # the compressed snapshot is read back by the next run, which replaces it
+        patched_dt.now.return_value = dt(2014, 3, 11)
+        lambda_handler({"full_snapshot": True}, DummyContext())
+
+        keys = [obj["Key"] for obj in s3.list_objects_v2(Bucket=MOCK_BUCKET_NAME)["Contents"]]
+        assert f"{SOURCE_PATH}staff{SOURCE_FILE_SUFFIX}.csv" in keys
+        assert f"{SOURCE_PATH}staff{SOURCE_FILE_SUFFIX}.csv{suffix}" not in keys
+        differences = s3.get_object(
+            Bucket=MOCK_BUCKET_NAME,
+            Key=f"{HISTORY_PATH}2014/03/11/00:00:00/staff{HISTORY_FILE_SUFFIX}.csv",
+        )["Body"].read()
+        assert len(differences.decode().splitlines()) == 1
+
+    @pytest.mark.it("An unknown compression is rejected")
+    def test_unknown_compression(self, s3, secretsmanager):
+        with patch.dict(os.environ, {"EXTRACT_COMPRESSION": "lz4"}):
+            with pytest.raises(Exception, match="Unknown compression: lz4"):
+                lambda_handler({}, DummyContext())
+
+    @pytest.mark.parametrize("mode", ["query", "stream", "copy"])
+    @pytest.mark.it("Typed parquet files are saved next to the csv files when enabled")
+    @patch("src.utils.extract_utils.dt")
+    def test_emits_typed_parquet(self, patched_dt, s3, secretsmanager, mode):
+        patched_dt.now.return_value = dt(2014, 3, 10)
+        patched_dt.side_effect = lambda *args, **kw: dt(*args, **kw)
+        with patch.dict(os.environ, {"EXTRACT_MODE": mode, "EXTRACT_PARQUET": "true"}):
+            lambda_handler({}, DummyContext())
+            patched_dt.now.return_value = dt(2014, 3, 11)
+            lambda_handler({"full_snapshot": True}, DummyContext())
+
+        snapshot = pl.read_parquet(BytesIO(s3.get_object(
+            Bucket=MOCK_BUCKET_NAME, Key=f"{SOURCE_PATH}payment{SOURCE_FILE_SUFFIX}.parquet"
+        )["Body"].read()))
+        first_differences = pl.read_parquet(BytesIO(s3.get_object(
+            Bucket=MOCK_BUCKET_NAME,
+            Key=f"{HISTORY_PATH}2014/03/10/00:00:00/payment{HISTORY_FILE_SUFFIX}.parquet",
+        )["Body"].read()))
+        second_differences = pl.read_parquet(BytesIO(s3.get_object(
+            Bucket=MOCK_BUCKET_NAME,
+            Key=f"{HISTORY_PATH}2014/03/11/00:00:00/payment{HISTORY_FILE_SUFFIX}.parquet",
+        )["Body"].read()))
+        csv_rows = s3.get_object(
+            Bucket=MOCK_BUCKET_NAME, Key=f"{SOURCE_PATH}payment{SOURCE_FILE_SUFFIX}.csv"
+        )["Body"].read().decode().splitlines()
+
+        assert snapshot.height == len(csv_rows) - 1
+        assert snapshot.schema["payment_id"] == pl.Int32
+        assert snapshot.schema["paid"] == pl.Boolean
+        assert snapshot.schema["last_updated"] == pl.Datetime("us")
+        assert snapshot.schema["payment_amount"] == pl.Float64
+        assert first_differences.drop("change_type").equals(snapshot)
+        assert first_differences["change_type"].unique().to_list() == ["insert"]
+        assert second_differences.height == 0
+        assert second_differences.columns == first_differences.columns
+
+    @pytest.mark.it("A typed snapshot is removed once the csv is replaced without parquet")
+    def test_stale_parquet_snapshot_is_removed(self, s3, secretsmanager):
+        parquet_key = f"{SOURCE_PATH}payment{SOURCE_FILE_SUFFIX}.parquet"
+        with patch.dict(os.environ, {"EXTRACT_PARQUET": "true"}):
+            lambda_handler({}, DummyContext())
+        assert s3.head_object(Bucket=MOCK_BUCKET_NAME, Key=parquet_key)
+
+        lambda_handler({"full_snapshot": True}, DummyContext())
+
+        keys = [obj["Key"] for obj in s3.list_objects(Bucket=MOCK_BUCKET_NAME)["Contents"]]
+        assert parquet_key not in keys
+        assert f"{SOURCE_PATH}payment{SOURCE_FILE_SUFFIX}.csv" in keys
+
+    @pytest.mark.it("Raises an exception for an unknown extract mode")
+    def test_unknown_extract_mode(self, s3, secretsmanager):
+        with patch.dict(os.environ, {"EXTRACT_MODE": "steve"}):
+            with pytest.raises(Exception, match="Unknown extract mode"):
+                lambda_handler({}, DummyContext())
+
+    @pytest.mark.it("A failing table doesn't stop the other tables from being extracted")
+    def test_failed_table_is_isolated(self, s3, secretsmanager):
+        real_query_db = query_db
+
+        def failing_query_db(dt_name, conn, watermark=None):
+            if dt_name == "staff":
+                raise ValueError("staff is broken")
+            return real_query_db(dt_name, conn, watermark)
+
+        with patch("src.lambda_functions.extract.query_db", side_effect=failing_query_db):
+            with pytest.raises(Exception, match="staff"):
+                lambda_handler({}, DummyContext())
+
+        keys = [obj["Key"] for obj in s3.list_objects_v2(Bucket=MOCK_BUCKET_NAME)["Contents"]]
+        assert f"{SOURCE_PATH}staff{SOURCE_FILE_SUFFIX}.csv" not in keys
+        assert f"{SOURCE_PATH}design{SOURCE_FILE_SUFFIX}.csv" in keys
+        assert f"{SOURCE_PATH}transaction{SOURCE_FILE_SUFFIX}.csv" in keys
+
+    @pytest.mark.it("A failed streaming upload closes its transaction before the connection is reused")
+    def test_failed_stream_upload_commits(self, s3, secretsmanager):
+        generators = []
+        real_stream_query_db = extract_utils.stream_query_db
+
+        def recording_stream_query_db(dt_name, conn, watermark=None):
+            header, batches = real_stream_query_db(dt_name, conn, watermark)
+            generators.append(batches)
+            return header, batches
+
+        def failing_upload(header, batches, *args):
+            next(batches)
+            raise ValueError("upload failed")
+
+        with patch.dict(os.environ, {"EXTRACT_MODE": "stream"}), patch(
+            "src.lambda_functions.extract.stream_query_db", side_effect=recording_stream_query_db
+        ), patch("src.lambda_functions.extract.stream_and_upload_csv", side_effect=failing_upload):
+            with pytest.raises(Exception):
+                lambda_handler({}, DummyContext())
+
+        assert generators
+        assert all(batches.gi_frame is None for batches in generators)
+
+    @pytest.mark.it("Tables are extracted sequentially with a concurrency of 1")
+    def test_concurrency_of_one(self, s3, secretsmanager):
+        with patch.dict(os.environ, {"EXTRACT_CONCURRENCY": "1"}):
+            lambda_handler({}, DummyContext())
+
+        listing = s3.list_objects_v2(Bucket=MOCK_BUCKET_NAME)
+        assert len(listing["Contents"]) == 11 * 3
+
+    @pytest.mark.it("Database connections are reused by the next invocation when kept")
+    def test_keep_connections(self, s3, secretsmanager):
+        with patch.dict(os.environ, {"EXTRACT_KEEP_CONNECTIONS": "true"}):
+            lambda_handler({}, DummyContext())
+            with patch("src.utils.extract_utils.connect_to_db") as patched_connect:
+                lambda_handler({}, DummyContext())
+
+        patched_connect.assert_not_called()
+        extract_utils.kept_pool.close()
+
+    @pytest.mark.it(
+        "Later full snapshots are compared with the fingerprint index instead of the previous csv"
+    )
+    def test_compares_with_fingerprint_index(self, s3, secretsmanager):
+        lambda_handler({}, DummyContext())
+        lambda_handler({"full_snapshot": True}, DummyContext())
+        index_key = f"{SOURCE_PATH}staff{SOURCE_FILE_SUFFIX}.idx"
+        assert s3.head_object(Bucket=MOCK_BUCKET_NAME, Key=index_key)
+
+        # the handler's S3 client is cached between invocations
+        with patch.object(
+            get_s3_client(),
+            "download_file",
+            side_effect=AssertionError("snapshot downloaded"),
+        ):
+            lambda_handler({"full_snapshot": True}, DummyContext())
+
+        assert "staff_new.idx" not in os.listdir("/tmp")
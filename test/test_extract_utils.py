@@ -4,9 +4,10 @@ import os
 import json
 import csv
 from moto import mock_aws
-from unittest.mock import patch
-from datetime import datetime as dt
+from unittest.mock import patch, Mock
+from datetime import datetime as dt, timedelta
 from src.utils.extract_utils import *
+from pg8000.exceptions import DatabaseError
 from dotenv import load_dotenv, find_dotenv
 
 env_file = find_dotenv(f'.env.{os.getenv("ENV")}')
@@ -80,33 +81,33 @@ def s3_extra_rows(aws_credentials):
         )
         s3.put_object(
             Body="""staff_id,first_name,last_name,department_id,email_address,created_at,last_updated
-        1,John,Doe,1,john.doe@example.com,2023-08-10 08:00:00,2023-08-10 08:00:00
-        2,Jane,Smith,2,jane.smith@example.com,2023-08-11 09:15:00,2023-08-11 09:15:00
-        3,Robert,Johnson,3,robert.johnson@example.com,2023-08-12 10:30:00,2023-08-12 10:30:00
-        4,John,Doe,1,john.doe@example.com,2023-08-10 08:00:00,2023-08-10 08:00:00
-        5,Jane,Smith,2,jane.smith@example.com,2023-08-11 09:15:00,2023-08-11 09:15:00
-        6,Robert,Johnson,3,robert.johnson@example.com,2023-08-12 10:30:00,2023-08-12 10:30:00
-        7,John,Doe,1,john.doe@example.com,2023-08-10 08:00:00,2023-08-10 08:00:00
-        8,Jane,Smith,2,jane.smith@example.com,2023-08-11 09:15:00,2023-08-11 09:15:00
-        9,Robert,Johnson,3,robert.johnson@example.com,2023-08-12 10:30:00,2023-08-12 10:30:00
-        """,
+1,John,Doe,1,john.doe@example.com,2023-08-10 08:00:00,2023-08-10 08:00:00
+2,Jane,Smith,2,jane.smith@example.com,2023-08-11 09:15:00,2023-08-11 09:15:00
+3,Robert,Johnson,3,robert.johnson@example.com,2023-08-12 10:30:00,2023-08-12 10:30:00
+4,John,Doe,1,john.doe@example.com,2023-08-10 08:00:00,2023-08-10 08:00:00
+5,Jane,Smith,2,jane.smith@example.com,2023-08-11 09:15:00,2023-08-11 09:15:00
+6,Robert,Johnson,3,robert.johnson@example.com,2023-08-12 10:30:00,2023-08-12 10:30:00
+7,John,Doe,1,john.doe@example.com,2023-08-10 08:00:00,2023-08-10 08:00:00
+8,Jane,Smith,2,jane.smith@example.com,2023-08-11 09:15:00,2023-08-11 09:15:00
+9,Robert,Johnson,3,robert.johnson@example.com,2023-08-12 10:30:00,2023-08-12 10:30:00
+""",
             Bucket=MOCK_BUCKET_NAME,
             Key="test_csv_extra_rows.csv",
         )
 
         s3.put_object(
             Body="""staff_id,first_name,last_name,department_id,email_address,created_at,last_updated
-        1,John,Doe,1,john.doe@example.com,2023-08-10 08:00:00,2023-08-10 08:00:00
-        2,Jane,Smith,2,jane.smith@example.com,2023-08-11 09:15:00,2023-08-11 09:15:00
-        3,Robert,Johnson,3,robert.johnson@example.com,2023-08-12 10:30:00,2023-08-12 10:30:00
-        4,John,Doe,1,john.doe@example.com,2023-08-10 08:00:00,2023-08-10 08:00:00
-        5,Jane,Smith,2,jane.smith@example.com,2023-08-11 09:15:00,2023-08-11 09:15:00
-        6,Robert,Johnson,3,robert.johnson@example.com,2023-08-12 10:30:00,2023-08-12 10:30:00
-        7,John,Doe,1,john.doe@example.com,2023-08-10 08:00:00,2023-08-10 08:00:00
-        8,Jane,Smith,2,jane.smith@example.com,2023-08-11 09:15:00,2023-08-11 09:15:00
-        9,Robert,Johnson,3,robert.johnson@example.com,2023-08-12 10:30:00,2023-08-12 10:30:00
-        10,Steve,Imposter,1,steve_imposter@nc.com,2023-08-12 10:30:00,2023-08-12 10:30:00
-        11,Stevie,Impostah,1,stevie_impostah@nc.com,2024-08-12 10:30:00,2024-08-12 10:30:00""",
+1,John,Doe,1,john.doe@example.com,2023-08-10 08:00:00,2023-08-10 08:00:00
+2,Jane,Smith,2,jane.smith@example.com,2023-08-11 09:15:00,2023-08-11 09:15:00
+3,Robert,Johnson,3,robert.johnson@example.com,2023-08-12 10:30:00,2023-08-12 10:30:00
+4,John,Doe,1,john.doe@example.com,2023-08-10 08:00:00,2023-08-10 08:00:00
+5,Jane,Smith,2,jane.smith@example.com,2023-08-11 09:15:00,2023-08-11 09:15:00
+6,Robert,Johnson,3,robert.johnson@example.com,2023-08-12 10:30:00,2023-08-12 10:30:00
+7,John,Doe,1,john.doe@example.com,2023-08-10 08:00:00,2023-08-10 08:00:00
+8,Jane,Smith,2,jane.smith@example.com,2023-08-11 09:15:00,2023-08-11 09:15:00
+9,Robert,Johnson,3,robert.johnson@example.com,2023-08-12 10:30:00,2023-08-12 10:30:00
+10,Steve,Imposter,1,steve_imposter@nc.com,2023-08-12 10:30:00,2023-08-12 10:30:00
+11,Stevie,Impostah,1,stevie_impostah@nc.com,2024-08-12 10:30:00,2024-08-12 10:30:00""",
             Bucket=MOCK_BUCKET_NAME,
             Key="test_csv_extra_rows_new.csv",
         )
@@ -127,34 +128,34 @@ def s3_rows_edited(aws_credentials):
         )
         s3.put_object(
             Body="""staff_id,first_name,last_name,department_id,email_address,created_at,last_updated
-        1,John,Doe,1,john.doe@example.com,2023-08-10 08:00:00,2023-08-10 08:00:00
-        2,Jane,Smith,2,jane.smith@example.com,2023-08-11 09:15:00,2023-08-11 09:15:00
-        3,Robert,Johnson,3,robert.johnson@example.com,2023-08-12 10:30:00,2023-08-12 10:30:00
-        4,John,Doe,1,john.doe@example.com,2023-08-10 08:00:00,2023-08-10 08:00:00
-        5,Jane,Smith,2,jane.smith@example.com,2023-08-11 09:15:00,2023-08-11 09:15:00
-        6,Robert,Johnson,3,robert.johnson@example.com,2023-08-12 10:30:00,2023-08-12 10:30:00
-        7,John,Doe,1,john.doe@example.com,2023-08-10 08:00:00,2023-08-10 08:00:00
-        8,Jane,Smith,2,jane.smith@example.com,2023-08-11 09:15:00,2023-08-11 09:15:00
-        9,Robert,Johnson,3,robert.johnson@example.com,2023-08-12 10:30:00,2023-08-12 10:30:00
-        10,Steve,Imposter,1,steve_imposter@nc.com,2023-08-12 10:30:00,2023-08-12 10:30:00
-        11,Stevie,Impostah,1,stevie_impostah@nc.com,2024-08-12 10:30:00,2024-08-12 10:30:00""",
+1,John,Doe,1,john.doe@example.com,2023-08-10 08:00:00,2023-08-10 08:00:00
+2,Jane,Smith,2,jane.smith@example.com,2023-08-11 09:15:00,2023-08-11 09:15:00
+3,Robert,Johnson,3,robert.johnson@example.com,2023-08-12 10:30:00,2023-08-12 10:30:00
+4,John,Doe,1,john.doe@example.com,2023-08-10 08:00:00,2023-08-10 08:00:00
+5,Jane,Smith,2,jane.smith@example.com,2023-08-11 09:15:00,2023-08-11 09:15:00
+6,Robert,Johnson,3,robert.johnson@example.com,2023-08-12 10:30:00,2023-08-12 10:30:00
+7,John,Doe,1,john.doe@example.com,2023-08-10 08:00:00,2023-08-10 08:00:00
+8,Jane,Smith,2,jane.smith@example.com,2023-08-11 09:15:00,2023-08-11 09:15:00
+9,Robert,Johnson,3,robert.johnson@example.com,2023-08-12 10:30:00,2023-08-12 10:30:00
+10,Steve,Imposter,1,steve_imposter@nc.com,2023-08-12 10:30:00,2023-08-12 10:30:00
+11,Stevie,Impostah,1,stevie_impostah@nc.com,2024-08-12 10:30:00,2024-08-12 10:30:00""",
             Bucket=MOCK_BUCKET_NAME,
             Key="test_csv_edited_rows.csv",
         )
 
         s3.put_object(
             Body="""staff_id,first_name,last_name,department_id,email_address,created_at,last_updated
-        1,John,Doe,1,john.doe@this_has_been_edited.com,2023-08-10 08:00:00,2023-08-10 08:00:00
-        2,Jane,Smith,2,jane.smith@example.com,2023-08-11 09:15:00,2023-08-11 09:15:00
-        3,Robert,Johnson,3,robert.johnson@example.com,2023-08-12 10:30:00,2023-08-12 10:30:00
-        4,John,Doe,1,john.doe@example.com,2023-08-10 08:00:00,2023-08-10 08:00:00
-        5,Jane,Smith,2,jane.smith@example.com,2023-08-11 09:15:00,2023-08-11 09:15:00
-        6,Robert,Johnson,3,robert.johnson@example.com,2023-08-12 10:30:00,2023-08-12 10:30:00
-        7,John,Doe,1,john.doe@example.com,2023-08-10 08:00:00,2023-08-10 08:00:00
-        8,Jane,Smith,2,jane.smith@example.com,2023-08-11 09:15:00,2023-08-11 09:15:00
-        9,Robert,Johnson,3,robert.johnson@example.com,2023-08-12 10:30:00,2023-08-12 10:30:00
-        10,Steve,Imposter,1,steve_imposter@nc.com,2023-08-12 10:30:00,2023-08-12 10:30:00
-        11,Stevie,Impostah,1,stevie_impostah@kastriot.com,2024-08-12 10:30:00,2024-08-12 10:30:00""",
+1,John,Doe,1,john.doe@this_has_been_edited.com,2023-08-10 08:00:00,2023-08-10 08:00:00
+2,Jane,Smith,2,jane.smith@example.com,2023-08-11 09:15:00,2023-08-11 09:15:00
+3,Robert,Johnson,3,robert.johnson@example.com,2023-08-12 10:30:00,2023-08-12 10:30:00
+4,John,Doe,1,john.doe@example.com,2023-08-10 08:00:00,2023-08-10 08:00:00
+5,Jane,Smith,2,jane.smith@example.com,2023-08-11 09:15:00,2023-08-11 09:15:00
+6,Robert,Johnson,3,robert.johnson@example.com,2023-08-12 10:30:00,2023-08-12 10:30:00
+7,John,Doe,1,john.doe@example.com,2023-08-10 08:00:00,2023-08-10 08:00:00
+8,Jane,Smith,2,jane.smith@example.com,2023-08-11 09:15:00,2023-08-11 09:15:00
+9,Robert,Johnson,3,robert.johnson@example.com,2023-08-12 10:30:00,2023-08-12 10:30:00
+10,Steve,Imposter,1,steve_imposter@nc.com,2023-08-12 10:30:00,2023-08-12 10:30:00
+11,Stevie,Impostah,1,stevie_impostah@kastriot.com,2024-08-12 10:30:00,2024-08-12 10:30:00""",
             Bucket=MOCK_BUCKET_NAME,
             Key="test_csv_edited_rows_new.csv",
         )
@@ -174,32 +175,32 @@ def s3_no_dt_changes(aws_credentials):
         )
         s3.put_object(
             Body="""staff_id,first_name,last_name,department_id,email_address,created_at,last_updated
-        1,John,Doe,1,john.doe@example.com,2023-08-10 08:00:00,2023-08-10 08:00:00
-        2,Jane,Smith,2,jane.smith@example.com,2023-08-11 09:15:00,2023-08-11 09:15:00
-        3,Robert,Johnson,3,robert.johnson@example.com,2023-08-12 10:30:00,2023-08-12 10:30:00
-        4,John,Doe,1,john.doe@example.com,2023-08-10 08:00:00,2023-08-10 08:00:00
-        5,Jane,Smith,2,jane.smith@example.com,2023-08-11 09:15:00,2023-08-11 09:15:00
-        6,Robert,Johnson,3,robert.johnson@example.com,2023-08-12 10:30:00,2023-08-12 10:30:00
-        7,John,Doe,1,john.doe@example.com,2023-08-10 08:00:00,2023-08-10 08:00:00
-        8,Jane,Smith,2,jane.smith@example.com,2023-08-11 09:15:00,2023-08-11 09:15:00
-        9,Robert,Johnson,3,robert.johnson@example.com,2023-08-12 10:30:00,2023-08-12 10:30:00
-        """,
+1,John,Doe,1,john.doe@example.com,2023-08-10 08:00:00,2023-08-10 08:00:00
+2,Jane,Smith,2,jane.smith@example.com,2023-08-11 09:15:00,2023-08-11 09:15:00
+3,Robert,Johnson,3,robert.johnson@example.com,2023-08-12 10:30:00,2023-08-12 10:30:00
+4,John,Doe,1,john.doe@example.com,2023-08-10 08:00:00,2023-08-10 08:00:00
+5,Jane,Smith,2,jane.smith@example.com,2023-08-11 09:15:00,2023-08-11 09:15:00
+6,Robert,Johnson,3,robert.johnson@example.com,2023-08-12 10:30:00,2023-08-12 10:30:00
+7,John,Doe,1,john.doe@example.com,2023-08-10 08:00:00,2023-08-10 08:00:00
+8,Jane,Smith,2,jane.smith@example.com,2023-08-11 09:15:00,2023-08-11 09:15:00
+9,Robert,Johnson,3,robert.johnson@example.com,2023-08-12 10:30:00,2023-08-12 10:30:00
+""",
             Bucket=MOCK_BUCKET_NAME,
             Key="test_csv_same_content.csv",
         )
 
         s3.put_object(
             Body="""staff_id,first_name,last_name,department_id,email_address,created_at,last_updated
-        1,John,Doe,1,john.doe@example.com,2023-08-10 08:00:00,2023-08-10 08:00:00
-        2,Jane,Smith,2,jane.smith@example.com,2023-08-11 09:15:00,2023-08-11 09:15:00
-        3,Robert,Johnson,3,robert.johnson@example.com,2023-08-12 10:30:00,2023-08-12 10:30:00
-        4,John,Doe,1,john.doe@example.com,2023-08-10 08:00:00,2023-08-10 08:00:00
-        5,Jane,Smith,2,jane.smith@example.com,2023-08-11 09:15:00,2023-08-11 09:15:00
-        6,Robert,Johnson,3,robert.johnson@example.com,2023-08-12 10:30:00,2023-08-12 10:30:00
-        7,John,Doe,1,john.doe@example.com,2023-08-10 08:00:00,2023-08-10 08:00:00
-        8,Jane,Smith,2,jane.smith@example.com,2023-08-11 09:15:00,2023-08-11 09:15:00
-        9,Robert,Johnson,3,robert.johnson@example.com,2023-08-12 10:30:00,2023-08-12 10:30:00
-        """,
+1,John,Doe,1,john.doe@example.com,2023-08-10 08:00:00,2023-08-10 08:00:00
+2,Jane,Smith,2,jane.smith@example.com,2023-08-11 09:15:00,2023-08-11 09:15:00
+3,Robert,Johnson,3,robert.johnson@example.com,2023-08-12 10:30:00,2023-08-12 10:30:00
+4,John,Doe,1,john.doe@example.com,2023-08-10 08:00:00,2023-08-10 08:00:00
+5,Jane,Smith,2,jane.smith@example.com,2023-08-11 09:15:00,2023-08-11 09:15:00
+6,Robert,Johnson,3,robert.johnson@example.com,2023-08-12 10:30:00,2023-08-12 10:30:00
+7,John,Doe,1,john.doe@example.com,2023-08-10 08:00:00,2023-08-10 08:00:00
+8,Jane,Smith,2,jane.smith@example.com,2023-08-11 09:15:00,2023-08-11 09:15:00
+9,Robert,Johnson,3,robert.johnson@example.com,2023-08-12 10:30:00,2023-08-12 10:30:00
+""",
             Bucket=MOCK_BUCKET_NAME,
             Key="test_csv_same_content_new.csv",
         )
@@ -261,6 +262,15 @@ class TestGetSecret:
         assert get_secret()["password"] == PASSWORD
         assert get_secret()["host"] == HOST
 
+    @pytest.mark.it("get secret reuses the cached secret on the following calls")
+    def test_get_secret_is_cached(self, secretsmanager):
+        first = get_secret()
+        for secret in secretsmanager.list_secrets()["SecretList"]:
+            secretsmanager.delete_secret(
+                SecretId=secret["Name"], ForceDeleteWithoutRecovery=True
+            )
+        assert get_secret() == first
+
     @pytest.mark.it(
         "get secret raises an error if secret_name is not in secretsmanager"
     )
@@ -276,6 +286,13 @@ class TestConnectToBucket:
         result = connect_to_bucket(s3_empty_bucket)
         assert result == MOCK_BUCKET_NAME
 
+    @pytest.mark.it("Connect to bucket function reuses the cached bucket name")
+    def test_connect_to_bucket_is_cached(self, s3_empty_bucket):
+        connect_to_bucket(s3_empty_bucket)
+        with patch.object(s3_empty_bucket, "list_buckets") as patched_list:
+            assert connect_to_bucket(s3_empty_bucket) == MOCK_BUCKET_NAME
+            patched_list.assert_not_called()
+
     @pytest.mark.it(
         "Connect to bucket function returns exception when no bucket is found"
     )
@@ -293,6 +310,108 @@ class TestConnectToDB:
         assert type(result) is Connection
 
 
+class TestConnectionPool:
+
+    @pytest.mark.it("Reuses idle connections instead of opening new ones")
+    @patch("src.utils.extract_utils.connect_to_db")
+    def test_pool_reuses_connections(self, patched_connect):
+        pool = ConnectionPool({}, 2)
+        with pool.connection() as conn_1:
+            pass
+        with pool.connection() as conn_2:
+            pass
+
+        assert conn_1 is conn_2
+        patched_connect.assert_called_once()
+
+    @pytest.mark.it("Never opens more connections than its size")
+    @patch("src.utils.extract_utils.connect_to_db")
+    def test_pool_is_bounded(self, patched_connect):
+        pool = ConnectionPool({}, 2)
+        with pool.connection(), pool.connection():
+            assert pool.opened == 2
+            with pytest.raises(Exception):
+                with patch.object(pool.idle, "get", side_effect=Exception("wait")):
+                    pool.get()
+        assert patched_connect.call_count == 2
+
+    @pytest.mark.it("Discards the connection when the block using it fails")
+    @patch("src.utils.extract_utils.connect_to_db")
+    def test_pool_discards_failed_connection(self, patched_connect):
+        pool = ConnectionPool({}, 2)
+        with pytest.raises(ValueError):
+            with pool.connection() as conn:
+                raise ValueError()
+
+        conn.close.assert_called_once()
+        assert pool.opened == 0
+
+    @pytest.mark.it("Closes idle connections")
+    @patch("src.utils.extract_utils.connect_to_db")
+    def test_pool_close(self, patched_connect):
+        pool = ConnectionPool({}, 2)
+        with pool.connection() as conn:
+            pass
+        pool.close()
+
+        conn.close.assert_called_once()
+        assert pool.opened == 0
+
+
+class TestConnectionKeeper:
+
+    @pytest.mark.it("Checks idle connections before reusing them and counts the reuse")
+    @patch("src.utils.extract_utils.PING_AFTER", 0)
+    @patch("src.utils.extract_utils.connect_to_db")
+    def test_healthy_connection_is_reused(self, patched_connect):
+        pool = ConnectionPool({}, 1)
+        with pool.connection() as conn:
+            pass
+        with pool.connection() as reused_conn:
+            pass
+
+        assert reused_conn is conn
+        conn.run.assert_called_once_with("SELECT 1;")
+        assert pool.counters == {"opened": 1, "reused": 1, "reconnected": 0}
+
+    @pytest.mark.it("Reconnects when an idle connection is stale")
+    @patch("src.utils.extract_utils.PING_AFTER", 0)
+    @patch("src.utils.extract_utils.connect_to_db")
+    def test_stale_connection_is_replaced(self, patched_connect):
+        stale_conn, new_conn = Mock(), Mock()
+        stale_conn.run.side_effect = Exception("server closed the connection")
+        patched_connect.side_effect = [stale_conn, new_conn]
+        pool = ConnectionPool({}, 1)
+        with pool.connection():
+            pass
+        with pool.connection() as conn:
+            pass
+
+        assert conn is new_conn
+        stale_conn.close.assert_called_once()
+        assert pool.counters == {"opened": 2, "reused": 0, "reconnected": 1}
+
+    @pytest.mark.it("Doesn't check connections that have just been used")
+    @patch("src.utils.extract_utils.connect_to_db")
+    def test_recent_connection_is_not_checked(self, patched_connect):
+        pool = ConnectionPool({}, 1)
+        with pool.connection() as conn:
+            pass
+        with pool.connection():
+            pass
+
+        conn.run.assert_not_called()
+
+    @pytest.mark.it("Keeps the pool at module scope only when asked to")
+    def test_get_connection_pool(self):
+        credentials = {"user": "steve"}
+
+        assert get_connection_pool(credentials, 2) is not get_connection_pool(credentials, 2)
+        kept_pool = get_connection_pool(credentials, 2, keep=True)
+        assert get_connection_pool(credentials, 2, keep=True) is kept_pool
+        assert get_connection_pool({"user": "stevie"}, 2, keep=True) is not kept_pool
+
+
 class TestQueryDB:
 
     @pytest.mark.it("Return valid csv formatted data (header + table rows)")
@@ -304,6 +423,64 @@ class TestQueryDB:
 
         assert len(result) >= 1
         
+class TestQueryDBIncremental:
+
+    @pytest.mark.it("Returns only the header when no rows are newer than the watermark")
+    def test_db_query_with_watermark_returns_header_only(self, secretsmanager):
+        conn = connect_to_db(get_secret())
+
+        result = query_db("currency", conn, "2100-01-01 00:00:00")
+
+        assert len(result) == 1
+        assert "last_updated" in result[0]
+
+    @pytest.mark.it("Returns rows newer than the watermark")
+    def test_db_query_with_old_watermark_returns_rows(self, secretsmanager):
+        conn = connect_to_db(get_secret())
+
+        result = query_db("currency", conn, "1970-01-01 00:00:00")
+
+        assert len(result) == len(query_db("currency", conn))
+
+    @pytest.mark.it("Reads again the rows updated shortly before the watermark")
+    def test_db_query_with_watermark_reads_lookback_window(self, secretsmanager):
+        conn = connect_to_db(get_secret())
+        latest = conn.run("SELECT max(last_updated) FROM currency;")[0][0]
+        watermark = str(latest + timedelta(minutes=1))
+
+        result = query_db("currency", conn, watermark)
+
+        assert len(result) > 1
+        assert all(row[result[0].index("last_updated")] == latest for row in result[1:])
+
+
+class TestWatermark:
+
+    @pytest.mark.it("Returns None when no watermark has been saved")
+    def test_get_watermark_returns_none_on_first_run(self, s3_empty_bucket):
+        assert get_watermark_file(s3_empty_bucket, MOCK_BUCKET_NAME, "staff") is None
+
+    @pytest.mark.it("Returns the watermark previously saved")
+    def test_save_and_get_watermark(self, s3_empty_bucket):
+        save_watermark(s3_empty_bucket, MOCK_BUCKET_NAME, "staff", "2024-08-12 10:30:00")
+        result = get_watermark_file(s3_empty_bucket, MOCK_BUCKET_NAME, "staff")
+        assert result["last_updated"] == "2024-08-12 10:30:00"
+
+    @pytest.mark.it("Finds the latest last_updated value of the data")
+    def test_find_watermark(self):
+        data = [
+            ["staff_id", "last_updated"],
+            [1, dt(2023, 8, 10, 8)],
+            [2, dt(2024, 8, 12, 10, 30)],
+            [3, dt(2023, 8, 12, 10, 30)],
+        ]
+        assert find_watermark(data) == "2024-08-12 10:30:00"
+
+    @pytest.mark.it("Finds no watermark when data has no rows")
+    def test_find_watermark_no_rows(self):
+        assert find_watermark([["staff_id", "last_updated"]]) is None
+
+
 class TestCreateAndUploadCsv:
 
     @pytest.mark.it(
@@ -355,6 +532,167 @@ class TestCreateAndUploadCsv:
         assert len(csv_path_list) > 0
 
 
+class TestStreamQueryDB:
+
+    @pytest.mark.it("Streams the same rows as query_db in batches")
+    def test_stream_query_db_batches(self, secretsmanager):
+        conn = connect_to_db(get_secret())
+
+        header, batches = stream_query_db("staff", conn, batch_size=2)
+        batches = list(batches)
+
+        assert [header] + [row for batch in batches for row in batch] == query_db("staff", conn)
+        assert all(len(batch) <= 2 for batch in batches)
+
+    @pytest.mark.it("Streams only rows newer than the watermark")
+    def test_stream_query_db_with_watermark(self, secretsmanager):
+        conn = connect_to_db(get_secret())
+
+        _, batches = stream_query_db("staff", conn, "2100-01-01 00:00:00")
+
+        assert list(batches) == []
+
+
+class TestCopyAndUploadCsv:
+
+    @pytest.mark.it("COPY writes the same csv rows as query_db to /tmp")
+    def test_copy_matches_query_db(self, s3_empty_bucket, secretsmanager):
+        conn = connect_to_db(get_secret())
+
+        result = copy_and_upload_csv(
+            "payment", conn, s3_empty_bucket, MOCK_BUCKET_NAME,
+            "2024/01/01/00:00:00/", False
+        )
+
+        expected = query_db("payment", conn)
+        assert result == (len(expected) - 1, find_watermark(expected))
+        with open(f"/tmp/payment{SOURCE_FILE_SUFFIX}.csv", "r", newline="") as f:
+            assert list(csv.reader(f)) == [
+                ["" if value is None else str(value) for value in row] for row in expected
+            ]
+
+    @pytest.mark.it("COPY only copies rows newer than the watermark")
+    def test_copy_with_watermark(self, s3_empty_bucket, secretsmanager):
+        conn = connect_to_db(get_secret())
+
+        result = copy_and_upload_csv(
+            "payment", conn, s3_empty_bucket, MOCK_BUCKET_NAME,
+            "2024/01/01/00:00:00/", False, "2100-01-01 00:00:00"
+        )
+
+        assert result == (0, None)
+
+
+    @pytest.mark.it("COPY writes empty strings the same way as query_db")
+    def test_copy_empty_strings(self, s3_empty_bucket, secretsmanager):
+        conn = connect_to_db(get_secret())
+        conn.run(
+            "CREATE TEMP TABLE copy_empty "
+            "(copy_empty_id int, name varchar, notes text, last_updated timestamp)"
+        )
+        conn.run(
+            "INSERT INTO copy_empty VALUES (1, '', NULL, '2024-01-01'), "
+            "(2, 'Jane', '', '2024-01-02')"
+        )
+
+        copy_and_upload_csv(
+            "copy_empty", conn, s3_empty_bucket, MOCK_BUCKET_NAME,
+            "2024/01/01/00:00:00/", False
+        )
+        with open(f"/tmp/copy_empty{SOURCE_FILE_SUFFIX}.csv", "rb") as f:
+            copied = f.read()
+        create_and_upload_csv(
+            query_db("copy_empty", conn), s3_empty_bucket, MOCK_BUCKET_NAME,
+            "copy_empty", "2024/01/01/00:00:00/", False
+        )
+        # only the line terminators differ (COPY ends lines with \n)
+        with open(f"/tmp/copy_empty{SOURCE_FILE_SUFFIX}.csv", "rb") as f:
+            assert copied == f.read().replace(b"\r\n", b"\n")
+
+    @pytest.mark.it("A failing COPY is rolled back and raises its own error")
+    def test_copy_failure_is_rolled_back(self, s3_empty_bucket, secretsmanager):
+        conn = connect_to_db(get_secret())
+
+        with pytest.raises(DatabaseError, match="timestamp"):
+            copy_and_upload_csv(
+                "payment", conn, s3_empty_bucket, MOCK_BUCKET_NAME,
+                "2024/01/01/00:00:00/", False, "not a timestamp"
+            )
+
+        assert conn.run("SELECT 1;") == [[1]]
+
+    @pytest.mark.it("COPY keeps a copy of the uploaded snapshot in /tmp when asked")
+    def test_copy_keep_csv(self, s3_empty_bucket, secretsmanager):
+        conn = connect_to_db(get_secret())
+
+        copy_and_upload_csv(
+            "payment", conn, s3_empty_bucket, MOCK_BUCKET_NAME,
+            "2024/01/01/00:00:00/", True, keep_csv=True
+        )
+
+        source = s3_empty_bucket.get_object(
+            Bucket=MOCK_BUCKET_NAME, Key=f"{SOURCE_PATH}payment{SOURCE_FILE_SUFFIX}.csv"
+        )["Body"].read()
+        with open(f"/tmp/payment{SOURCE_FILE_SUFFIX}.csv", "rb") as f:
+            assert f.read() == source
+        os.remove(f"/tmp/payment{SOURCE_FILE_SUFFIX}.csv")
+
+class TestStreamAndUploadCsv:
+
+    @pytest.mark.it("Streams batches to both history and source on the first call")
+    def test_stream_first_call(self, s3_empty_bucket):
+        header = ["A", "last_updated"]
+        batches = iter([[[1, dt(2024, 1, 1)], [2, dt(2024, 1, 3)]], [[3, dt(2024, 1, 2)]]])
+
+        result = stream_and_upload_csv(
+            header, batches, s3_empty_bucket, MOCK_BUCKET_NAME,
+            "test_stream", "2024/01/01/00:00:00/", True
+        )
+
+        assert result == (3, "2024-01-03 00:00:00")
+        source = s3_empty_bucket.get_object(
+            Bucket=MOCK_BUCKET_NAME, Key=f"{SOURCE_PATH}test_stream{SOURCE_FILE_SUFFIX}.csv"
+        )["Body"].read().decode()
+        history = s3_empty_bucket.get_object(
+            Bucket=MOCK_BUCKET_NAME,
+            Key=f"{HISTORY_PATH}2024/01/01/00:00:00/test_stream{HISTORY_FILE_SUFFIX}.csv",
+        )["Body"].read().decode()
+        assert list(csv.reader(source.splitlines())) == [
+            ["A", "last_updated"],
+            ["1", "2024-01-01 00:00:00"],
+            ["2", "2024-01-03 00:00:00"],
+            ["3", "2024-01-02 00:00:00"],
+        ]
+        assert list(csv.reader(history.splitlines()))[0] == ["A", "last_updated", "change_type"]
+        assert list(csv.reader(history.splitlines()))[3] == ["3", "2024-01-02 00:00:00", "insert"]
+
+    @pytest.mark.it("Passes every batch to on_batch once it has been written")
+    def test_stream_on_batch(self, s3_empty_bucket):
+        header = ["A", "last_updated"]
+        batches = [[[1, dt(2024, 1, 1)], [2, dt(2024, 1, 3)]], [[3, dt(2024, 1, 2)]]]
+        seen = []
+
+        stream_and_upload_csv(
+            header, iter(batches), s3_empty_bucket, MOCK_BUCKET_NAME,
+            "test_stream", "2024/01/01/00:00:00/", True, on_batch=seen.append
+        )
+
+        assert seen == batches
+
+    @pytest.mark.it("Streams batches to /tmp after the first call")
+    def test_stream_after_first_call(self, s3_empty_bucket):
+        header = ["A", "last_updated"]
+
+        result = stream_and_upload_csv(
+            header, iter([]), s3_empty_bucket, MOCK_BUCKET_NAME,
+            "test_stream", "2024/01/01/00:00:00/", False
+        )
+
+        assert result == (0, None)
+        with open(f"/tmp/test_stream{SOURCE_FILE_SUFFIX}.csv", "r", newline="") as f:
+            assert list(csv.reader(f)) == [header]
+
+
 class TestCompareCsvs:
     # @pytest.mark.skip()
     @pytest.mark.it("""Creates a csv file after comparing two csv files in /tmp/""")
@@ -416,6 +754,7 @@ class TestCompareCsvs:
                     "steve_imposter@nc.com",
                     "2023-08-12 10:30:00",
                     "2023-08-12 10:30:00",
+                    "insert",
                 ],
                 [
                     "11",
@@ -425,6 +764,7 @@ class TestCompareCsvs:
                     "stevie_impostah@nc.com",
                     "2024-08-12 10:30:00",
                     "2024-08-12 10:30:00",
+                    "insert",
                 ],
             ]
 
@@ -495,6 +835,7 @@ class TestCompareCsvs:
                     "john.doe@this_has_been_edited.com",
                     "2023-08-10 08:00:00",
                     "2023-08-10 08:00:00",
+                    "update",
                 ],
                 [
                     "11",
@@ -504,5 +845,359 @@ class TestCompareCsvs:
                     "stevie_impostah@kastriot.com",
                     "2024-08-12 10:30:00",
                     "2024-08-12 10:30:00",
+                    "update",
                 ],
             ]
+
+
+class TestCompareCsvsPrimaryKey:
+
+    @pytest.mark.parametrize("backend", ["python", "polars"])
+    @pytest.mark.it("Marks rows missing from the most recent dt as deleted")
+    def test_deleted_rows(self, backend):
+        with open("/tmp/test_deleted.csv", "w", newline="") as f:
+            csv.writer(f).writerows(
+                [["test_deleted_id", "name"], ["1", "John"], ["2", "Jane"], ["3", "Rob"]]
+            )
+        with open("/tmp/test_deleted_new.csv", "w", newline="") as f:
+            csv.writer(f).writerows([["test_deleted_id", "name"], ["1", "John"]])
+
+        result = compare_csvs("test_deleted", backend)
+
+        with open(f"/tmp/{result}", "r", newline="") as f:
+            assert list(csv.reader(f)) == [
+                ["test_deleted_id", "name", "change_type"],
+                ["2", "Jane", "delete"],
+                ["3", "Rob", "delete"],
+            ]
+
+    @pytest.mark.parametrize("backend", ["python", "polars"])
+    @pytest.mark.it("Keeps quoted commas, quotes and unicode in changed values")
+    def test_special_characters(self, backend):
+        header = ["address_id", "address_line_1", "city"]
+        with open("/tmp/address_special.csv", "w", newline="") as f:
+            csv.writer(f).writerows([header, ["1", "6826 Herzog Via", "Leeds"]])
+        new_rows = [
+            header,
+            ["1", '6826 "Herzog", Via', "Leeds"],
+            ["2", "Flat 2, 1 Main St", "Zürich"],
+        ]
+        with open("/tmp/address_special_new.csv", "w", newline="") as f:
+            csv.writer(f).writerows(new_rows)
+
+        result = compare_csvs("address_special", backend)
+
+        with open(f"/tmp/{result}", "r", newline="", encoding="utf-8") as f:
+            assert list(csv.reader(f)) == [
+                header + ["change_type"],
+                new_rows[1] + ["update"],
+                new_rows[2] + ["insert"],
+            ]
+
+
+    @pytest.mark.parametrize("backend", ["python", "polars"])
+    @pytest.mark.it("Keeps multi-line values and leading spaces in changed values")
+    def test_multi_line_values(self, backend):
+        header = ["address_id", "address_line_1", "city"]
+        with open("/tmp/address_lines.csv", "w", newline="") as f:
+            csv.writer(f).writerows([header, ["1", "6826 Herzog Via", "Leeds"]])
+        new_rows = [
+            header,
+            ["1", "6826 Herzog Via\n  Flat 2", "Leeds"],
+            ["2", "  1 Main St", " York"],
+        ]
+        with open("/tmp/address_lines_new.csv", "w", newline="") as f:
+            csv.writer(f).writerows(new_rows)
+
+        result = compare_csvs("address_lines", backend)
+
+        with open(f"/tmp/{result}", "r", newline="") as f:
+            assert list(csv.reader(f)) == [
+                header + ["change_type"],
+                new_rows[1] + ["update"],
+                new_rows[2] + ["insert"],
+            ]
+
+class TestCompareCsvsPolars:
+
+    @pytest.mark.it("Polars backend writes the same differences file as the python backend")
+    def test_same_output_as_python_backend(self):
+        header = ["staff_id", "first_name", "email_address", "last_updated"]
+        prev_rows = [header] + [
+            [str(i), f"name {i}", f"{i}@nc.com", "2023-08-10 08:00:00"] for i in range(1, 200)
+        ]
+        new_rows = [header] + [
+            [str(i), f"name {i}", f"{i}@nc.com" if i % 7 else "", "2023-08-10 08:00:00"]
+            for i in range(3, 210)
+        ]
+        for backend in ["python", "polars"]:
+            with open("/tmp/staff_backend.csv", "w", newline="") as f:
+                csv.writer(f).writerows(prev_rows)
+            with open("/tmp/staff_backend_new.csv", "w", newline="") as f:
+                csv.writer(f).writerows(new_rows)
+            with open(f"/tmp/{compare_csvs('staff_backend', backend)}", "rb") as f:
+                if backend == "python":
+                    expected = f.read()
+                else:
+                    assert f.read() == expected
+        assert expected.count(b",insert\r\n") == 10
+        assert expected.count(b",update\r\n") == 28
+        assert expected.count(b",delete\r\n") == 2
+
+
+class TestMergeCsvs:
+
+    @pytest.mark.it(
+        """Saves the incremental rows as differences and
+        updates the previous snapshot with them"""
+    )
+    def test_merge_csvs(self):
+        with open("/tmp/test_merge.csv", "w", newline="") as f:
+            csv.writer(f).writerows(
+                [["test_merge_id", "name"], ["1", "John"], ["2", "Jane"], ["3", "Rob"]]
+            )
+        with open("/tmp/test_merge_new.csv", "w", newline="") as f:
+            csv.writer(f).writerows(
+                [["test_merge_id", "name"], ["2", "Janet"], ["4", "Steve"]]
+            )
+
+        result = merge_csvs("test_merge")
+
+        assert result == "test_merge_differences.csv"
+        with open(f"/tmp/{result}", "r", newline="") as f:
+            assert list(csv.reader(f)) == [
+                ["test_merge_id", "name", "change_type"],
+                ["2", "Janet", "update"],
+                ["4", "Steve", "insert"],
+            ]
+        with open("/tmp/test_merge_new.csv", "r", newline="") as f:
+            assert list(csv.reader(f)) == [
+                ["test_merge_id", "name"],
+                ["1", "John"],
+                ["2", "Janet"],
+                ["3", "Rob"],
+                ["4", "Steve"],
+            ]
+
+    @pytest.mark.it("Rows read again without changes are not differences")
+    def test_merge_csvs_skips_unchanged_rows(self):
+        with open("/tmp/test_merge_dup.csv", "w", newline="") as f:
+            csv.writer(f).writerows(
+                [["test_merge_dup_id", "name"], ["1", "John"], ["2", "Jane"]]
+            )
+        with open("/tmp/test_merge_dup_new.csv", "w", newline="") as f:
+            csv.writer(f).writerows(
+                [["test_merge_dup_id", "name"], ["1", "John"], ["2", "Janet"]]
+            )
+
+        result = merge_csvs("test_merge_dup")
+
+        with open(f"/tmp/{result}", "r", newline="") as f:
+            assert list(csv.reader(f)) == [
+                ["test_merge_dup_id", "name", "change_type"],
+                ["2", "Janet", "update"],
+            ]
+        with open("/tmp/test_merge_dup_new.csv", "r", newline="") as f:
+            assert list(csv.reader(f)) == [
+                ["test_merge_dup_id", "name"], ["1", "John"], ["2", "Janet"]
+            ]
+
+    @pytest.mark.it("Leaves the snapshot untouched when there are no incremental rows")
+    def test_merge_csvs_no_changes(self):
+        with open("/tmp/test_merge_empty_new.csv", "w", newline="") as f:
+            csv.writer(f).writerows([["test_merge_empty_id", "name"]])
+
+        result = merge_csvs("test_merge_empty")
+
+        with open(f"/tmp/{result}", "r", newline="") as f:
+            assert list(csv.reader(f)) == [["test_merge_empty_id", "name", "change_type"]]
+        with open("/tmp/test_merge_empty_new.csv", "r", newline="") as f:
+            assert list(csv.reader(f)) == [["test_merge_empty_id", "name"]]
+
+
+class TestFingerprintIndex:
+
+    @pytest.mark.it("Encoded index decodes to the same primary keys and row hashes")
+    def test_round_trip(self):
+        keys = [3, 1, 2]
+        hashes = [row_hash(["3", "a"]), row_hash(["1", "b"]), 2**64 - 1]
+
+        result = decode_fingerprint_index(encode_fingerprint_index(keys, hashes))
+
+        assert list(result.items()) == list(zip(keys, hashes))
+
+    @pytest.mark.it("Index is much smaller than the csv it describes")
+    def test_index_smaller_than_csv(self):
+        with open("/tmp/test_index_new.csv", "w", newline="") as f:
+            csv.writer(f).writerows(
+                [["test_index_id", "name", "email_address", "last_updated"]]
+                + [[str(i), f"name {i}", f"{i}@nc.com", "2023-08-10 08:00:00"] for i in range(5000)]
+            )
+
+        result = write_fingerprint_index("test_index")
+
+        assert result == "test_index_new.idx"
+        assert os.path.getsize(f"/tmp/{result}") * 3 < os.path.getsize("/tmp/test_index_new.csv")
+
+    @pytest.mark.it("No index is built when the primary key is not an integer")
+    def test_no_index_for_text_keys(self):
+        with open("/tmp/test_text_new.csv", "w", newline="") as f:
+            csv.writer(f).writerows([["test_text_id", "name"], ["a", "John"]])
+
+        assert write_fingerprint_index("test_text") is None
+
+    @pytest.mark.it("Returns None when the table has no index yet")
+    def test_get_missing_index(self, s3_empty_bucket):
+        assert get_fingerprint_index(s3_empty_bucket, MOCK_BUCKET_NAME, "staff") is None
+
+    @pytest.mark.it(
+        """Comparing with the index finds the same inserts and updates as the csvs,
+        and deleted rows are copied from the previous snapshot"""
+    )
+    def test_compare_with_index(self, s3_empty_bucket):
+        header = ["test_fp_id", "name"]
+        with open("/tmp/test_fp_new.csv", "w", newline="") as f:
+            csv.writer(f).writerows([header, ["1", "John"], ["2", "Jane"], ["3", "Rob"]])
+        write_fingerprint_index("test_fp")
+        s3_empty_bucket.upload_file(
+            Bucket=MOCK_BUCKET_NAME,
+            Filename="/tmp/test_fp_new.idx",
+            Key=f"{SOURCE_PATH}test_fp{SOURCE_FILE_SUFFIX}.idx",
+        )
+        new_rows = [header, ["1", "John"], ["2", "Janet"], ["4", "Steve"]]
+        with open("/tmp/test_fp_new.csv", "w", newline="") as f:
+            csv.writer(f).writerows(new_rows)
+
+        def download_previous():
+            with open("/tmp/test_fp.csv", "w", newline="") as f:
+                csv.writer(f).writerows([header, ["1", "John"], ["2", "Jane"], ["3", "Rob"]])
+
+        prev_index = get_fingerprint_index(s3_empty_bucket, MOCK_BUCKET_NAME, "test_fp")
+        result = compare_with_index("test_fp", prev_index, download_previous)
+
+        with open(f"/tmp/{result}", "r", newline="") as f:
+            assert list(csv.reader(f)) == [
+                header + ["change_type"],
+                ["2", "Janet", "update"],
+                ["4", "Steve", "insert"],
+                ["3", "Rob", "delete"],
+            ]
+        with open("/tmp/test_fp_new.idx", "rb") as f:
+            assert list(decode_fingerprint_index(f.read())) == [1, 2, 4]
+
+
+    @pytest.mark.it("The previous snapshot is only downloaded when rows were deleted")
+    def test_compare_with_index_without_deletes(self):
+        header = ["test_fp_id", "name"]
+        with open("/tmp/test_fp_new.csv", "w", newline="") as f:
+            csv.writer(f).writerows([header, ["1", "John"]])
+        prev_index = {1: row_hash(["1", "John"])}
+
+        def download_previous():
+            raise AssertionError("previous snapshot downloaded")
+
+        result = compare_with_index("test_fp", prev_index, download_previous)
+
+        with open(f"/tmp/{result}", "r", newline="") as f:
+            assert list(csv.reader(f)) == [header + ["change_type"]]
+
+    @pytest.mark.parametrize("backend", ["python", "polars"])
+    @pytest.mark.it("Comparing with the index writes the same differences file as compare_csvs")
+    def test_index_and_csvs_give_same_differences(self, backend):
+        header = ["test_same_id", "name", "email_address"]
+        prev_rows = [header, ["1", "John", ""], ["2", "Jane", "j@nc.com"], ["3", "Rob", "r@nc.com"]]
+        new_rows = [header, ["1", "John", ""], ["2", "Janet", "j@nc.com"], ["4", "Steve", ""]]
+        with open("/tmp/test_same_new.csv", "w", newline="") as f:
+            csv.writer(f).writerows(prev_rows)
+        write_fingerprint_index("test_same")
+        with open("/tmp/test_same_new.idx", "rb") as f:
+            prev_index = decode_fingerprint_index(f.read())
+
+        def download_previous():
+            with open("/tmp/test_same.csv", "w", newline="") as f:
+                csv.writer(f).writerows(prev_rows)
+
+        with open("/tmp/test_same_new.csv", "w", newline="") as f:
+            csv.writer(f).writerows(new_rows)
+        download_previous()
+        with open(f"/tmp/{compare_csvs('test_same', backend)}", "rb") as f:
+            from_csvs = f.read()
+        os.remove("/tmp/test_same.csv")
+
+        with open(f"/tmp/{compare_with_index('test_same', prev_index, download_previous)}", "rb") as f:
+            assert f.read() == from_csvs
+
+
+class TestProbeTable:
+
+    @pytest.mark.it("Probe holds the latest last_updated value and the row count")
+    def test_probe_table(self, secretsmanager):
+        conn = connect_to_db(get_secret())
+
+        result = probe_table("currency", conn)
+
+        assert result == {
+            "max_last_updated": str(conn.run("SELECT max(last_updated) FROM currency;")[0][0]),
+            "row_count": len(query_db("currency", conn)) - 1,
+        }
+
+    @pytest.mark.it("Probing the same table twice gives the same result, with or without hash")
+    def test_probe_table_is_stable(self, secretsmanager):
+        conn = connect_to_db(get_secret())
+
+        result = probe_table("staff", conn, with_hash=True)
+
+        assert isinstance(result["row_hash"], int)
+        assert result == probe_table("staff", conn, with_hash=True)
+        assert json.loads(json.dumps(result)) == result
+
+    @pytest.mark.it("Probe is saved and read back with the watermark")
+    def test_probe_saved_with_watermark(self, s3_empty_bucket):
+        probe = {"max_last_updated": "2024-08-12 10:30:00", "row_count": 3}
+        save_watermark(s3_empty_bucket, MOCK_BUCKET_NAME, "staff", "2024-08-12 10:30:00", probe)
+
+        result = get_watermark_file(s3_empty_bucket, MOCK_BUCKET_NAME, "staff")
+
+        assert result == {"last_updated": "2024-08-12 10:30:00", "probe": probe}
+
+
+class TestTypedParquet:
+
+    @pytest.mark.it("Parquet schema follows the types of the table's columns")
+    def test_query_parquet_schema(self, secretsmanager):
+        import polars as pl
+
+        conn = connect_to_db(get_secret())
+
+        result = query_parquet_schema("payment", conn)
+
+        assert list(result) == query_header("payment", conn)
+        assert result["payment_id"] == pl.Int32
+        assert result["created_at"] == pl.Datetime("us")
+        assert result["paid"] == pl.Boolean
+        assert result["payment_date"] == pl.Utf8
+
+    @pytest.mark.it("Rows read back from the csv have the same types as the query result")
+    def test_csv_and_query_result_give_same_dataframe(self, secretsmanager):
+        conn = connect_to_db(get_secret())
+        schema = query_parquet_schema("payment", conn)
+        data = query_db("payment", conn)
+        csv_file = StringIO()
+        csv.writer(csv_file).writerows(data)
+
+        result = read_typed_csv(csv_file.getvalue().encode(), schema)
+
+        assert result.equals(dataframe_from_rows(data, schema))
+
+    @pytest.mark.it("Batches concatenated give the same DataFrame as the whole query result")
+    def test_concat_frames(self, secretsmanager):
+        conn = connect_to_db(get_secret())
+        schema = query_parquet_schema("payment", conn)
+        data = query_db("payment", conn)
+        frames = [
+            dataframe_from_rows([data[0]] + data[start:start + 3], schema)
+            for start in range(1, len(data), 3)
+        ]
+
+        assert concat_frames(frames, schema).equals(dataframe_from_rows(data, schema))
+        assert concat_frames([], schema).schema == dataframe_from_rows(data, schema).schema
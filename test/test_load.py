@@ -0,0 +1,182 @@
+import pytest
+import boto3
+import os
+import json
+from io import BytesIO
+from moto import mock_aws
+import polars as pl
+from pg8000.native import Connection
+from src.lambda_functions.load import lambda_handler as load
+from src.utils.load_utils import WAREHOUSE_TABLES, LEDGER_TABLE
+from src.utils.s3_utils import partition_key
+from dotenv import load_dotenv, find_dotenv
+
+env_file = find_dotenv(f'.env.{os.getenv("ENV")}')
+if env_file != "":
+    load_dotenv(env_file)
+# env variables
+if os.getenv("ENV") == "testing":
+    USER_NAME = os.getenv("PG_USER")
+    PASSWORD = os.getenv("PG_PASSWORD")
+    DB_NAME = os.getenv("PG_DATABASE")
+    HOST = os.getenv("PG_HOST")
+    PORT = os.getenv("PG_PORT")
+elif os.getenv("ENV") == "development":
+    USER_NAME = os.getenv("DB_USER")
+    PASSWORD = os.getenv("DB_PASSWORD")
+    DB_NAME = os.getenv("DB_NAME")
+    HOST = os.getenv("DB_HOST")
+    PORT = os.getenv("DB_PORT")
+
+WAREHOUSE_DDL = os.path.join(os.path.dirname(__file__), "..", "database", "warehouse.sql")
+PROCESSED_BUCKET = "totesys-processed-data-000000"
+PREFIX = "2024/01/01/00:00:00/"
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    """Mocked AWS Credentials for S3 bucket."""
+    os.environ["AWS_ACCESS_KEY_ID"] = "test"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+    os.environ["AWS_SECURITY_TOKEN"] = "test"
+    os.environ["AWS_SESSION_TOKEN"] = "test"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def s3(aws_credentials):
+    """Mocked S3 client with processed data bucket and warehouse credentials."""
+    with mock_aws():
+        s3 = boto3.client("s3")
+        s3.create_bucket(
+            Bucket=PROCESSED_BUCKET,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        boto3.client("secretsmanager").create_secret(
+            Name="totesys-data-warehouse-credentials-test",
+            SecretString=json.dumps(
+                {
+                    "user": USER_NAME,
+                    "password": PASSWORD,
+                    "host": HOST,
+                    "database": DB_NAME,
+                    "port": PORT,
+                }
+            ),
+        )
+        yield s3
+
+
+@pytest.fixture(scope="function")
+def warehouse():
+    """Connection to the test database with the warehouse tables created,
+    dropped again after the test."""
+    conn = Connection(
+        user=USER_NAME, password=PASSWORD, host=HOST, database=DB_NAME, port=PORT
+    )
+    conn.run(f"DROP TABLE IF EXISTS {', '.join(reversed(WAREHOUSE_TABLES))}, {LEDGER_TABLE}")
+    with open(WAREHOUSE_DDL) as f:
+        for statement in f.read().split(";"):
+            if statement.strip():
+                conn.run(statement)
+    yield conn
+    conn.run(f"DROP TABLE IF EXISTS {', '.join(reversed(WAREHOUSE_TABLES))}, {LEDGER_TABLE}")
+    conn.close()
+
+
+def put_table(s3, table, df):
+    buffer = BytesIO()
+    df.write_parquet(buffer)
+    s3.put_object(
+        Bucket=PROCESSED_BUCKET, Key=partition_key("/", table, PREFIX),
+        Body=buffer.getvalue(),
+    )
+
+
+class DummyContext:  # Dummy context class used for testing
+    pass
+
+
+event = {"time_prefix": PREFIX}
+context = DummyContext()
+
+
+class TestLoad:
+
+    @pytest.mark.it("star schema tables saved by the transform run land in the warehouse")
+    def test_load_lands_data_in_warehouse(self, s3, warehouse):
+        put_table(s3, "dim_currency", pl.DataFrame(
+            {"currency_id": [1, 2], "currency_code": ["GBP", "USD"],
+             "currency_name": ["British Pound", "US Dollar"]}
+        ))
+        put_table(s3, "dim_design", pl.DataFrame(
+            {"design_id": [9], "design_name": ["Wooden"], "file_location": ["/usr"],
+             "file_name": ["wooden-20220717-npgz.json"]}
+        ))
+
+        result = load(event, context)
+
+        assert result == {
+            "time_prefix": PREFIX, "loaded": {"dim_design": 1, "dim_currency": 2}
+        }
+        assert warehouse.run("SELECT currency_code FROM dim_currency") == [
+            ["GBP"], ["USD"]
+        ]
+        assert warehouse.run("SELECT design_name FROM dim_design") == [["Wooden"]]
+
+    @pytest.mark.it("writes the metrics of each loaded table as EMF log lines")
+    def test_load_writes_metrics(self, s3, warehouse, capsys):
+        put_table(s3, "dim_currency", pl.DataFrame(
+            {"currency_id": [1, 2], "currency_code": ["GBP", "USD"],
+             "currency_name": ["British Pound", "US Dollar"]}
+        ))
+
+        load(event, context)
+
+        records = {
+            record["table"]: record
+            for record in map(json.loads, capsys.readouterr().out.splitlines())
+        }
+        assert set(records) == set(WAREHOUSE_TABLES) | {"all"}
+        assert "rows" not in records["dim_design"]
+        currency = records["dim_currency"]
+        assert currency["stage"] == "load"
+        assert currency["time_path"] == PREFIX
+        assert currency["rows"] == currency["changed_rows"] == 2
+        assert currency["downloaded_bytes"] > 0
+        assert currency["copy_time"] >= 0
+        assert records["all"]["duration_time"] > 0
+
+    @pytest.mark.it("a run loaded again is skipped")
+    def test_retried_load_is_skipped(self, s3, warehouse):
+        put_table(s3, "dim_currency", pl.DataFrame(
+            {"currency_id": [1], "currency_code": ["GBP"],
+             "currency_name": ["British Pound"]}
+        ))
+        load(event, context)
+
+        result = load(event, context)
+
+        assert result == {"time_prefix": PREFIX, "loaded": {}}
+        assert warehouse.run(f"SELECT time_prefix, row_count FROM {LEDGER_TABLE}") == [
+            [PREFIX, 1]
+        ]
+
+    @pytest.mark.it("a run that fails leaves the warehouse unchanged")
+    def test_failed_load_is_rolled_back(self, s3, warehouse):
+        put_table(s3, "dim_currency", pl.DataFrame(
+            {"currency_id": [1], "currency_code": ["GBP"],
+             "currency_name": ["British Pound"]}
+        ))
+        put_table(s3, "dim_design", pl.DataFrame(
+            {"design_id": [9], "design_name": [None]}, schema_overrides={"design_name": pl.Utf8}
+        ))
+
+        assert load(event, context) == "Failed to load data"
+        assert warehouse.run("SELECT count(*) FROM dim_currency") == [[0]]
+        assert warehouse.run(f"SELECT count(*) FROM {LEDGER_TABLE}") == [[0]]
+
+    @pytest.mark.it("returns an error message if there is no processed data bucket")
+    def test_no_processed_bucket(self, s3, warehouse):
+        s3.delete_bucket(Bucket=PROCESSED_BUCKET)
+        assert load(event, context) == "Failed to load data"
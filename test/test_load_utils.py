@@ -0,0 +1,248 @@
+import pytest
+import boto3
+import os
+from datetime import date, time
+from decimal import Decimal
+from io import BytesIO
+from moto import mock_aws
+import polars as pl
+from pg8000.native import Connection
+from src.utils.load_utils import *
+from dotenv import load_dotenv, find_dotenv
+
+env_file = find_dotenv(f'.env.{os.getenv("ENV")}')
+if env_file != "":
+    load_dotenv(env_file)
+# env variables
+if os.getenv("ENV") == "testing":
+    USER_NAME = os.getenv("PG_USER")
+    PASSWORD = os.getenv("PG_PASSWORD")
+    DB_NAME = os.getenv("PG_DATABASE")
+    HOST = os.getenv("PG_HOST")
+    PORT = os.getenv("PG_PORT")
+elif os.getenv("ENV") == "development":
+    USER_NAME = os.getenv("DB_USER")
+    PASSWORD = os.getenv("DB_PASSWORD")
+    DB_NAME = os.getenv("DB_NAME")
+    HOST = os.getenv("DB_HOST")
+    PORT = os.getenv("DB_PORT")
+
+WAREHOUSE_DDL = os.path.join(os.path.dirname(__file__), "..", "database", "warehouse.sql")
+PROCESSED_BUCKET = "totesys-processed-data-000000"
+PREFIX = "2024/01/01/00:00:00/"
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    """Mocked AWS Credentials for S3 bucket."""
+    os.environ["AWS_ACCESS_KEY_ID"] = "test"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+    os.environ["AWS_SECURITY_TOKEN"] = "test"
+    os.environ["AWS_SESSION_TOKEN"] = "test"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def s3(aws_credentials):
+    """Mocked S3 client with processed data bucket."""
+    with mock_aws():
+        s3 = boto3.client("s3")
+        s3.create_bucket(
+            Bucket=PROCESSED_BUCKET,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        yield s3
+
+
+@pytest.fixture(scope="function")
+def warehouse():
+    """Connection to the test database with the warehouse tables created,
+    dropped again after the test."""
+    conn = Connection(
+        user=USER_NAME, password=PASSWORD, host=HOST, database=DB_NAME, port=PORT
+    )
+    conn.run(f"DROP TABLE IF EXISTS {', '.join(reversed(WAREHOUSE_TABLES))}, {LEDGER_TABLE}")
+    with open(WAREHOUSE_DDL) as f:
+        for statement in f.read().split(";"):
+            if statement.strip():
+                conn.run(statement)
+    yield conn
+    conn.run("ROLLBACK")
+    conn.run(f"DROP TABLE IF EXISTS {', '.join(reversed(WAREHOUSE_TABLES))}, {LEDGER_TABLE}")
+    conn.close()
+
+
+def put_table(s3, table, df):
+    buffer = BytesIO()
+    df.write_parquet(buffer)
+    s3.put_object(
+        Bucket=PROCESSED_BUCKET, Key=partition_key("/", table, PREFIX),
+        Body=buffer.getvalue(),
+    )
+
+
+DIM_CURRENCY = pl.DataFrame(
+    {"currency_id": [1, 2], "currency_code": ["GBP", "USD"],
+     "currency_name": ["British Pound", "US Dollar"]}
+)
+
+
+class TestFindProcessedBucket:
+
+    @pytest.mark.it("Returns the name of the processed data bucket")
+    def test_finds_bucket(self, s3):
+        assert find_processed_bucket(s3) == PROCESSED_BUCKET
+
+    @pytest.mark.it("Raises an exception if there is no processed data bucket")
+    def test_no_bucket(self, s3):
+        s3.delete_bucket(Bucket=PROCESSED_BUCKET)
+        with pytest.raises(Exception, match="No processed data bucket found"):
+            find_processed_bucket(s3)
+
+
+class TestGetStarSchemaTable:
+
+    @pytest.mark.it("Reads the table saved by the transform run")
+    def test_reads_table(self, s3):
+        put_table(s3, "dim_currency", DIM_CURRENCY)
+        result = get_star_schema_table("dim_currency", PREFIX, s3, PROCESSED_BUCKET)
+        assert result.equals(DIM_CURRENCY)
+
+    @pytest.mark.it("Returns None if the run didn't change the table")
+    def test_missing_table(self, s3):
+        assert get_star_schema_table("dim_currency", PREFIX, s3, PROCESSED_BUCKET) is None
+
+
+class TestDataframeToCsv:
+
+    @pytest.mark.it("Missing values are unquoted empty fields, empty strings are quoted")
+    def test_nulls(self):
+        df = pl.DataFrame(
+            {"text": ["a", "", None], "price": [Decimal("2.50"), None, None]}
+        )
+        assert b"".join(dataframe_to_csv(df)) == b'a,2.50\n"",\n,\n'
+
+    @pytest.mark.it("Rows are written in chunks of batch_rows rows")
+    def test_chunks(self):
+        df = pl.DataFrame({"id": range(5)})
+        assert list(dataframe_to_csv(df, batch_rows=2)) == [
+            b"0\n1\n", b"2\n3\n", b"4\n"
+        ]
+
+
+class TestLoadTable:
+
+    @pytest.mark.it("Dimension rows are inserted, then replaced by changed rows with the same key")
+    def test_dimension_upsert(self, warehouse):
+        warehouse.run("START TRANSACTION")
+        assert load_table(warehouse, "dim_currency", DIM_CURRENCY) == 2
+        updated = pl.DataFrame(
+            {"currency_id": [2, 3], "currency_code": ["USD", "EUR"],
+             "currency_name": ["Dollar", "Euro"]}
+        )
+        assert load_table(warehouse, "dim_currency", updated) == 2
+        warehouse.run("COMMIT")
+
+        warehouse.run("START TRANSACTION")
+        assert load_table(warehouse, "dim_currency", updated) == 0
+        warehouse.run("COMMIT")
+
+        rows = warehouse.run("SELECT * FROM dim_currency ORDER BY currency_id")
+        assert rows == [
+            [1, "GBP", "British Pound"], [2, "USD", "Dollar"], [3, "EUR", "Euro"]
+        ]
+
+    @pytest.mark.it("Fact rows are appended with their typed values")
+    def test_fact_insert(self, warehouse, s3):
+        dims = {
+            "dim_date": pl.DataFrame(
+                {"date_id": [date(2022, 11, 3)], "year": [2022], "month": [11],
+                 "day": [3], "day_of_week": [4], "day_name": ["Thursday"],
+                 "month_name": ["November"], "quarter": [4]}
+            ),
+            "dim_staff": pl.DataFrame(
+                {"staff_id": [1], "first_name": ["Jeremie"], "last_name": ["Franey"],
+                 "department_name": ["Sales"], "location": ["Manchester"],
+                 "email_address": ["jf@terrifictotes.com"]}
+            ),
+            "dim_location": pl.DataFrame(
+                {"location_id": [1], "address_line_1": ["6826 Herzog Via"],
+                 "address_line_2": [None], "district": ["Avon"],
+                 "city": ["New Patienceburgh"], "postal_code": ["28441"],
+                 "country": ["Turkey"], "phone": ["1803 637401"]},
+                schema_overrides={"address_line_2": pl.Utf8},
+            ),
+            "dim_design": pl.DataFrame(
+                {"design_id": [9], "design_name": ["Wooden"], "file_location": ["/usr"],
+                 "file_name": ["wooden-20220717-npgz.json"]}
+            ),
+            "dim_currency": DIM_CURRENCY,
+            "dim_counterparty": pl.DataFrame(
+                {"counterparty_id": [1], "counterparty_legal_name": ["Fahey and Sons"],
+                 "counterparty_legal_address_line_1": ["6826 Herzog Via"],
+                 "counterparty_legal_address_line_2": [None],
+                 "counterparty_legal_district": ["Avon"],
+                 "counterparty_legal_city": ["New Patienceburgh"],
+                 "counterparty_legal_postal_code": ["28441"],
+                 "counterparty_legal_country": ["Turkey"],
+                 "counterparty_legal_phone_number": ["1803 637401"]},
+                schema_overrides={"counterparty_legal_address_line_2": pl.Utf8},
+            ),
+        }
+        fact = pl.DataFrame(
+            {"sales_order_id": [1], "created_date": [date(2022, 11, 3)],
+             "created_time": [time(14, 20, 49, 962000)],
+             "last_updated_date": [date(2022, 11, 3)],
+             "last_updated_time": [time(14, 20, 49, 962000)],
+             "sales_staff_id": [1], "counterparty_id": [1], "units_sold": [84754],
+             "unit_price": [Decimal("2.43")], "currency_id": [1], "design_id": [9],
+             "agreed_payment_date": [date(2022, 11, 3)],
+             "agreed_delivery_date": [date(2022, 11, 3)],
+             "agreed_delivery_location_id": [1]}
+        )
+        warehouse.run("START TRANSACTION")
+        for table, df in dims.items():
+            load_table(warehouse, table, df)
+        load_table(warehouse, "fact_sales_order", fact)
+        load_table(warehouse, "fact_sales_order", fact)
+        warehouse.run("COMMIT")
+
+        rows = warehouse.run(
+            "SELECT sales_record_id, created_time, unit_price, units_sold "
+            "FROM fact_sales_order ORDER BY sales_record_id"
+        )
+        assert rows == [
+            [1, time(14, 20, 49, 962000), Decimal("2.43"), 84754],
+            [2, time(14, 20, 49, 962000), Decimal("2.43"), 84754],
+        ]
+        assert warehouse.run(
+            "SELECT address_line_2 FROM dim_location"
+        ) == [[None]]
+
+
+class TestLoadStarSchema:
+
+    @pytest.mark.it("Loads every table saved by the run and skips the others")
+    def test_loads_saved_tables(self, warehouse, s3):
+        put_table(s3, "dim_currency", DIM_CURRENCY)
+        result = load_star_schema(warehouse, s3, PROCESSED_BUCKET, PREFIX)
+        assert result == {"dim_currency": 2}
+        assert warehouse.run("SELECT count(*) FROM dim_currency") == [[2]]
+
+    @pytest.mark.it("The run is recorded in the load ledger and not loaded again")
+    def test_run_loaded_once(self, warehouse, s3):
+        put_table(s3, "dim_currency", DIM_CURRENCY)
+        load_star_schema(warehouse, s3, PROCESSED_BUCKET, PREFIX)
+        assert load_star_schema(warehouse, s3, PROCESSED_BUCKET, PREFIX) is None
+        assert warehouse.run(f"SELECT time_prefix, row_count FROM {LEDGER_TABLE}") == [
+            [PREFIX, 2]
+        ]
+
+    @pytest.mark.it("Nothing is loaded if a table fails")
+    def test_rolls_back(self, warehouse, s3):
+        put_table(s3, "dim_currency", DIM_CURRENCY)
+        put_table(s3, "dim_design", pl.DataFrame({"design_id": [1], "design_name": [None]}))
+        with pytest.raises(Exception):
+            load_star_schema(warehouse, s3, PROCESSED_BUCKET, PREFIX)
+        assert warehouse.run("SELECT count(*) FROM dim_currency") == [[0]]
+        assert warehouse.run(f"SELECT count(*) FROM {LEDGER_TABLE}") == [[0]]
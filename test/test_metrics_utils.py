@@ -0,0 +1,135 @@
+import pytest
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from src.utils.metrics_utils import (
+    start_metrics,
+    flush_metrics,
+    metrics_table,
+    run_for_table,
+    count,
+    timed,
+)
+
+
+@pytest.fixture(autouse=True)
+def no_metrics():
+    """Stops any recording left by a test."""
+    yield
+    flush_metrics()
+
+
+class TestRecording:
+
+    @pytest.mark.it("Metrics are attributed to the current table of each thread")
+    def test_metrics_are_attributed_per_thread(self):
+        metrics = start_metrics("extract", "2024/01/01/00:00:00/")
+
+        def worker():
+            count("rows", 5)
+
+        with metrics_table("design"):
+            thread = threading.Thread(target=worker)
+            thread.start()
+            thread.join()
+            count("rows", 1)
+        count("rows", 2)
+
+        assert metrics.tables == {
+            "design": {"rows": (1, "Count")},
+            "all": {"rows": (7, "Count")},
+        }
+
+    @pytest.mark.it("Counts are summed per table and metric")
+    def test_counts_are_summed(self):
+        metrics = start_metrics("extract", "2024/01/01/00:00:00/")
+        count("rows", 10)
+        with metrics_table("staff"):
+            count("rows", 3)
+            count("rows", 4)
+            count("uploaded_bytes", 100, "Bytes")
+
+        assert metrics.tables == {
+            "all": {"rows": (10, "Count")},
+            "staff": {"rows": (7, "Count"), "uploaded_bytes": (100, "Bytes")},
+        }
+
+    @pytest.mark.it("Timed steps are recorded in milliseconds, also when they fail")
+    def test_timed(self):
+        metrics = start_metrics("transform")
+        with metrics_table("staff"):
+            with pytest.raises(ValueError):
+                with timed("download"):
+                    raise ValueError("failed")
+
+        total, unit = metrics.tables["staff"]["download_time"]
+        assert unit == "Milliseconds"
+        assert total >= 0
+
+    @pytest.mark.it("Tables run in worker threads get their own metrics and time")
+    def test_run_for_table(self):
+        metrics = start_metrics("extract")
+
+        def extract(rows):
+            count("rows", rows)
+            return rows
+
+        with ThreadPoolExecutor() as executor:
+            futures = [
+                executor.submit(run_for_table, table, extract, rows)
+                for table, rows in [("staff", 3), ("design", 5)]
+            ]
+        assert [future.result() for future in futures] == [3, 5]
+        assert metrics.tables["staff"]["rows"] == (3, "Count")
+        assert metrics.tables["design"]["rows"] == (5, "Count")
+        assert metrics.tables["design"]["table_time"][1] == "Milliseconds"
+
+    @pytest.mark.it("Nothing is recorded outside of start_metrics and flush_metrics")
+    def test_no_recording(self, capsys):
+        count("rows", 3)
+        with timed("query"):
+            pass
+
+        assert flush_metrics() == []
+        assert capsys.readouterr().out == ""
+
+
+class TestFlush:
+
+    @pytest.mark.it("Writes one EMF line per table tagged with stage and time_path")
+    def test_flush_metrics(self, capsys):
+        start_metrics("load", "2024/01/01/00:00:00/")
+        with metrics_table("dim_staff"):
+            count("rows", 2)
+            count("downloaded_bytes", 512, "Bytes")
+
+        records = flush_metrics()
+
+        lines = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+        assert lines == records
+        assert [r["table"] for r in records] == ["dim_staff", "all"]
+        staff = records[0]
+        assert staff["stage"] == "load"
+        assert staff["time_path"] == "2024/01/01/00:00:00/"
+        assert staff["rows"] == 2
+        assert staff["downloaded_bytes"] == 512
+        assert staff["_aws"]["CloudWatchMetrics"] == [{
+            "Namespace": "Totesys/Pipeline",
+            "Dimensions": [["stage", "table"]],
+            "Metrics": [
+                {"Name": "rows", "Unit": "Count"},
+                {"Name": "downloaded_bytes", "Unit": "Bytes"},
+            ],
+        }]
+        assert isinstance(staff["_aws"]["Timestamp"], int)
+        assert records[1]["duration_time"] >= 0
+        assert flush_metrics() == []
+
+    @pytest.mark.it("Uses the namespace set in METRICS_NAMESPACE")
+    def test_namespace(self, monkeypatch):
+        monkeypatch.setenv("METRICS_NAMESPACE", "Totesys/Test")
+        start_metrics("load")
+
+        records = flush_metrics()
+
+        assert records[0]["_aws"]["CloudWatchMetrics"][0]["Namespace"] == "Totesys/Test"
@@ -0,0 +1,312 @@
+import pytest
+import boto3
+import os
+import threading
+from moto import mock_aws
+from unittest.mock import patch
+from botocore.exceptions import ClientError
+from src.utils.s3_utils import (
+    MultipartUpload,
+    get_s3_client,
+    run_bulk,
+    upload_file,
+    download_file,
+    upload_files,
+    download_files,
+    put_objects,
+    get_objects,
+    compression_suffix,
+    compress,
+    decompress,
+    compress_file,
+    decompress_file,
+    download_files_decompressed,
+    get_object_decompressed,
+    MULTIPART_CHUNK_SIZE,
+)
+
+MOCK_BUCKET_NAME = "totesys-raw-data-000000"
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    """Mocked AWS Credentials for S3 bucket."""
+    os.environ["AWS_ACCESS_KEY_ID"] = "test"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+    os.environ["AWS_SECURITY_TOKEN"] = "test"
+    os.environ["AWS_SESSION_TOKEN"] = "test"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def s3(aws_credentials):
+    """Mocked S3 client with raw data bucket."""
+    with mock_aws():
+        s3 = boto3.client("s3")
+        s3.create_bucket(
+            Bucket=MOCK_BUCKET_NAME,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        yield s3
+
+
+class TestMultipartUpload:
+
+    @pytest.mark.it("Uploads content smaller than a part with a single put_object")
+    def test_small_upload(self, s3):
+        upload = MultipartUpload(s3, MOCK_BUCKET_NAME, "small.csv")
+        upload.write(b"A,B\n")
+        upload.write(b"1,2\n")
+        upload.close()
+
+        res = s3.get_object(Bucket=MOCK_BUCKET_NAME, Key="small.csv")
+        assert res["Body"].read() == b"A,B\n1,2\n"
+        assert upload.upload_id is None
+
+    @pytest.mark.it("Uploads large content in several parts")
+    def test_multipart_upload(self, s3):
+        chunk = b"x" * (5 * 1024 * 1024)
+        upload = MultipartUpload(
+            s3, MOCK_BUCKET_NAME, "large.csv", chunk_size=len(chunk)
+        )
+        upload.write(chunk)
+        upload.write(chunk)
+        upload.write(b"end")
+        upload.close()
+
+        res = s3.get_object(Bucket=MOCK_BUCKET_NAME, Key="large.csv")
+        assert res["Body"].read() == chunk + chunk + b"end"
+        assert len(upload.parts) == 3
+
+    @pytest.mark.it("Aborting an upload leaves no object in the bucket")
+    def test_abort_upload(self, s3):
+        chunk = b"x" * (5 * 1024 * 1024)
+        upload = MultipartUpload(
+            s3, MOCK_BUCKET_NAME, "aborted.csv", chunk_size=len(chunk)
+        )
+        upload.write(chunk)
+        upload.abort()
+
+        assert "Contents" not in s3.list_objects_v2(Bucket=MOCK_BUCKET_NAME)
+
+    @pytest.mark.it("Cuts a single large write into parts of chunk_size bytes")
+    def test_large_write_is_cut_into_parts(self, s3):
+        chunk_size = 5 * 1024 * 1024
+        data = bytes(range(256)) * (chunk_size * 2 // 256) + b"end"
+        upload = MultipartUpload(s3, MOCK_BUCKET_NAME, "cut.parquet", chunk_size=chunk_size)
+
+        assert upload.write(memoryview(data)) == len(data)
+        assert len(upload.buffer) == 3
+        upload.close()
+
+        res = s3.get_object(Bucket=MOCK_BUCKET_NAME, Key="cut.parquet")
+        assert res["Body"].read() == data
+        assert len(upload.parts) == 3
+
+
+class TestS3Client:
+
+    @pytest.mark.it("The same client is shared by every caller")
+    def test_shared_client(self, s3):
+        assert get_s3_client() is get_s3_client()
+        assert get_s3_client().meta.config.max_pool_connections >= 50
+
+
+class TestRunBulk:
+
+    @pytest.mark.it("Calls are run on several threads and their results returned by key")
+    def test_concurrent_calls(self):
+        barrier = threading.Barrier(3, timeout=5)
+
+        def call(key, value):
+            barrier.wait()  # only returns once the three calls run at the same time
+            return value * 2
+
+        assert run_bulk(call, {"a": 1, "b": 2, "c": 3}) == {"a": 2, "b": 4, "c": 6}
+
+    @pytest.mark.it("Every call is finished before an exception is raised")
+    def test_exception_after_all_calls(self):
+        done = []
+
+        def call(key, value):
+            if key == "a":
+                raise ValueError("failed")
+            done.append(key)
+
+        with pytest.raises(ValueError, match="failed"):
+            run_bulk(call, {"a": 1, "b": 2, "c": 3})
+        assert sorted(done) == ["b", "c"]
+
+
+class TestTransfers:
+
+    @pytest.mark.it("Files larger than a part are uploaded in several parts")
+    def test_upload_file_multipart(self, s3, tmp_path):
+        filename = tmp_path / "large.csv"
+        filename.write_bytes(b"x" * (MULTIPART_CHUNK_SIZE + 1))
+        upload_file(s3, MOCK_BUCKET_NAME, str(filename), "large.csv")
+
+        head = s3.head_object(Bucket=MOCK_BUCKET_NAME, Key="large.csv")
+        assert head["ContentLength"] == MULTIPART_CHUNK_SIZE + 1
+        assert head["ETag"].endswith('-2"')
+
+    @pytest.mark.it("Missing objects are reported with missing_ok, raised otherwise")
+    def test_download_missing(self, s3, tmp_path):
+        filename = str(tmp_path / "missing.csv")
+        assert download_file(s3, MOCK_BUCKET_NAME, "missing.csv", filename, True) is False
+        with pytest.raises(ClientError):
+            download_file(s3, MOCK_BUCKET_NAME, "missing.csv", filename)
+
+    @pytest.mark.it("Bulk uploads and downloads transfer every file")
+    def test_bulk_files(self, s3, tmp_path):
+        files = {}
+        for name in ["a", "b", "c"]:
+            (tmp_path / f"{name}.csv").write_bytes(name.encode())
+            files[f"/source/{name}.csv"] = str(tmp_path / f"{name}.csv")
+        upload_files(s3, MOCK_BUCKET_NAME, files)
+
+        downloads = {key: f"{filename}.copy" for key, filename in files.items()}
+        downloads["/source/d.csv"] = str(tmp_path / "d.csv")
+        result = download_files(s3, MOCK_BUCKET_NAME, downloads, missing_ok=True)
+
+        assert result == {
+            "/source/a.csv": True, "/source/b.csv": True,
+            "/source/c.csv": True, "/source/d.csv": False,
+        }
+        assert (tmp_path / "b.csv.copy").read_bytes() == b"b"
+
+    @pytest.mark.it("Bulk puts and gets return the content of every object")
+    def test_bulk_objects(self, s3):
+        responses = put_objects(s3, MOCK_BUCKET_NAME, {"a": b"1", "b": b"2"})
+        assert set(responses) == {"a", "b"}
+        assert all("ETag" in response for response in responses.values())
+
+        assert get_objects(s3, MOCK_BUCKET_NAME, ["a", "b", "c"]) == {
+            "a": b"1", "b": b"2", "c": None
+        }
+
+    @pytest.mark.it("Errors other than a missing object are raised")
+    def test_get_objects_error(self, s3):
+        with pytest.raises(ClientError):
+            get_objects(s3, "totesys-no-bucket", ["a"])
+
+
+CSV_CONTENT = b"address_id,city\n" + b"".join(
+    f"{i},New Patienceburgh\n".encode() for i in range(1000)
+)
+
+
+class TestCompression:
+
+    @pytest.mark.it("Compressions have their key suffix, unknown compressions are rejected")
+    def test_compression_suffix(self):
+        assert compression_suffix(None) == ""
+        assert compression_suffix("none") == ""
+        assert compression_suffix("gzip") == ".gz"
+        assert compression_suffix("zstd") == ".zst"
+        with pytest.raises(Exception, match="Unknown compression: lz4"):
+            compression_suffix("lz4")
+
+    @pytest.mark.parametrize("compression,suffix", [("gzip", ".gz"), ("zstd", ".zst")])
+    @pytest.mark.it("Compressed data and files are decompressed to their content")
+    def test_round_trip(self, tmp_path, compression, suffix):
+        compressed = compress(CSV_CONTENT, compression)
+        assert len(compressed) < len(CSV_CONTENT) / 5
+        assert decompress(compressed, suffix) == CSV_CONTENT
+
+        filename = tmp_path / "address.csv"
+        filename.write_bytes(CSV_CONTENT)
+        compressed_file = compress_file(str(filename), compression)
+        assert compressed_file == f"{filename}{suffix}"
+        decompress_file(compressed_file, str(tmp_path / "copy.csv"), suffix)
+        assert (tmp_path / "copy.csv").read_bytes() == CSV_CONTENT
+
+    @pytest.mark.it("Without compression, data and files are left as they are")
+    def test_no_compression(self, tmp_path):
+        assert compress(CSV_CONTENT, "none") == CSV_CONTENT
+        assert decompress(CSV_CONTENT, "") == CSV_CONTENT
+        filename = str(tmp_path / "address.csv")
+        assert compress_file(filename, None) == filename
+
+    @pytest.mark.parametrize("compression,suffix", [("gzip", ".gz"), ("zstd", ".zst")])
+    @pytest.mark.it("Multipart uploads compress their content as it is written")
+    def test_compressed_multipart_upload(self, s3, compression, suffix):
+        upload = MultipartUpload(
+            s3, MOCK_BUCKET_NAME, f"address.csv{suffix}", chunk_size=5 * 1024 * 1024,
+            compression=compression,
+        )
+        content = os.urandom(3 * 1024 * 1024) + CSV_CONTENT * 200
+        for offset in range(0, len(content), 1024 * 1024):
+            upload.write(content[offset:offset + 1024 * 1024])
+        upload.close()
+
+        body = s3.get_object(Bucket=MOCK_BUCKET_NAME, Key=f"address.csv{suffix}")["Body"].read()
+        assert decompress(body, suffix) == content
+
+    @pytest.mark.parametrize("compression,suffix", [("gzip", ".gz"), ("zstd", ".zst"), ("none", "")])
+    @pytest.mark.it("Objects are read whatever the compression they were saved with")
+    def test_transparent_reads(self, s3, tmp_path, compression, suffix):
+        s3.put_object(
+            Bucket=MOCK_BUCKET_NAME, Key=f"/source/address_new.csv{suffix}",
+            Body=compress(CSV_CONTENT, compression),
+        )
+
+        assert get_object_decompressed(s3, MOCK_BUCKET_NAME, "/source/address_new.csv") == CSV_CONTENT
+        assert get_object_decompressed(s3, MOCK_BUCKET_NAME, "/source/staff_new.csv") is None
+
+        result = download_files_decompressed(s3, MOCK_BUCKET_NAME, {
+            "/source/address_new.csv": str(tmp_path / "address.csv"),
+            "/source/staff_new.csv": str(tmp_path / "staff.csv"),
+        }, missing_ok=True)
+        assert result == {"/source/address_new.csv": True, "/source/staff_new.csv": False}
+        assert (tmp_path / "address.csv").read_bytes() == CSV_CONTENT
+        assert os.listdir(tmp_path) == ["address.csv"]
+
+    @pytest.mark.parametrize("compression,suffix", [("gzip", ".gz"), ("zstd", ".zst"), ("none", "")])
+    @pytest.mark.it("Objects saved with the configured compression are read with one request each")
+    def test_configured_compression_read_first(self, s3, tmp_path, compression, suffix):
+        s3.put_object(
+            Bucket=MOCK_BUCKET_NAME, Key=f"/source/address_new.csv{suffix}",
+            Body=compress(CSV_CONTENT, compression),
+        )
+
+        with patch.object(s3, "get_object", wraps=s3.get_object) as patched_get:
+            assert get_object_decompressed(
+                s3, MOCK_BUCKET_NAME, "/source/address_new.csv", compression
+            ) == CSV_CONTENT
+        assert patched_get.call_count == 1
+
+        with patch.object(s3, "download_file", wraps=s3.download_file) as patched_download:
+            download_files_decompressed(
+                s3, MOCK_BUCKET_NAME,
+                {"/source/address_new.csv": str(tmp_path / "address.csv")},
+                compression=compression,
+            )
+        assert patched_download.call_count == 1
+        assert (tmp_path / "address.csv").read_bytes() == CSV_CONTENT
+
+    @pytest.mark.it("Objects saved with another compression are still found")
+    def test_other_compression_fallback(self, s3, tmp_path):
+        s3.put_object(
+            Bucket=MOCK_BUCKET_NAME, Key="/source/address_new.csv.gz",
+            Body=compress(CSV_CONTENT, "gzip"),
+        )
+
+        assert get_object_decompressed(
+            s3, MOCK_BUCKET_NAME, "/source/address_new.csv", "zstd"
+        ) == CSV_CONTENT
+        result = download_files_decompressed(
+            s3, MOCK_BUCKET_NAME,
+            {"/source/address_new.csv": str(tmp_path / "address.csv")},
+            compression="zstd",
+        )
+        assert result == {"/source/address_new.csv": True}
+        assert os.listdir(tmp_path) == ["address.csv"]
+        assert (tmp_path / "address.csv").read_bytes() == CSV_CONTENT
+
+    @pytest.mark.it("A missing object is raised unless missing_ok")
+    def test_missing_decompressed(self, s3, tmp_path):
+        with pytest.raises(Exception, match="/source/staff_new.csv not found"):
+            download_files_decompressed(
+                s3, MOCK_BUCKET_NAME, {"/source/staff_new.csv": str(tmp_path / "staff.csv")}
+            )
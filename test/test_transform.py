@@ -1,8 +1,15 @@
 import pytest
 import boto3
+import json
 import os
 from moto import mock_aws
-from src.lambda_functions.transform import lambda_handler as transform
+from unittest.mock import patch
+from botocore.exceptions import ClientError
+from io import BytesIO
+import polars as pl
+from src.lambda_functions.transform import lambda_handler as transform, csvs
+from src.utils.transform_utils import read_raw_file
+from src.utils.s3_utils import compress
 
 
 @pytest.fixture(scope="function")
@@ -31,6 +38,50 @@ def s3(aws_credentials):
         yield s3
 
 
+TIMESTAMPS = "2022-11-03 14:20:49.962000,2022-11-03 14:20:49.962000"
+STAR_SCHEMA_SOURCES = {
+    "sales_order": "sales_order_id,created_at,last_updated,design_id,staff_id,"
+    "counterparty_id,units_sold,unit_price,currency_id,agreed_delivery_date,"
+    "agreed_payment_date,agreed_delivery_location_id\n"
+    f"1,{TIMESTAMPS},9,1,1,84754,2.43,1,2022-11-10,2022-11-03,1\n",
+    "staff": "staff_id,first_name,last_name,department_id,email_address,"
+    f"created_at,last_updated\n1,Jeremie,Franey,1,jf@terrifictotes.com,{TIMESTAMPS}\n",
+    "department": "department_id,department_name,location,manager,created_at,"
+    f"last_updated\n1,Sales,Manchester,Richard Roma,{TIMESTAMPS}\n",
+    "address": "address_id,address_line_1,address_line_2,district,city,"
+    "postal_code,country,phone,created_at,last_updated\n"
+    f"1,6826 Herzog Via,,Avon,New Patienceburgh,28441,Turkey,1803 637401,{TIMESTAMPS}\n",
+    "design": "design_id,created_at,last_updated,design_name,file_location,"
+    f"file_name\n9,{TIMESTAMPS},Wooden,/usr,wooden-20220717-npgz.json\n",
+    "currency": f"currency_id,currency_code,created_at,last_updated\n1,GBP,{TIMESTAMPS}\n",
+    "counterparty": "counterparty_id,counterparty_legal_name,legal_address_id,"
+    "commercial_contact,delivery_contact,created_at,last_updated\n"
+    f"1,Fahey and Sons,1,Micheal Toy,Mrs. Lucy Runolfsdottir,{TIMESTAMPS}\n",
+}
+
+
+def as_differences(body):
+    """Differences file of a first extract run: every row is an insert"""
+    header, *rows = body.splitlines()
+    return "\n".join([f"{header},change_type"] + [f"{row},insert" for row in rows]) + "\n"
+
+
+TABLES = [csv[:-4] for csv in csvs]
+
+
+def put_differences(s3, tables=TABLES):
+    """Saves the differences of an extract run changing tables, with unsorted rows"""
+    for table in tables:
+        s3.put_object(
+            Body=f"{table}_id,last_updated,change_type\n"
+            "1,2022-11-04 14:20:49.962000,insert\n"
+            "2,2022-11-03 14:20:49.962000,update\n"
+            "3,2022-11-05 14:20:49.962000,insert\n",
+            Bucket="totesys-raw-data-000000",
+            Key=f"/history/YYYY/MM/DD/HH:MM:SS/{table}_differences.csv",
+        )
+
+
 class DummyContext:  # Dummy context class used for testing
     pass
 
@@ -43,116 +94,272 @@ class TestTransform:
 
     @pytest.mark.it("parquet data lands in the processed bucket")
     def test_transform_lands_data_in_processed_data_bucket(self, s3):
+        put_differences(s3)
 
+        res = transform(event, context)
+        proc_data_bucket_objects = s3.list_objects(
+            Bucket="totesys-processed-data-000000"
+        )["Contents"]
+
+        assert {parquet["Key"] for parquet in proc_data_bucket_objects} == {
+            key
+            for table in TABLES
+            for key in [
+                f"/history/table={table}/year=YYYY/month=MM/day=DD/HH:MM:SS.parquet",
+                f"/history/table={table}/year=YYYY/month=MM/day=DD/_index.json",
+            ]
+        }
+        assert res == {"time_prefix": "YYYY/MM/DD/HH:MM:SS/"}
+
+    @pytest.mark.it("parquet files are sorted on last_updated and indexed by partition")
+    def test_transform_writes_sorted_indexed_partitions(self, s3):
+        put_differences(s3)
+
+        transform(event, context)
+
+        folder = "/history/table=payment/year=YYYY/month=MM/day=DD/"
+        df = pl.read_parquet(BytesIO(s3.get_object(
+            Bucket="totesys-processed-data-000000", Key=f"{folder}HH:MM:SS.parquet"
+        )["Body"].read()))
+        assert df["payment_id"].to_list() == [2, 1, 3]
+        assert df.schema["last_updated"] == pl.Datetime("us")
+        index = json.loads(s3.get_object(
+            Bucket="totesys-processed-data-000000", Key=f"{folder}_index.json"
+        )["Body"].read())
+        assert index["files"]["HH:MM:SS.parquet"] == {
+            "rows": 3,
+            "min": {"last_updated": "2022-11-03 14:20:49.962000"},
+            "max": {"last_updated": "2022-11-05 14:20:49.962000"},
+        }
+
+    @pytest.mark.it("typed parquet files saved by the extract are used instead of the csvs")
+    def test_transform_uses_raw_parquet(self, s3):
+        typed = pl.DataFrame({"staff_id": [1], "change_type": ["insert"]})
+        parquet = BytesIO()
+        typed.write_parquet(parquet)
         s3.put_object(
-            Body="""test,test2,test3
-                    1,2,3
-                    5,6,7
-                    8,9,10""",
-            Bucket="totesys-raw-data-000000",
-            Key="/history/YYYY/MM/DD/HH:MM:SS/sales_order.csv",
-        )
-        s3.put_object(
-            Body="""test,test2,test3
-                    1,2,3
-                    5,6,7
-                    8,9,10""",
-            Bucket="totesys-raw-data-000000",
-            Key="/history/YYYY/MM/DD/HH:MM:SS/design.csv",
-        )
-        s3.put_object(
-            Body="""test,test2,test3
-                    1,2,3
-                    5,6,7
-                    8,9,10""",
-            Bucket="totesys-raw-data-000000",
-            Key="/history/YYYY/MM/DD/HH:MM:SS/currency.csv",
-        )
-        s3.put_object(
-            Body="""test,test2,test3
-                    1,2,3
-                    5,6,7
-                    8,9,10""",
-            Bucket="totesys-raw-data-000000",
-            Key="/history/YYYY/MM/DD/HH:MM:SS/staff.csv",
-        )
-        s3.put_object(
-            Body="""test,test2,test3
-                    1,2,3
-                    5,6,7
-                    8,9,10""",
-            Bucket="totesys-raw-data-000000",
-            Key="/history/YYYY/MM/DD/HH:MM:SS/counterparty.csv",
-        )
-        s3.put_object(
-            Body="""test,test2,test3
-                    1,2,3
-                    5,6,7
-                    8,9,10""",
-            Bucket="totesys-raw-data-000000",
-            Key="/history/YYYY/MM/DD/HH:MM:SS/address.csv",
-        )
-        s3.put_object(
-            Body="""test,test2,test3
-                    1,2,3
-                    5,6,7
-                    8,9,10""",
-            Bucket="totesys-raw-data-000000",
-            Key="/history/YYYY/MM/DD/HH:MM:SS/department.csv",
-        )
-        s3.put_object(
-            Body="""test,test2,test3
-                    1,2,3
-                    5,6,7
-                    8,9,10""",
+            Body=parquet.getvalue(),
             Bucket="totesys-raw-data-000000",
-            Key="/history/YYYY/MM/DD/HH:MM:SS/purchase_order.csv",
+            Key="/history/YYYY/MM/DD/HH:MM:SS/staff_differences.parquet",
         )
         s3.put_object(
-            Body="""test,test2,test3
-                    1,2,3
-                    5,6,7
-                    8,9,10""",
+            Body="staff_id,change_type\n2,insert\n",
             Bucket="totesys-raw-data-000000",
-            Key="/history/YYYY/MM/DD/HH:MM:SS/payment_type.csv",
+            Key="/history/YYYY/MM/DD/HH:MM:SS/staff_differences.csv",
         )
-        s3.put_object(
-            Body="""test,test2,test3
-                    1,2,3
-                    5,6,7
-                    8,9,10""",
-            Bucket="totesys-raw-data-000000",
-            Key="/history/YYYY/MM/DD/HH:MM:SS/payment.csv",
+
+        transform(event, context)
+
+        result = s3.get_object(
+            Bucket="totesys-processed-data-000000",
+            Key="/history/table=staff/year=YYYY/month=MM/day=DD/HH:MM:SS.parquet",
+        )["Body"].read()
+        assert pl.read_parquet(BytesIO(result)).equals(typed)
+
+    @pytest.mark.it("tables the extract run didn't change are skipped")
+    def test_unchanged_tables_are_skipped(self, s3):
+        put_differences(s3, ["payment"])
+
+        res = transform(event, context)
+
+        keys = [
+            obj["Key"]
+            for obj in s3.list_objects(Bucket="totesys-processed-data-000000")["Contents"]
+        ]
+        assert res == {"time_prefix": "YYYY/MM/DD/HH:MM:SS/"}
+        assert all(key.startswith("/history/table=payment/") for key in keys)
+
+    @pytest.mark.it("a failing table doesn't stop the other tables from being transformed")
+    def test_failed_table_is_isolated(self, s3):
+        put_differences(s3)
+
+        def read(key, s3_client, bucket):
+            if key.endswith("/staff_differences"):
+                raise ClientError({"Error": {"Code": "500", "Message": "boom"}}, "GetObject")
+            return read_raw_file(key, s3_client, bucket)
+
+        with patch("src.lambda_functions.transform.read_raw_file", side_effect=read):
+            with pytest.raises(Exception, match="Failed to transform tables: staff"):
+                transform(event, context)
+
+        keys = [
+            obj["Key"]
+            for obj in s3.list_objects(Bucket="totesys-processed-data-000000")["Contents"]
+        ]
+        assert len(keys) == 20
+        assert not any(key.startswith("/history/table=staff/") for key in keys)
+
+    @pytest.mark.it("a failed run leaves the star schema states as they were for its retry")
+    def test_failed_run_keeps_states(self, s3):
+        for table, body in STAR_SCHEMA_SOURCES.items():
+            s3.put_object(
+                Body=body, Bucket="totesys-raw-data-000000", Key=f"/source/{table}_new.csv"
+            )
+
+        def read(key, s3_client, bucket):
+            if key.endswith("/payment_differences"):
+                raise ClientError({"Error": {"Code": "500", "Message": "boom"}}, "GetObject")
+            return read_raw_file(key, s3_client, bucket)
+
+        with patch("src.lambda_functions.transform.read_raw_file", side_effect=read):
+            with pytest.raises(Exception, match="payment"):
+                transform(event, context)
+        assert "Contents" not in s3.list_objects(
+            Bucket="totesys-processed-data-000000", Prefix="/state/"
         )
-        s3.put_object(
-            Body="""test,test2,test3
-                    1,2,3
-                    5,6,7
-                    8,9,10""",
-            Bucket="totesys-raw-data-000000",
-            Key="/history/YYYY/MM/DD/HH:MM:SS/transaction.csv",
+
+        with patch(
+            "src.lambda_functions.transform.save_states", side_effect=ClientError(
+                {"Error": {"Code": "500", "Message": "boom"}}, "PutObject"
+            )
+        ):
+            with pytest.raises(Exception, match="star_schema"):
+                transform(event, context)
+
+        res = transform(event, context)
+
+        assert res == {"time_prefix": "YYYY/MM/DD/HH:MM:SS/"}
+        dim_staff = s3.get_object(
+            Bucket="totesys-processed-data-000000",
+            Key="/table=dim_staff/year=YYYY/month=MM/day=DD/HH:MM:SS.parquet",
+        )["Body"].read()
+        assert pl.read_parquet(BytesIO(dim_staff)).height == 1
+        assert s3.head_object(
+            Bucket="totesys-processed-data-000000", Key="/state/staff.parquet"
         )
 
-        expected_pq = {
-            "/history/YYYY/MM/DD/HH:MM:SS//address.parquet": 0,
-            "/history/YYYY/MM/DD/HH:MM:SS//design.parquet": 0,
-            "/history/YYYY/MM/DD/HH:MM:SS//currency.parquet": 0,
-            "/history/YYYY/MM/DD/HH:MM:SS//staff.parquet": 0,
-            "/history/YYYY/MM/DD/HH:MM:SS//counterparty.parquet": 0,
-            "/history/YYYY/MM/DD/HH:MM:SS//sales_order.parquet": 0,
-            "/history/YYYY/MM/DD/HH:MM:SS//department.parquet": 0,
-            "/history/YYYY/MM/DD/HH:MM:SS//purchase_order.parquet": 0,
-            "/history/YYYY/MM/DD/HH:MM:SS//payment_type.parquet": 0,
-            "/history/YYYY/MM/DD/HH:MM:SS//payment.parquet": 0,
-            "/history/YYYY/MM/DD/HH:MM:SS//transaction.parquet": 0,
-        }
+    @pytest.mark.it("tables are transformed sequentially with a concurrency of 1")
+    def test_concurrency_of_one(self, s3):
+        put_differences(s3)
+
+        with patch.dict(os.environ, {"TRANSFORM_CONCURRENCY": "1"}):
+            res = transform(event, context)
+
+        contents = s3.list_objects(Bucket="totesys-processed-data-000000")["Contents"]
+        assert len(contents) == 22
+        assert res == {"time_prefix": "YYYY/MM/DD/HH:MM:SS/"}
+
+    @pytest.mark.it("star schema tables are built from the first extract run")
+    def test_transform_builds_star_schema(self, s3):
+        for table, body in STAR_SCHEMA_SOURCES.items():
+            s3.put_object(
+                Body=body, Bucket="totesys-raw-data-000000", Key=f"/source/{table}_new.csv"
+            )
+            s3.put_object(
+                Body=as_differences(body),
+                Bucket="totesys-raw-data-000000",
+                Key=f"/history/YYYY/MM/DD/HH:MM:SS/{table}_differences.csv",
+            )
 
         res = transform(event, context)
-        proc_data_bucket_objects = s3.list_objects(
-            Bucket="totesys-processed-data-000000"
-        )["Contents"]
 
-        for parquet in proc_data_bucket_objects:
-            assert parquet["Key"] in expected_pq
+        assert res == {"time_prefix": "YYYY/MM/DD/HH:MM:SS/"}
+        for table in [
+            "fact_sales_order", "dim_staff", "dim_location", "dim_design",
+            "dim_date", "dim_currency", "dim_counterparty",
+        ]:
+            parquet = s3.get_object(
+                Bucket="totesys-processed-data-000000",
+                Key=f"/table={table}/year=YYYY/month=MM/day=DD/HH:MM:SS.parquet",
+            )["Body"].read()
+            assert pl.read_parquet(BytesIO(parquet)).height >= 1
+        assert "staff_new.csv" not in os.listdir("/tmp")
+
+    @pytest.mark.it("the first star schema is built from the snapshots of every source table")
+    def test_first_star_schema_reads_every_snapshot(self, s3):
+        for table, body in STAR_SCHEMA_SOURCES.items():
+            s3.put_object(
+                Body=body, Bucket="totesys-raw-data-000000", Key=f"/source/{table}_new.csv"
+            )
+
+        transform(event, context)
+
+        for table in ["fact_sales_order", "dim_design", "dim_currency", "dim_staff"]:
+            parquet = s3.get_object(
+                Bucket="totesys-processed-data-000000",
+                Key=f"/table={table}/year=YYYY/month=MM/day=DD/HH:MM:SS.parquet",
+            )["Body"].read()
+            assert pl.read_parquet(BytesIO(parquet)).height == 1
+        assert "sales_order_new.csv" not in os.listdir("/tmp")
+
+    @pytest.mark.it("compressed csv files saved by the extract are read transparently")
+    def test_transform_reads_compressed_files(self, s3):
+        for table, body in STAR_SCHEMA_SOURCES.items():
+            s3.put_object(
+                Body=compress(body.encode(), "zstd"),
+                Bucket="totesys-raw-data-000000",
+                Key=f"/source/{table}_new.csv.zst",
+            )
+            s3.put_object(
+                Body=compress(as_differences(body).encode(), "gzip"),
+                Bucket="totesys-raw-data-000000",
+                Key=f"/history/YYYY/MM/DD/HH:MM:SS/{table}_differences.csv.gz",
+            )
+
+        res = transform(event, context)
 
         assert res == {"time_prefix": "YYYY/MM/DD/HH:MM:SS/"}
+        parquet = s3.get_object(
+            Bucket="totesys-processed-data-000000",
+            Key="/table=dim_counterparty/year=YYYY/month=MM/day=DD/HH:MM:SS.parquet",
+        )["Body"].read()
+        assert pl.read_parquet(BytesIO(parquet))["counterparty_legal_name"].to_list() == [
+            "Fahey and Sons"
+        ]
+        assert "staff_differences.csv.gz" not in os.listdir("/tmp")
+
+    @pytest.mark.it("a run without changes leaves the star schema without reading its states")
+    def test_unchanged_run_skips_star_schema(self, s3):
+        for table, body in STAR_SCHEMA_SOURCES.items():
+            s3.put_object(
+                Body=body, Bucket="totesys-raw-data-000000", Key=f"/source/{table}_new.csv"
+            )
+        transform(event, context)
+        contents = s3.list_objects(Bucket="totesys-processed-data-000000")["Contents"]
+
+        with patch("src.lambda_functions.transform.update_source_states") as update:
+            res = transform({"time_path": "2022/11/04/00:00:00/"}, context)
+
+        assert res == {"time_prefix": "2022/11/04/00:00:00/"}
+        update.assert_not_called()
+        assert s3.list_objects(Bucket="totesys-processed-data-000000")["Contents"] == contents
+
+    @pytest.mark.it("later runs only save the star schema rows changed by the extract run")
+    def test_transform_updates_star_schema(self, s3):
+        for table, body in STAR_SCHEMA_SOURCES.items():
+            s3.put_object(
+                Body=body, Bucket="totesys-raw-data-000000", Key=f"/source/{table}_new.csv"
+            )
+        transform(event, context)
+        s3.put_object(
+            Body="department_id,department_name,location,manager,created_at,last_updated,"
+            f"change_type\n1,Sales,Leeds,Richard Roma,{TIMESTAMPS},update\n",
+            Bucket="totesys-raw-data-000000",
+            Key="/history/2022/11/04/00:00:00/department_differences.csv",
+        )
+
+        res = transform({"time_path": "2022/11/04/00:00:00/"}, context)
+
+        keys = [
+            obj["Key"]
+            for obj in s3.list_objects(
+                Bucket="totesys-processed-data-000000", Prefix="/table=dim"
+            )["Contents"]
+            if "/day=04/" in obj["Key"] and obj["Key"].endswith(".parquet")
+        ]
+        assert res == {"time_prefix": "2022/11/04/00:00:00/"}
+        assert keys == ["/table=dim_staff/year=2022/month=11/day=04/00:00:00.parquet"]
+        dim_staff = pl.read_parquet(BytesIO(s3.get_object(
+            Bucket="totesys-processed-data-000000", Key=keys[0]
+        )["Body"].read()))
+        assert dim_staff["location"].to_list() == ["Leeds"]
+        state = pl.read_parquet(BytesIO(s3.get_object(
+            Bucket="totesys-processed-data-000000", Key="/state/department.parquet"
+        )["Body"].read()))
+        assert state["location"].to_list() == ["Leeds"]
+        calendar = s3.get_object(
+            Bucket="totesys-processed-data-000000", Key="/state/dim_date.parquet"
+        )
+        assert calendar["LastModified"] <= s3.get_object(
+            Bucket="totesys-processed-data-000000", Key="/state/department.parquet"
+        )["LastModified"]
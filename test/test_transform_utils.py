@@ -1,10 +1,32 @@
 import pytest
 import boto3
+import json
 import os
 from moto import mock_aws
-from src.lambda_functions.transform import finds_data_buckets, convert_csv_to_parquet
+from src.lambda_functions.transform import finds_data_buckets
+from src.utils.transform_utils import (
+    build_fact_sales_order,
+    build_dim_staff,
+    build_dim_location,
+    build_dim_currency,
+    build_dim_counterparty,
+    generate_dim_date,
+    extend_dim_date,
+    build_star_schema,
+    upsert_source_state,
+    get_state,
+    save_states,
+    scan_all_differences,
+    remove_raw_files,
+    write_partition,
+    read_raw_file,
+    STAR_SCHEMA_SOURCES,
+)
+from unittest.mock import patch
 import polars as pl
 from io import BytesIO
+from decimal import Decimal
+from datetime import datetime as dt, date, time
 
 
 @pytest.fixture(scope="function")
@@ -87,33 +109,394 @@ class TestFindsDataBuckets:
         result = finds_data_buckets()
         assert result == ("totesys-raw-data-000000", "totesys-processed-data-000000")
 
+    @pytest.mark.it("Reuses the bucket names found by the previous call")
+    def test_buckets_are_cached(self, s3):
+        finds_data_buckets()
+        s3.delete_bucket(Bucket="totesys-raw-data-000000")
+        result = finds_data_buckets()
+        assert result == ("totesys-raw-data-000000", "totesys-processed-data-000000")
+
+
+SALES_ORDER = pl.LazyFrame(
+    {
+        "sales_order_id": [1, 2],
+        "created_at": [dt(2022, 11, 3, 14, 20, 49, 962000), dt(2022, 11, 4, 9, 0)],
+        "last_updated": [dt(2022, 11, 3, 14, 20, 49, 962000), dt(2022, 11, 5, 10, 30)],
+        "design_id": [9, 3],
+        "staff_id": [16, 19],
+        "counterparty_id": [18, 8],
+        "units_sold": [84754, 42972],
+        "unit_price": [2.43, 3.94],
+        "currency_id": [3, 2],
+        "agreed_delivery_date": ["2022-11-10", "2022-11-07"],
+        "agreed_payment_date": ["2022-11-03", "2022-11-08"],
+        "agreed_delivery_location_id": [4, 8],
+    }
+)
+ADDRESS = pl.LazyFrame(
+    {
+        "address_id": [1, 2],
+        "address_line_1": ["6826 Herzog Via", "179 Alexie Cliffs"],
+        "address_line_2": [None, "Flat 1"],
+        "district": ["Avon", None],
+        "city": ["New Patienceburgh", "Aliso Viejo"],
+        "postal_code": ["28441", "99305-7380"],
+        "country": ["Turkey", "San Marino"],
+        "phone": ["1803 637401", "9621 880720"],
+        "created_at": [dt(2022, 11, 3, 14, 20, 49, 962000)] * 2,
+        "last_updated": [dt(2022, 11, 3, 14, 20, 49, 962000)] * 2,
+    }
+)
+
+
+class TestStarSchema:
+
+    @pytest.mark.it("fact_sales_order splits created_at and last_updated into dates and times")
+    def test_build_fact_sales_order(self):
+        result = build_fact_sales_order(SALES_ORDER).collect()
+
+        assert result.columns == [
+            "sales_order_id", "created_date", "created_time", "last_updated_date",
+            "last_updated_time", "sales_staff_id", "counterparty_id", "units_sold",
+            "unit_price", "currency_id", "design_id", "agreed_payment_date",
+            "agreed_delivery_date", "agreed_delivery_location_id",
+        ]
+        assert result["created_date"].to_list() == [date(2022, 11, 3), date(2022, 11, 4)]
+        assert result["created_time"].to_list() == [time(14, 20, 49, 962000), time(9, 0)]
+        assert result["agreed_payment_date"].to_list() == [date(2022, 11, 3), date(2022, 11, 8)]
+        assert result["sales_staff_id"].to_list() == [16, 19]
+
+    @pytest.mark.it("dim_staff takes the department name and location of each member of staff")
+    def test_build_dim_staff(self):
+        staff = pl.LazyFrame(
+            {
+                "staff_id": [1, 2],
+                "first_name": ["Jeremie", "Deron"],
+                "last_name": ["Franey", "Beier"],
+                "department_id": [2, 6],
+                "email_address": ["jeremie.franey@terrifictotes.com", "deron.beier@terrifictotes.com"],
+            }
+        )
+        department = pl.LazyFrame(
+            {
+                "department_id": [2, 6],
+                "department_name": ["Purchasing", "Facilities"],
+                "location": ["Manchester", "Manchester"],
+                "manager": ["Naomi Lapaglia", "Shelley Levene"],
+            }
+        )
+
+        result = build_dim_staff(staff, department).collect()
+
+        assert result.rows() == [
+            (1, "Jeremie", "Franey", "Purchasing", "Manchester", "jeremie.franey@terrifictotes.com"),
+            (2, "Deron", "Beier", "Facilities", "Manchester", "deron.beier@terrifictotes.com"),
+        ]
+
+    @pytest.mark.it("dim_counterparty takes the legal address of each counterparty")
+    def test_build_dim_counterparty(self):
+        counterparty = pl.LazyFrame(
+            {
+                "counterparty_id": [1],
+                "counterparty_legal_name": ["Fahey and Sons"],
+                "legal_address_id": [2],
+                "commercial_contact": ["Micheal Toy"],
+            }
+        )
+
+        result = build_dim_counterparty(counterparty, ADDRESS).collect()
+
+        assert result.rows(named=True) == [
+            {
+                "counterparty_id": 1,
+                "counterparty_legal_name": "Fahey and Sons",
+                "counterparty_legal_address_line_1": "179 Alexie Cliffs",
+                "counterparty_legal_address_line_2": "Flat 1",
+                "counterparty_legal_district": None,
+                "counterparty_legal_city": "Aliso Viejo",
+                "counterparty_legal_postal_code": "99305-7380",
+                "counterparty_legal_country": "San Marino",
+                "counterparty_legal_phone_number": "9621 880720",
+            }
+        ]
+
+    @pytest.mark.it("dim_location renames address_id to location_id")
+    def test_build_dim_location(self):
+        result = build_dim_location(ADDRESS).collect()
+
+        assert result.columns[0] == "location_id"
+        assert "created_at" not in result.columns
+        assert result.height == 2
+
+    @pytest.mark.it("dim_currency adds the name of each currency, or its code when unknown")
+    def test_build_dim_currency(self):
+        currency = pl.LazyFrame({"currency_id": [1, 2, 3], "currency_code": ["GBP", "USD", "XYZ"]})
 
-class TestConvertCsvToParquet:
+        result = build_dim_currency(currency).collect()
 
-    @pytest.mark.it("csv file not found")
-    def test_csv_file_not_found(self, s3):
-        result = convert_csv_to_parquet("test.csv")
-        assert result == "csv file not found"
+        assert result["currency_name"].to_list() == ["British Pound", "US Dollar", "XYZ"]
 
-    @pytest.mark.it("converts cvs to parquet correctly")
-    def test_convert_csv_to_parquet(self, s3):
+    @pytest.mark.it("Only the columns used by the star schema are read from the sources")
+    def test_projection_pushdown(self):
+        ADDRESS.collect().write_csv("/tmp/address_pushdown.csv")
+
+        plan = build_dim_location(pl.scan_csv("/tmp/address_pushdown.csv")).explain()
+
+        assert "PROJECT 8/10 COLUMNS" in plan
+
+
+class TestIncrementalStarSchema:
+
+    @pytest.mark.it("Changed rows replace the state rows with the same key, deleted rows are removed")
+    def test_upsert_source_state(self):
+        state = pl.DataFrame({"staff_id": [1, 2, 3], "first_name": ["Jeremie", "Deron", "Jeanne"]})
+        changes = pl.LazyFrame(
+            {
+                "staff_id": ["2", "3", "4"],
+                "first_name": ["Deronne", None, "Ana"],
+                "change_type": ["update", "delete", "insert"],
+            }
+        )
+
+        result, changed_rows = upsert_source_state(state, changes, "staff")
+
+        assert result.rows() == [(1, "Jeremie"), (2, "Deronne"), (4, "Ana")]
+        assert changed_rows.collect().schema["staff_id"] == pl.Int64
+
+    @pytest.mark.it("Counterparties are rebuilt when their legal address changes")
+    def test_address_change_rebuilds_counterparty(self):
+        counterparty = pl.DataFrame(
+            {
+                "counterparty_id": [1, 2],
+                "counterparty_legal_name": ["Fahey and Sons", "Leannon Inc"],
+                "legal_address_id": [2, 1],
+            }
+        )
+        address = ADDRESS.collect()
+        changes = {table: None for table in STAR_SCHEMA_SOURCES}
+        changes["address"] = address.lazy().filter(pl.col("address_id") == 2).with_columns(
+            change_type=pl.lit("update")
+        )
+        states = {
+            "staff": None,
+            "department": None,
+            "counterparty": counterparty,
+            "address": address,
+        }
+
+        result = build_star_schema(changes, states)
+
+        tables = dict(zip(result, pl.collect_all(list(result.values()))))
+        assert list(tables) == ["dim_location", "dim_counterparty"]
+        assert tables["dim_location"]["location_id"].to_list() == [2]
+        assert tables["dim_counterparty"]["counterparty_id"].to_list() == [1]
+
+    @pytest.mark.it("Source state is saved and read back from the cache while unchanged")
+    def test_source_state_is_cached(self, s3):
+        state = pl.DataFrame({"staff_id": [1], "first_name": ["Jeremie"]})
+        save_states({"staff": state}, s3, "totesys-processed-data-000000")
+
+        with patch.object(s3, "get_object") as get_object:
+            result = get_state("staff", s3, "totesys-processed-data-000000")
+
+        assert result.equals(state)
+        get_object.assert_not_called()
+        assert get_state("department", s3, "totesys-processed-data-000000") is None
+
+    @pytest.mark.it("Several states are saved together and cached")
+    def test_save_states(self, s3):
+        states = {
+            "staff": pl.DataFrame({"staff_id": [1]}),
+            "department": pl.DataFrame({"department_id": [2]}),
+        }
+        save_states(states, s3, "totesys-processed-data-000000")
+
+        with patch.object(s3, "get_object") as get_object:
+            for table, state in states.items():
+                assert get_state(table, s3, "totesys-processed-data-000000").equals(state)
+        get_object.assert_not_called()
+
+    @pytest.mark.it("Differences of several tables are read from parquet or csv files")
+    def test_scan_all_differences(self, s3):
+        prefix = "2024/01/01/00:00:00/"
+        parquet = BytesIO()
+        pl.DataFrame({"staff_id": [1], "change_type": ["insert"]}).write_parquet(parquet)
         s3.put_object(
-            Body="test,test2,test3\n1,2,3\n5,6,7\n8,9,10",
             Bucket="totesys-raw-data-000000",
-            Key="test.csv",
-        )
-        result = convert_csv_to_parquet("test.csv")
-        parquet_buffer = BytesIO(result)
-        df_read_parquet = pl.read_parquet(parquet_buffer)
-        data = {"test": [1, 5, 8], "test2": [2, 6, 9], "test3": [3, 7, 10]}
-        df = pl.DataFrame(data)
-        assert isinstance(df_read_parquet, pl.DataFrame)
-        assert df.equals(df_read_parquet)
-
-    @pytest.mark.it("correct message shown when file is not type csv")
-    def test_returns_appropriate_message_if_file_is_not_csv(self, s3):
+            Key=f"/history/{prefix}staff_differences.parquet",
+            Body=parquet.getvalue(),
+        )
         s3.put_object(
-            Body="""Apple""", Bucket="totesys-raw-data-000000", Key="test.txt"
+            Bucket="totesys-raw-data-000000",
+            Key=f"/history/{prefix}address_differences.csv",
+            Body=f"address_id,created_at,last_updated,change_type\n"
+            "2,2022-11-03 14:20:49.962000,2022-11-03 14:20:49.962000,update\n",
+        )
+
+        result = scan_all_differences(
+            ["staff", "address", "design"], prefix, s3, "totesys-raw-data-000000"
+        )
+
+        assert result["design"] is None
+        assert result["staff"].collect()["staff_id"].to_list() == [1]
+        address = result["address"].collect()
+        assert address["address_id"].to_list() == [2]
+        assert address["last_updated"].dtype == pl.Datetime("us")
+        remove_raw_files(["staff", "address"])
+
+
+class TestDimDate:
+
+    @pytest.mark.it("Generates one row per day with its calendar attributes")
+    def test_generate_dim_date(self):
+        result = generate_dim_date(date(2022, 11, 3), date(2023, 1, 1))
+
+        assert result.columns == [
+            "date_id", "year", "month", "day", "day_of_week", "day_name", "month_name", "quarter",
+        ]
+        assert result.height == 60
+        assert result.row(0) == (date(2022, 11, 3), 2022, 11, 3, 4, "Thursday", "November", 4)
+        assert result.row(-1) == (date(2023, 1, 1), 2023, 1, 1, 7, "Sunday", "January", 1)
+
+    @pytest.mark.it("A new calendar covers the configured range")
+    def test_new_calendar(self):
+        with patch.dict(os.environ, {"DIM_DATE_START": "2022-01-01", "DIM_DATE_END": "2022-12-31"}):
+            calendar, new_rows = extend_dim_date(None, build_fact_sales_order(SALES_ORDER))
+
+        assert calendar.height == 365
+        assert new_rows.equals(calendar)
+
+    @pytest.mark.it("The calendar is left as it is when it covers every fact date")
+    def test_calendar_not_extended(self):
+        calendar = generate_dim_date(date(2022, 1, 1), date(2022, 12, 31))
+
+        result, new_rows = extend_dim_date(calendar, build_fact_sales_order(SALES_ORDER))
+
+        assert result is calendar
+        assert new_rows.height == 0
+
+    @pytest.mark.it("The calendar is extended by whole years to cover fact dates outside of it")
+    def test_calendar_extended(self):
+        calendar = generate_dim_date(date(2023, 1, 1), date(2023, 12, 31))
+        fact = build_fact_sales_order(
+            SALES_ORDER.with_columns(pl.lit("2024-02-29").alias("agreed_delivery_date"))
         )
-        result = convert_csv_to_parquet("test.txt")
-        assert result == "test.txt is not a .csv file."
+
+        result, new_rows = extend_dim_date(calendar, fact)
+
+        assert new_rows["date_id"].min() == date(2022, 1, 1)
+        assert new_rows["date_id"].max() == date(2024, 12, 31)
+        assert new_rows.height == 365 + 366
+        assert result["date_id"].is_sorted()
+        assert result.height == 365 * 2 + 366
+
+
+
+class TestPartitionedDatasets:
+
+    @pytest.mark.it("Rows are written sorted on last_updated to the partition of the run")
+    def test_write_partition(self, s3):
+        df = pl.DataFrame(
+            {
+                "staff_id": [1, 2, 3],
+                "last_updated": [dt(2024, 1, 2), dt(2024, 1, 1), None],
+            }
+        )
+
+        key = write_partition(
+            df, s3, "totesys-processed-data-000000", "/history/", "staff", "2024/01/02/10:30:00/"
+        )
+
+        assert key == "/history/table=staff/year=2024/month=01/day=02/10:30:00.parquet"
+        parquet = s3.get_object(Bucket="totesys-processed-data-000000", Key=key)["Body"].read()
+        assert pl.read_parquet(BytesIO(parquet))["staff_id"].to_list() == [2, 1, 3]
+
+    @pytest.mark.it("The partition index records the rows and min/max dates of each file")
+    def test_partition_index(self, s3):
+        bucket = "totesys-processed-data-000000"
+        for time_of_day, day in [("10:00:00", 1), ("11:00:00", 2), ("10:00:00", 3)]:
+            df = pl.DataFrame({"date_id": [date(2024, 1, 1), date(2024, 1, day)]})
+            write_partition(df, s3, bucket, "/", "dim_date", f"2024/01/02/{time_of_day}/")
+
+        index = json.loads(s3.get_object(
+            Bucket=bucket, Key="/table=dim_date/year=2024/month=01/day=02/_index.json"
+        )["Body"].read())
+
+        assert index == {
+            "files": {
+                "10:00:00.parquet": {
+                    "rows": 2, "min": {"date_id": "2024-01-01"}, "max": {"date_id": "2024-01-03"}
+                },
+                "11:00:00.parquet": {
+                    "rows": 2, "min": {"date_id": "2024-01-01"}, "max": {"date_id": "2024-01-02"}
+                },
+            }
+        }
+
+    @pytest.mark.it("Readers only read the partitions matching their filters")
+    def test_partition_pruning(self, s3, tmp_path):
+        bucket = "totesys-processed-data-000000"
+        for day in [1, 2]:
+            df = pl.DataFrame({"staff_id": [day]})
+            write_partition(df, s3, bucket, "/history/", "staff", f"2024/01/0{day}/00:00:00/")
+        for obj in s3.list_objects(Bucket=bucket)["Contents"]:
+            filename = tmp_path / obj["Key"].lstrip("/")
+            filename.parent.mkdir(parents=True, exist_ok=True)
+            s3.download_file(bucket, obj["Key"], str(filename))
+
+        history = pl.scan_parquet(
+            tmp_path / "history" / "table=staff" / "**" / "*.parquet", hive_partitioning=True
+        )
+        result = history.filter(pl.col("day") == 2).collect()
+
+        assert result["staff_id"].to_list() == [2]
+        assert result["year"].to_list() == [2024]
+
+    @pytest.mark.it("Partitions of a table have the same schema whatever file they were read from")
+    def test_partition_schema(self, s3, tmp_path):
+        raw, processed = "totesys-raw-data-000000", "totesys-processed-data-000000"
+        typed = BytesIO()
+        pl.DataFrame(
+            {
+                "payment_id": [1],
+                "last_updated": [dt(2024, 1, 1)],
+                "payment_amount": [Decimal("10.50")],
+                "paid": [True],
+                "change_type": ["insert"],
+            },
+            schema_overrides={"payment_id": pl.Int32, "payment_amount": pl.Decimal(10, 2)},
+        ).write_parquet(typed)
+        s3.put_object(Bucket=raw, Key="/history/1/payment_differences.parquet", Body=typed.getvalue())
+        s3.put_object(
+            Bucket=raw,
+            Key="/history/2/payment_differences.csv",
+            Body="payment_id,last_updated,payment_amount,paid,change_type\n"
+            "2,2024-01-02 10:30:00.000000,3.25,False,update\n",
+        )
+        s3.put_object(
+            Bucket=raw,
+            Key="/history/3/payment_differences.csv",
+            Body="payment_id,last_updated,payment_amount,paid,change_type\n",
+        )
+        for day in [1, 2, 3]:
+            df = read_raw_file(f"/history/{day}/payment_differences", s3, raw)
+            write_partition(df, s3, processed, "/history/", "payment", f"2024/01/0{day}/00:00:00/")
+        for obj in s3.list_objects(Bucket=processed, Prefix="/history/")["Contents"]:
+            filename = tmp_path / obj["Key"].lstrip("/")
+            filename.parent.mkdir(parents=True, exist_ok=True)
+            s3.download_file(processed, obj["Key"], str(filename))
+
+        history = pl.scan_parquet(
+            tmp_path / "history" / "table=payment" / "**" / "*.parquet", hive_partitioning=True
+        ).collect()
+
+        assert history["payment_id"].to_list() == [1, 2]
+        assert history.select(
+            "payment_id", "last_updated", "payment_amount", "paid", "change_type"
+        ).schema == {
+            "payment_id": pl.Int32,
+            "last_updated": pl.Datetime("us"),
+            "payment_amount": pl.Float64,
+            "paid": pl.Boolean,
+            "change_type": pl.String,
+        }